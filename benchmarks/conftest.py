@@ -0,0 +1,34 @@
+"""
+Fixtures shared by the benchmarks. Saved results go to benchmarks/results so runs can be
+compared across releases.
+"""
+
+import math
+from pathlib import Path
+
+import pytest
+
+from camsrv.header import TelemetryCache
+from camsrv.simulate import StubAPI
+
+from synthetic import READOUTS
+
+RESULTS = Path(__file__).parent / "results"
+
+
+def pytest_configure(config):
+    # store saved runs with the benchmarks unless told otherwise
+    if config.getoption("benchmark_storage", None) == "file://./.benchmarks":
+        config.option.benchmark_storage = f"file://{RESULTS}"
+
+
+@pytest.fixture(params=READOUTS)
+def readout(request):
+    return request.param
+
+
+@pytest.fixture
+def telemetry():
+    cache = TelemetryCache(http=StubAPI(), autostart=False, max_age=math.inf)
+    cache.refresh()
+    return cache
@@ -0,0 +1,68 @@
+"""
+Synthetic frames and bad pixel masks for each camera readout used by the benchmarks
+"""
+
+import io
+
+import numpy as np
+
+from camsrv import simulate
+from camsrv.badpix import Geometry
+
+# full-frame detector size of each camera, (height, width)
+DETECTORS = {
+    "f5wfs": (512, 512),
+    "f9wfs": (2048, 2048),
+    "matcam": (1024, 1024),
+    "ratcam": (1024, 1280),
+}
+
+# readout configurations the cameras are run in: detector and binning
+READOUTS = {
+    "f5wfs": ("f5wfs", 1),
+    "f5wfs_2x2": ("f5wfs", 2),
+    "f9wfs": ("f9wfs", 1),
+    "f9wfs_3x3": ("f9wfs", 3),
+    "matcam": ("matcam", 1),
+    "matcam_2x2": ("matcam", 2),
+    "ratcam": ("ratcam", 1),
+    "ratcam_2x2": ("ratcam", 2),
+}
+
+
+def readout_geometry(readout):
+    detector, nbin = READOUTS[readout]
+    height, width = DETECTORS[detector]
+    return Geometry(0, 0, width, height, nbin, nbin)
+
+
+def make_frame(readout, nspots=200, seed=0):
+    """
+    camsrv.simulate.make_frame at the readout's binned size, with its binning in the header
+    """
+    g = readout_geometry(readout)
+    hdu = simulate.make_frame(
+        (g.height // g.ybin, g.width // g.xbin), nspots=nspots, seed=seed
+    )
+    hdu.header["XBINNING"] = g.xbin
+    hdu.header["YBINNING"] = g.ybin
+    return hdu
+
+
+def make_mask(readout, nbad=500, seed=1):
+    """
+    Full-frame bad pixel mask for the readout's detector
+    """
+    detector, _ = READOUTS[readout]
+    rng = np.random.default_rng(seed)
+    mask = np.zeros(DETECTORS[detector], dtype=bool)
+    y = rng.integers(0, mask.shape[0], nbad)
+    x = rng.integers(0, mask.shape[1], nbad)
+    mask[y, x] = True
+    return mask
+
+
+def to_blob(hdu):
+    out = io.BytesIO()
+    hdu.writeto(out)
+    return out.getvalue()
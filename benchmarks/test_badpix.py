@@ -0,0 +1,34 @@
+"""
+Benchmark the sparse bad pixel correction against the full-frame median filter it replaces, at
+each camera's readout configurations.
+
+Run with: pytest benchmarks/test_badpix.py
+"""
+
+import numpy as np
+
+from camsrv.badpix import BadPixelCorrector, BadPixelMasks, median_filter_correct
+
+from synthetic import make_frame, make_mask, readout_geometry
+
+
+def bad_frame(readout):
+    """
+    Synthetic frame with the pixels flagged in the readout's bad pixel mask set high, along with
+    the mask binned to match it
+    """
+    mask = BadPixelMasks(make_mask(readout)).derive(readout_geometry(readout))
+    im = make_frame(readout).data.astype(np.float32)
+    im[mask] = 60000.0
+    return im, mask
+
+
+def test_median_filter(benchmark, readout):
+    im, mask = bad_frame(readout)
+    benchmark(median_filter_correct, im, mask)
+
+
+def test_sparse(benchmark, readout):
+    im, mask = bad_frame(readout)
+    corrector = BadPixelCorrector(mask)
+    benchmark(corrector.correct, im)
@@ -0,0 +1,34 @@
+"""
+Benchmark looking up the master bias and dark for a light frame and subtracting them, with the dark
+scaled to the light's exposure time, at each camera's readout configurations.
+
+Run with: pytest benchmarks/test_calibration.py
+"""
+
+import numpy as np
+
+from camsrv.calibration import CalibrationLibrary
+
+from synthetic import make_frame
+
+
+def calibration_frame(readout, imagetyp, exptime, value):
+    hdu = make_frame(readout, nspots=0)
+    hdu.data[:] = value
+    hdu.header["IMAGETYP"] = imagetyp
+    hdu.header["EXPTIME"] = exptime
+    return hdu
+
+
+def test_calibrate(benchmark, readout):
+    library = CalibrationLibrary()
+    library.build([calibration_frame(readout, "Bias", 0.0, 1000)])
+    library.build([calibration_frame(readout, "Dark", 10.0, 1010)])
+
+    light = make_frame(readout)
+    light.header["EXPTIME"] = 5.0
+    calibrated, used = benchmark(
+        library.calibrate, light.data, light.header, saturation=65535
+    )
+    assert used["dark_scale"] == 0.5
+    assert calibrated.dtype == np.float32
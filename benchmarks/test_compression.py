@@ -0,0 +1,38 @@
+"""
+Benchmark writing and reading back frames in each of the FITS output formats at each camera's
+readout configurations. The file size of each is recorded in the benchmark's extra_info.
+
+Run with: pytest benchmarks/test_compression.py
+"""
+
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from camsrv.writer import OUTPUT_FORMATS, encode_fits, write_atomic
+
+from synthetic import make_frame
+
+
+@pytest.mark.parametrize("fmt", OUTPUT_FORMATS)
+def test_write(benchmark, tmp_path, readout, fmt):
+    hdu = make_frame(readout)
+    filename = tmp_path / "test.fits"
+
+    benchmark(lambda: write_atomic(filename, encode_fits(hdu, fmt)))
+    benchmark.extra_info["size"] = filename.stat().st_size
+
+
+@pytest.mark.parametrize("fmt", OUTPUT_FORMATS)
+def test_read(benchmark, tmp_path, readout, fmt):
+    hdu = make_frame(readout)
+    filename = tmp_path / "test.fits"
+    write_atomic(filename, encode_fits(hdu, fmt))
+
+    def read():
+        with fits.open(filename) as hdulist:
+            return hdulist[-1].data.copy()
+
+    data = benchmark(read)
+    assert np.array_equal(data, hdu.data)
+    benchmark.extra_info["size"] = filename.stat().st_size
@@ -0,0 +1,54 @@
+"""
+Benchmark reading a FITS BLOB and writing it back out, as the WFS servers do for every frame,
+through astropy's file layer and through RawImage, at each camera's readout configurations. Peak
+memory allocated per frame is recorded in the benchmark's extra_info.
+
+Run with: pytest benchmarks/test_ingest.py
+"""
+
+import io
+import tracemalloc
+
+import pytest
+from astropy.io import fits
+
+from camsrv.ingest import RawImage
+
+from synthetic import make_frame, to_blob
+
+
+def astropy_ingest(blob):
+    hdulist = fits.open(io.BytesIO(blob))
+    hdulist[0].data[0, 0] = 0
+    out = io.BytesIO()
+    hdulist[0].writeto(out)
+    return out.getvalue()
+
+
+def raw_ingest(blob, modified=True):
+    raw = RawImage(blob)
+    if modified:
+        raw.data[0, 0] = 0
+    raw.modified = modified
+    return raw.tobytes()
+
+
+def peak_memory(func, *args):
+    tracemalloc.start()
+    func(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def test_astropy(benchmark, readout):
+    blob = to_blob(make_frame(readout))
+    benchmark.extra_info["peak_memory"] = peak_memory(astropy_ingest, blob)
+    benchmark(astropy_ingest, blob)
+
+
+@pytest.mark.parametrize("modified", [True, False])
+def test_raw(benchmark, readout, modified):
+    blob = to_blob(make_frame(readout))
+    benchmark.extra_info["peak_memory"] = peak_memory(raw_ingest, blob, modified)
+    benchmark(raw_ingest, blob, modified)
@@ -0,0 +1,88 @@
+"""
+Benchmark each stage of getting a frame from the camera onto disk and to the browser, at each
+camera's readout configurations.
+
+Run with: pytest benchmarks/test_pipeline.py --benchmark-autosave
+Compare with earlier runs: pytest benchmarks/test_pipeline.py --benchmark-compare
+"""
+
+import asyncio
+import io
+import tempfile
+from pathlib import Path
+
+import pytest
+from astropy.io import fits
+
+from camsrv.badpix import BadPixelMasks
+from camsrv.header import update_header
+from camsrv.ingest import read_blob
+from camsrv.matcam import MATsrv
+
+from synthetic import make_frame, make_mask, readout_geometry, to_blob
+
+# write to tmpfs where available so the disk doesn't dominate
+TMPFS = Path("/dev/shm") if Path("/dev/shm").is_dir() else None
+
+
+def test_open_blob(benchmark, readout):
+    blob = to_blob(make_frame(readout))
+
+    def ingest():
+        return fits.open(io.BytesIO(blob))[0].data
+
+    benchmark(ingest)
+
+
+def test_read_blob(benchmark, readout):
+    blob = to_blob(make_frame(readout))
+    benchmark(lambda: read_blob(blob)[0][0].data)
+
+
+def test_update_header(benchmark, readout, telemetry):
+    hdu = make_frame(readout)
+    benchmark(update_header, hdu, telemetry=telemetry)
+
+
+def test_correct(benchmark, readout):
+    hdu = make_frame(readout)
+    corrector = BadPixelMasks(make_mask(readout)).corrector(readout_geometry(readout))
+    benchmark(corrector.correct, hdu.data)
+
+
+def test_serialize(benchmark, readout):
+    hdu = make_frame(readout)
+
+    def serialize():
+        out = io.BytesIO()
+        hdu.writeto(out)
+        return out.getvalue()
+
+    benchmark(serialize)
+
+
+@pytest.fixture
+def server():
+    # the server needs an event loop to attach its periodic callbacks to
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    app = MATsrv(connect=False)
+    with tempfile.TemporaryDirectory(dir=TMPFS) as datadir:
+        app.datadir = Path(datadir)
+        yield app
+        app.writer.stop()
+    asyncio.set_event_loop(None)
+    loop.close()
+
+
+def test_save_latest(benchmark, readout, server):
+    hdu = make_frame(readout)
+
+    def save():
+        # a new image each time so it is serialized again like it would be for a new frame
+        server.latest_image = fits.PrimaryHDU(hdu.data, header=hdu.header)
+        server.save_latest()
+        server.writer.flush()
+
+    benchmark(save)
+    assert server.writer.stats()["failed"] == 0
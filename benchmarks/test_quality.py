@@ -0,0 +1,16 @@
+"""
+Benchmark the background, noise, saturation, and spot statistics computed for each frame at each
+camera's readout configurations, including the spot detection that dominates their cost.
+
+Run with: pytest benchmarks/test_quality.py
+"""
+
+from camsrv.quality import frame_stats
+
+from synthetic import make_frame
+
+
+def test_frame_stats(benchmark, readout):
+    im = make_frame(readout).data
+    stats = benchmark(frame_stats, im, spots=True)
+    assert stats["nspots"] > 0
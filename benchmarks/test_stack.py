@@ -0,0 +1,33 @@
+"""
+Benchmark adding a frame to a full stack of eight and combining them at each camera's readout
+configurations. Sums and means both come from the running total, so mean stands in for sum when
+combining.
+
+Run with: pytest benchmarks/test_stack.py
+"""
+
+import pytest
+
+from camsrv.stack import Stack
+
+from synthetic import make_frame
+
+
+@pytest.mark.parametrize("mode", ["sum", "mean", "median"])
+def test_stack_add(benchmark, readout, mode):
+    hdu = make_frame(readout)
+    stack = Stack(mode=mode, depth=8)
+    for _ in range(8):
+        stack.add(hdu)
+    benchmark(stack.add, hdu)
+    assert len(stack) == 8
+
+
+@pytest.mark.parametrize("mode", ["mean", "median"])
+def test_stack_combine(benchmark, readout, mode):
+    hdu = make_frame(readout)
+    stack = Stack(mode=mode, depth=8)
+    for _ in range(8):
+        stack.add(hdu)
+    stacked = benchmark(stack.combine)
+    assert stacked.shape == hdu.data.shape
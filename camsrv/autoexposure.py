@@ -0,0 +1,110 @@
+"""
+Pick exposure times from the measured signal of previous frames
+"""
+
+import threading
+
+__all__ = ["AutoExposure", "METRICS"]
+
+# statistics from camsrv.quality.frame_stats() that can be used as the signal
+METRICS = ("peak", "spot_flux")
+
+
+class AutoExposure:
+    """
+    Scale the exposure time so the signal, either the background-subtracted peak or the mean WFS
+    spot flux, lands on target. The signal is assumed to be proportional to the exposure time,
+    which holds until pixels saturate, so a saturated frame only tells us the exposure has to be
+    at least halved. Each step is limited to a factor of max_step and exposure times are clamped
+    to [min_exptime, max_exptime]. A frame is converged if its signal is within tolerance, a
+    fraction of target, and auto-exposure sequences give up after max_iterations frames.
+    """
+
+    def __init__(
+        self,
+        target=30000.0,
+        metric="peak",
+        tolerance=0.2,
+        min_exptime=0.05,
+        max_exptime=60.0,
+        max_step=10.0,
+        max_iterations=4,
+        nsigma=5.0,
+    ):
+        if metric not in METRICS:
+            raise ValueError(
+                f"Unknown auto-exposure metric {metric}, must be one of {METRICS}"
+            )
+        self.target = target
+        self.metric = metric
+        self.tolerance = tolerance
+        self.min_exptime = min_exptime
+        self.max_exptime = max_exptime
+        self.max_step = max_step
+        self.max_iterations = max_iterations
+        self.nsigma = nsigma
+        self.lock = threading.Lock()
+        self.last = None
+
+    def signal(self, stats):
+        """
+        Signal of a frame given its quality statistics
+        """
+        if self.metric == "spot_flux" and stats.get("nspots"):
+            return stats["spot_flux"]
+        return stats["peak"] - stats["background"]
+
+    def converged(self, stats):
+        return (
+            stats.get("saturated", 0) == 0
+            and abs(self.signal(stats) - self.target) <= self.tolerance * self.target
+        )
+
+    def next_exptime(self, exptime, stats):
+        """
+        Exposure time that should bring a frame taken with exptime and measured as stats on target
+        """
+        signal = self.signal(stats)
+        if signal <= self.nsigma * max(stats["noise"], 1.0):
+            # nothing above the noise to scale from
+            scale = self.max_step
+        else:
+            scale = self.target / signal
+            if stats.get("saturated", 0) > 0:
+                scale = min(scale, 0.5)
+        scale = min(max(scale, 1.0 / self.max_step), self.max_step)
+        return min(max(exptime * scale, self.min_exptime), self.max_exptime)
+
+    def update(self, exptime, stats):
+        """
+        Record the exposure time and statistics of the latest light frame
+        """
+        with self.lock:
+            self.last = {
+                "exptime": exptime,
+                "signal": self.signal(stats),
+                "saturated": stats.get("saturated", 0),
+                "converged": self.converged(stats),
+                "next_exptime": self.next_exptime(exptime, stats),
+            }
+        return self.last
+
+    def suggest(self, default=None):
+        """
+        Exposure time for the next frame, or default if no frame has been measured yet
+        """
+        with self.lock:
+            if self.last is None:
+                return default
+            return self.last["next_exptime"]
+
+    def state(self):
+        return {
+            "target": self.target,
+            "metric": self.metric,
+            "tolerance": self.tolerance,
+            "min_exptime": self.min_exptime,
+            "max_exptime": self.max_exptime,
+            "max_iterations": self.max_iterations,
+            "last": self.last,
+        }
@@ -0,0 +1,168 @@
+"""
+Bad pixel correction that only computes medians at the masked pixels
+"""
+
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+from scipy.ndimage import median_filter
+
+__all__ = [
+    "BadPixelCorrector",
+    "BadPixelMasks",
+    "Geometry",
+    "median_filter_correct",
+    "readout_geometry",
+]
+
+# readout region in unbinned detector pixels plus the binning factors
+Geometry = namedtuple("Geometry", ["x", "y", "width", "height", "xbin", "ybin"])
+
+
+def median_filter_correct(im, mask, size=5):
+    """
+    Reference correction that replaces masked pixels with a full-frame median filter
+    """
+    blurred = median_filter(im, size=size)
+    im[mask] = blurred[mask]
+    return im
+
+
+class BadPixelCorrector:
+    """
+    Replace masked pixels with the median of their size x size neighborhood. The neighbor indices
+    are computed once per mask so each correction only touches the pixels around the bad ones.
+    Other bad pixels and pixels outside of the frame are excluded from each median.
+    """
+
+    def __init__(self, mask, size=5):
+        self.mask = np.asarray(mask, dtype=bool)
+        self.shape = self.mask.shape
+        self.size = size
+
+        ny, nx = self.shape
+        self.y, self.x = np.nonzero(self.mask)
+
+        offsets = np.arange(size) - size // 2
+        dy, dx = np.meshgrid(offsets, offsets, indexing="ij")
+        yy = self.y[:, np.newaxis] + dy.ravel()
+        xx = self.x[:, np.newaxis] + dx.ravel()
+
+        inside = (yy >= 0) & (yy < ny) & (xx >= 0) & (xx < nx)
+        yy = np.clip(yy, 0, ny - 1)
+        xx = np.clip(xx, 0, nx - 1)
+        self.valid = inside & ~self.mask[yy, xx]
+        self.index = np.ravel_multi_index((yy, xx), self.shape)
+
+    @property
+    def npix(self):
+        return len(self.y)
+
+    def medians(self, im):
+        """
+        Return the neighborhood median for each bad pixel. Pixels with no good neighbors get NaN.
+        """
+        vals = np.take(im, self.index).astype(np.float64)
+        vals[~self.valid] = np.nan
+        # sorting puts the NaNs at the end so the median is taken from the first nvalid values
+        vals.sort(axis=1)
+        nvalid = self.valid.sum(axis=1)
+        rows = np.arange(len(vals))
+        lo = np.clip((nvalid - 1) // 2, 0, None)
+        hi = np.clip(nvalid // 2, 0, None)
+        meds = 0.5 * (vals[rows, lo] + vals[rows, hi])
+        meds[nvalid == 0] = np.nan
+        return meds
+
+    def correct(self, im):
+        """
+        Correct the bad pixels in im in place and return it
+        """
+        if im.shape != self.shape:
+            raise ValueError(
+                f"Image shape {im.shape} does not match bad pixel mask shape {self.shape}"
+            )
+        if self.npix == 0:
+            return im
+
+        meds = self.medians(im)
+        good = np.isfinite(meds)
+        if np.issubdtype(im.dtype, np.integer):
+            meds = np.rint(meds)
+        im[self.y[good], self.x[good]] = meds[good]
+        return im
+
+
+def readout_geometry(shape, full_shape, header=None, frame=None, binning=None):
+    """
+    Work out the readout Geometry of an image with the given shape. Binning and subframe origin are
+    taken from the FITS header (XBINNING/YBINNING and XORGSUBF/YORGSUBF) if present, otherwise from
+    the camera's frame and binning dicts. Returns None if the geometry can't be determined or doesn't
+    fit within a detector of full_shape.
+    """
+    if header is None:
+        header = {}
+    binning = binning or {}
+    frame = frame or {}
+
+    xbin = int(header.get("XBINNING", binning.get("X", 1)))
+    ybin = int(header.get("YBINNING", binning.get("Y", 1)))
+    height = shape[0] * ybin
+    width = shape[1] * xbin
+
+    if "XORGSUBF" in header and "YORGSUBF" in header:
+        # subframe origin is given in binned pixels
+        x = int(header["XORGSUBF"]) * xbin
+        y = int(header["YORGSUBF"]) * ybin
+    elif "X" in frame and "Y" in frame:
+        x = int(frame["X"])
+        y = int(frame["Y"])
+    elif (height, width) == tuple(full_shape):
+        x = y = 0
+    else:
+        return None
+
+    if x < 0 or y < 0 or y + height > full_shape[0] or x + width > full_shape[1]:
+        return None
+
+    return Geometry(x, y, width, height, xbin, ybin)
+
+
+class BadPixelMasks:
+    """
+    Derive binned and windowed bad pixel masks from a full-frame mask. The BadPixelCorrector for each
+    readout Geometry is cached and the least recently used ones are evicted beyond maxsize.
+    """
+
+    def __init__(self, mask, size=5, maxsize=8):
+        self.source = mask
+        self.mask = np.asarray(mask, dtype=bool)
+        self.size = size
+        self.maxsize = maxsize
+        self.cache = OrderedDict()
+
+    def derive(self, geometry):
+        """
+        Return the mask for geometry. A binned pixel is bad if any of the pixels binned into it are.
+        """
+        g = geometry
+        ny = g.height // g.ybin
+        nx = g.width // g.xbin
+        rows = slice(g.y, g.y + ny * g.ybin)
+        cols = slice(g.x, g.x + nx * g.xbin)
+        window = self.mask[rows, cols]
+        return window.reshape(ny, g.ybin, nx, g.xbin).any(axis=(1, 3))
+
+    def corrector(self, geometry):
+        """
+        Get the cached BadPixelCorrector for geometry, building it if needed
+        """
+        if geometry in self.cache:
+            self.cache.move_to_end(geometry)
+            return self.cache[geometry]
+
+        corrector = BadPixelCorrector(self.derive(geometry), size=self.size)
+        self.cache[geometry] = corrector
+        while len(self.cache) > self.maxsize:
+            self.cache.popitem(last=False)
+        return corrector
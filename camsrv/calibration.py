@@ -0,0 +1,362 @@
+"""
+Library of master bias and dark frames, indexed by readout geometry, exposure time, and
+temperature, that are subtracted from images as they come in
+"""
+
+import bisect
+import json
+import logging
+import math
+import os
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from pathlib import Path
+
+import numpy as np
+from astropy.io import fits
+
+__all__ = ["KINDS", "CalibrationLibrary", "Master", "frame_kind", "frame_geometry"]
+
+log = logging.getLogger("tornado.application")
+
+KINDS = ("bias", "dark")
+
+# cameras report their temperature under different keywords
+TEMPERATURE_KEYS = ("CCD-TEMP", "CAMTEMP")
+
+Master = namedtuple(
+    "Master",
+    [
+        "kind",
+        "exptime",
+        "temperature",
+        "geometry",
+        "filename",
+        "ncombine",
+        "biassub",
+        "created",
+    ],
+)
+
+
+def frame_kind(header):
+    """
+    bias or dark if the header's IMAGETYP says the frame is one, otherwise None
+    """
+    imagetyp = str(header.get("IMAGETYP", "")).lower()
+    for kind in KINDS:
+        if kind in imagetyp:
+            return kind
+    return None
+
+
+def frame_geometry(shape, header):
+    """
+    Readout geometry of a frame as (ny, nx, xbin, ybin, x0, y0). Masters only apply to frames
+    with the same geometry.
+    """
+    return (
+        int(shape[0]),
+        int(shape[1]),
+        int(header.get("XBINNING", 1)),
+        int(header.get("YBINNING", 1)),
+        int(header.get("XORGSUBF", 0)),
+        int(header.get("YORGSUBF", 0)),
+    )
+
+
+def frame_temperature(header):
+    for key in TEMPERATURE_KEYS:
+        if key in header:
+            try:
+                return float(header[key])
+            except (TypeError, ValueError):
+                pass
+    return None
+
+
+class CalibrationLibrary:
+    """
+    Master biases and darks stored as FITS files in directory, with an index.json listing them so
+    the directory only has to be read when the library is opened. Masters are looked up through a
+    dict keyed by kind and readout geometry and a bisect on exposure time, so finding the one for a
+    frame doesn't depend on how many there are. Masters only match frames whose temperature is
+    within temperature_tolerance degrees, if both temperatures are known. Pixel data are loaded
+    on first use and the least recently used are dropped once they take up more than maxbytes.
+    If directory is None, masters are only kept in memory.
+
+    Darks are stored with the matching bias subtracted, if there was one when they were built,
+    which lets them be scaled to the exposure time of the frame being calibrated. Darks that
+    still include the bias are only used for frames of the same exposure time.
+    """
+
+    INDEX = "index.json"
+
+    def __init__(self, directory=None, maxbytes=64 * 2**20, temperature_tolerance=2.0):
+        self.maxbytes = maxbytes
+        self.temperature_tolerance = temperature_tolerance
+        self.lock = threading.Lock()
+        self.cache = OrderedDict()
+        self.open(directory)
+
+    def open(self, directory):
+        """
+        Load the index of the masters in directory, replacing any that were loaded before
+        """
+        with self.lock:
+            self.directory = None if directory is None else Path(directory)
+            self.index = {}
+            self.exptimes = {}
+            self.masters = {}
+            self.cache.clear()
+            if self.directory is None:
+                return
+            index_file = self.directory / self.INDEX
+            if not index_file.exists():
+                return
+            try:
+                entries = json.loads(index_file.read_text())
+            except (OSError, ValueError) as e:
+                log.error(f"Unable to read calibration index {index_file}: {e}")
+                return
+            for entry in entries:
+                entry["geometry"] = tuple(entry["geometry"])
+                master = Master(**entry)
+                if (self.directory / master.filename).exists():
+                    self._add(master)
+
+    @property
+    def nbytes(self):
+        return sum(data.nbytes for data in list(self.cache.values()))
+
+    def __len__(self):
+        return len(self.masters)
+
+    def _add(self, master):
+        self.masters[master.filename] = master
+        key = (master.kind, master.geometry)
+        entries = self.index.setdefault(key, [])
+        exptimes = self.exptimes.setdefault(key, [])
+        # masters are kept sorted by exposure time and then by age
+        i = bisect.bisect(exptimes, master.exptime)
+        entries.insert(i, master)
+        exptimes.insert(i, master.exptime)
+
+    def _write_index(self):
+        entries = [m._asdict() for m in self.masters.values()]
+        tmp = self.directory / (self.INDEX + ".tmp")
+        tmp.write_text(json.dumps(entries, indent=1))
+        os.replace(tmp, self.directory / self.INDEX)
+
+    def _cached(self, key):
+        """
+        Mark a cache entry as recently used and drop the least recently used ones over maxbytes
+        """
+        self.cache.move_to_end(key)
+        for old in list(self.cache):
+            if old == key or self.nbytes <= self.maxbytes:
+                break
+            if self.directory is None and old in self.masters:
+                # there's nowhere to read it back from
+                continue
+            del self.cache[old]
+        return self.cache[key]
+
+    def data(self, master):
+        """
+        Pixel data of master as a float32 array, read from disk if it isn't in memory
+        """
+        with self.lock:
+            return self._data(master)
+
+    def _data(self, master):
+        if master.filename not in self.cache:
+            with fits.open(self.directory / master.filename) as hdulist:
+                self.cache[master.filename] = hdulist[0].data.astype(np.float32)
+        return self._cached(master.filename)
+
+    def find(self, kind, geometry, exptime=None, temperature=None, accept=None):
+        """
+        Master of kind for frames with geometry, taken at temperature, that is closest in exposure
+        time. The newest of equally close masters wins. If accept is given, only masters for which
+        it returns True are considered. Returns None if there isn't one.
+        """
+        with self.lock:
+            return self._find(kind, geometry, exptime, temperature, accept)
+
+    def _find(self, kind, geometry, exptime, temperature, accept=None):
+        entries = self.index.get((kind, geometry))
+        if not entries:
+            return None
+
+        def usable(master):
+            if accept is not None and not accept(master):
+                return False
+            return (
+                temperature is None
+                or master.temperature is None
+                or abs(master.temperature - temperature) <= self.temperature_tolerance
+            )
+
+        if exptime is None or kind == "bias":
+            for master in reversed(entries):
+                if usable(master):
+                    return master
+            return None
+
+        # walk out from where exptime would go until a master at the right temperature turns up
+        # on each side, then take the closer one
+        i = bisect.bisect(self.exptimes[(kind, geometry)], exptime)
+        below = next((m for m in reversed(entries[:i]) if usable(m)), None)
+        above = next((m for m in entries[i:] if usable(m)), None)
+        if below is None or above is None:
+            return below or above
+
+        def distance(m):
+            return abs(math.log(max(m.exptime, 1e-6) / max(exptime, 1e-6)))
+
+        return below if distance(below) <= distance(above) else above
+
+    def build(self, hdus, kind=None):
+        """
+        Median-combine hdus, which must all have the same geometry and exposure time, into a master
+        and add it to the library. Darks have the matching master bias subtracted if there is one.
+        Returns the new Master.
+        """
+        header = hdus[0].header
+        kind = kind or frame_kind(header)
+        if kind not in KINDS:
+            raise ValueError(f"Unknown calibration frame type {kind}")
+        geometry = frame_geometry(hdus[0].data.shape, header)
+        exptime = 0.0 if kind == "bias" else float(header.get("EXPTIME", 0.0))
+        for hdu in hdus[1:]:
+            if frame_geometry(hdu.data.shape, hdu.header) != geometry:
+                raise ValueError("Frames have different readout geometries")
+            if kind == "dark" and float(hdu.header.get("EXPTIME", 0.0)) != exptime:
+                raise ValueError("Darks have different exposure times")
+
+        data = np.median(
+            np.stack([np.asarray(hdu.data, dtype=np.float32) for hdu in hdus]), axis=0
+        ).astype(np.float32)
+        temps = [frame_temperature(hdu.header) for hdu in hdus]
+        temps = [t for t in temps if t is not None]
+        temperature = float(np.mean(temps)) if temps else None
+
+        biassub = False
+        if kind == "dark":
+            bias = self.find("bias", geometry, temperature=temperature)
+            if bias is not None:
+                data -= self.data(bias)
+                biassub = True
+
+        created = time.time()
+        stamp = time.strftime("%Y%m%dT%H%M%S", time.gmtime(created))
+        stamp += f"{created % 1:.3f}"[1:]
+        ny, nx, xbin, ybin, x0, y0 = geometry
+        master = Master(
+            kind=kind,
+            exptime=exptime,
+            temperature=temperature,
+            geometry=geometry,
+            filename=f"{kind}_{exptime:g}s_bin{xbin}x{ybin}_{nx}x{ny}+{x0}+{y0}_{stamp}.fits",
+            ncombine=len(hdus),
+            biassub=biassub,
+            created=created,
+        )
+
+        out = fits.PrimaryHDU(data=data)
+        out.header["IMAGETYP"] = kind.capitalize()
+        out.header["EXPTIME"] = exptime
+        if temperature is not None:
+            out.header["CCD-TEMP"] = temperature
+        out.header["XBINNING"] = xbin
+        out.header["YBINNING"] = ybin
+        out.header["XORGSUBF"] = x0
+        out.header["YORGSUBF"] = y0
+        out.header["NCOMBINE"] = (len(hdus), "Number of frames combined")
+        out.header["BIASSUB"] = (biassub, "Master bias has been subtracted")
+
+        with self.lock:
+            if self.directory is not None:
+                self.directory.mkdir(parents=True, exist_ok=True)
+                out.writeto(self.directory / master.filename)
+            self._add(master)
+            self.cache[master.filename] = data
+            self._cached(master.filename)
+            if self.directory is not None:
+                self._write_index()
+        return master
+
+    def calibrate(self, im, header, saturation=None):
+        """
+        Subtract the best matching master bias and dark from a light frame. The dark is scaled
+        to the frame's exposure time if it has had the bias subtracted. Returns the calibrated
+        image as a new float32 array along with a dict of the masters that were used, or None and
+        an empty dict if there was nothing to subtract. If saturation is given, the number of
+        pixels in im at or above it is included in the dict since they can't be picked out after
+        calibration.
+        """
+        if frame_kind(header) is not None:
+            return None, {}
+        geometry = frame_geometry(im.shape, header)
+        exptime = header.get("EXPTIME")
+        exptime = None if exptime is None else float(exptime)
+        temperature = frame_temperature(header)
+
+        def usable_dark(master):
+            if exptime is None:
+                return False
+            if master.biassub:
+                return bias is not None and master.exptime > 0
+            return math.isclose(master.exptime, exptime, rel_tol=0.01)
+
+        with self.lock:
+            bias = self._find("bias", geometry, None, temperature)
+            # only darks that can be used are candidates so an unusable one that is closer in
+            # exposure time doesn't hide one that can be scaled
+            dark = self._find("dark", geometry, exptime, temperature, usable_dark)
+            scale = 1.0
+            if dark is not None:
+                if dark.biassub:
+                    scale = exptime / dark.exptime
+                else:
+                    # the dark already includes the bias
+                    bias = None
+            if bias is None and dark is None:
+                return None, {}
+
+            # the bias plus scaled dark is cached too so a run of frames at the same exposure
+            # time costs a single subtraction each
+            key = (
+                None if bias is None else bias.filename,
+                None if dark is None else dark.filename,
+                round(scale, 6),
+            )
+            if key not in self.cache:
+                offset = np.zeros(im.shape, dtype=np.float32)
+                if bias is not None:
+                    offset += self._data(bias)
+                if dark is not None:
+                    offset += np.float32(scale) * self._data(dark)
+                self.cache[key] = offset
+            offset = self._cached(key)
+
+        calibrated = np.subtract(im, offset, dtype=np.float32)
+        used = {}
+        if bias is not None:
+            used["bias"] = bias.filename
+        if dark is not None:
+            used["dark"] = dark.filename
+            used["dark_scale"] = scale
+        if saturation is not None:
+            used["saturated"] = int(np.count_nonzero(im >= saturation))
+        return calibrated, used
+
+    def summary(self):
+        """
+        List of dicts describing each master, oldest first
+        """
+        with self.lock:
+            masters = sorted(self.masters.values(), key=lambda m: m.created)
+        return [dict(m._asdict(), geometry=list(m.geometry)) for m in masters]
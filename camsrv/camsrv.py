@@ -2,13 +2,19 @@
 Base classes for MMTO camera interface systems
 """
 
+import asyncio
 import importlib.resources
 import io
 import socket
 import json
 import importlib
-
-from scipy.ndimage import median_filter
+import itertools
+import time
+import datetime
+import hashlib
+import email.utils
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 import tracemalloc
 
@@ -19,6 +25,8 @@ import tornado
 import tornado.web
 import tornado.httpserver
 import tornado.ioloop
+import tornado.locks
+import tornado.util
 import tornado.websocket
 from tornado.log import enable_pretty_logging
 
@@ -27,11 +35,36 @@ import os
 
 dev = os.environ.get("WFSDEV", False)
 if dev:
-    from header import update_header
+    from header import update_header, TelemetryCache
+    from badpix import BadPixelMasks, readout_geometry
+    from preview import PREVIEW_FORMATS, check_preview_args, make_preview
+    from writer import FITSWriter
+    from frames import FrameBuffer
+    from ingest import read_blob
+    from memory import MemoryMonitor, start_tracing
+    from metrics import CONTENT_TYPE, MetricsRegistry
+    from quality import add_header_cards, frame_stats
+    from autoexposure import METRICS as AUTOEXPOSURE_METRICS, AutoExposure
+    from stack import Stack
+    from calibration import KINDS as CALIBRATION_KINDS, CalibrationLibrary
+    from calibration import frame_geometry, frame_kind
 else:
-    from .header import update_header
-
-tracemalloc.start(25)
+    from .header import update_header, TelemetryCache
+    from .badpix import BadPixelMasks, readout_geometry
+    from .preview import PREVIEW_FORMATS, check_preview_args, make_preview
+    from .writer import FITSWriter
+    from .frames import FrameBuffer
+    from .ingest import read_blob
+    from .memory import MemoryMonitor, start_tracing
+    from .metrics import CONTENT_TYPE, MetricsRegistry
+    from .quality import add_header_cards, frame_stats
+    from .autoexposure import METRICS as AUTOEXPOSURE_METRICS, AutoExposure
+    from .stack import Stack
+    from .calibration import KINDS as CALIBRATION_KINDS, CalibrationLibrary
+    from .calibration import frame_geometry, frame_kind
+
+# tracemalloc is expensive so it's only started if CAMSRV_TRACEMALLOC is set
+start_tracing()
 
 enable_pretty_logging()
 
@@ -44,6 +77,13 @@ SIMSRVPORT = 8788
 
 __all__ = ["CAMsrv", "main"]
 
+# latest image serialized to FITS along with what's needed to serve conditional GETs
+LatestFITS = namedtuple("LatestFITS", ["hdu", "data", "etag", "modified"])
+
+# result of processing an exposure: where it was saved and what the auto-exposure made of it,
+# which is None unless it was a light frame that could be measured
+ProcessedImage = namedtuple("ProcessedImage", ["filename", "autoexposure"])
+
 
 class CAMsrv(tornado.web.Application):
     class HomeHandler(tornado.web.RequestHandler):
@@ -68,19 +108,21 @@ class CAMsrv(tornado.web.Application):
                 }
             else:
                 try:
-                    args = {
-                        "filter": self.application.camera.filter,
-                        "filters": self.application.camera.filters,
-                        "frame_types": self.application.camera.frame_types,
-                        "cooling": self.application.camera.cooler,
-                        "temperature": self.application.camera.temperature,
-                        "cooling_power": self.application.camera.cooling_power,
-                        "requested_temp": self.application.requested_temp,
-                        "binning": self.application.camera.binning,
-                        "frame": self.application.camera.frame,
-                        "ccdinfo": self.application.camera.ccd_info,
-                        "status": True,
-                    }
+                    cam = self.application.camera
+                    with self.application.camera_time.time(op="config"):
+                        args = {
+                            "filter": cam.filter,
+                            "filters": cam.filters,
+                            "frame_types": cam.frame_types,
+                            "cooling": cam.cooler,
+                            "temperature": cam.temperature,
+                            "cooling_power": cam.cooling_power,
+                            "requested_temp": self.application.requested_temp,
+                            "binning": cam.binning,
+                            "frame": cam.frame,
+                            "ccdinfo": cam.ccd_info,
+                            "status": True,
+                        }
                 except Exception as e:
                     log.error("Can't load configuration from camera: %s" % e)
 
@@ -93,7 +135,10 @@ class CAMsrv(tornado.web.Application):
 
     class ExposureHandler(tornado.web.RequestHandler):
         """
-        Takes an exposure
+        Start an exposure and return its ID without waiting for it to complete. If exptime is
+        auto, exposures are repeated with the exposure time picked by the auto-exposure until
+        the signal is on target. Requests made while another exposure or a sequence is in
+        progress get a 409 with its record rather than being queued behind it.
         """
 
         def get(self):
@@ -104,48 +149,507 @@ class CAMsrv(tornado.web.Application):
                 "exptime", default=self.application.default_exptime
             )
 
-            if cam is not None:
-                if filt is not None and filt in cam.filters:
-                    cam.filter = filt
-
-                if exptype not in cam.frame_types:
-                    exptype = "Light"
-
-                hdulist = cam.expose(exptime=float(exptime), exptype=exptype)
-                if hdulist is not None:
-                    hdulist = update_header(hdulist)
-                    if self.application.bad_pixel_mask is not None:
-                        im = hdulist[0].data
-                        if im.shape != self.application.bad_pixel_mask.shape:
-                            log.warning(
-                                "Wrong readout configuration for making bad pixel corrections..."
-                            )
-                        else:
-                            blurred = median_filter(im, size=5)
-                            im[self.application.bad_pixel_mask] = blurred[
-                                self.application.bad_pixel_mask
-                            ]
-                    self.application.latest_image = hdulist[0]
-                    self.application.save_latest()
-                else:
-                    log.error("Exposure failed.")
-            else:
+            if cam is None:
                 log.warning("Camera not connected.")
+                self.set_status(503)
+                self.finish(json.dumps({"id": None, "state": "failed"}))
+                return
 
-            self.finish()
+            auto = exptime == "auto"
+            try:
+                exptime = None if auto else float(exptime)
+            except ValueError as e:
+                self.set_status(400)
+                self.finish(str(e))
+                return
+
+            busy = self.application.exposure_in_progress()
+            if busy is None and self.application.sequence is not None:
+                if self.application.sequence["finished"] is None:
+                    busy = self.application.sequence
+            if busy is not None:
+                self.set_status(409)
+                self.finish(json.dumps(busy))
+                return
+
+            expid = self.application.start_exposure(
+                exptime=exptime,
+                exptype=exptype,
+                filt=filt,
+                auto=auto,
+            )
+            self.finish(json.dumps(self.application.exposures[expid]))
+
+    class AutoExposureHandler(tornado.web.RequestHandler):
+        """
+        Report the auto-exposure settings, last measurement, and the exposure time it suggests
+        for the next frame. The target, metric, tolerance, and max_iterations can be changed by
+        passing them as arguments.
+        """
+
+        def get(self):
+            autoexposure = self.application.autoexposure
+            try:
+                for arg, convert in [
+                    ("target", float),
+                    ("tolerance", float),
+                    ("max_iterations", int),
+                ]:
+                    value = self.get_argument(arg, default=None)
+                    if value is not None:
+                        setattr(autoexposure, arg, convert(value))
+                metric = self.get_argument("metric", default=None)
+                if metric is not None:
+                    if metric not in AUTOEXPOSURE_METRICS:
+                        raise ValueError(f"Unknown metric {metric}")
+                    autoexposure.metric = metric
+            except ValueError as e:
+                self.set_status(400)
+                self.finish(str(e))
+                return
+
+            state = autoexposure.state()
+            state["next_exptime"] = autoexposure.suggest(
+                self.application.default_exptime
+            )
+            self.finish(json.dumps(state))
+
+    class ExposureStatusHandler(tornado.web.RequestHandler):
+        """
+        Report the state of an exposure. If wait is given, block for up to that many
+        seconds for the exposure to finish before replying.
+        """
+
+        async def get(self):
+            expid = self.get_argument("id", default=None)
+            try:
+                wait = float(self.get_argument("wait", default=0))
+                if expid is not None:
+                    expid = int(expid)
+            except ValueError as e:
+                self.set_status(400)
+                self.finish(str(e))
+                return
+
+            if expid is None:
+                if len(self.application.exposures) == 0:
+                    self.finish(json.dumps({"id": None, "state": "none"}))
+                    return
+                expid = next(reversed(self.application.exposures))
+
+            if expid not in self.application.exposures:
+                self.set_status(404)
+                self.finish(json.dumps({"id": expid, "state": "unknown"}))
+                return
+
+            event = self.application.exposure_events.get(expid)
+            if wait > 0 and event is not None:
+                try:
+                    await event.wait(timeout=datetime.timedelta(seconds=wait))
+                except tornado.util.TimeoutError:
+                    pass
+
+            self.finish(json.dumps(self.application.exposures[expid]))
+
+    class SequenceHandler(tornado.web.RequestHandler):
+        """
+        Start a sequence of nframes exposures, or keep exposing until stopped if nframes is 0,
+        and return its state without waiting for it to complete
+        """
+
+        def get(self):
+            app = self.application
+            if app.camera is None:
+                log.warning("Camera not connected.")
+                self.set_status(503)
+                self.finish(json.dumps({"id": None, "state": "failed"}))
+                return
+
+            try:
+                nframes = int(self.get_argument("nframes", default=0))
+                exptime = float(
+                    self.get_argument("exptime", default=app.default_exptime)
+                )
+            except ValueError as e:
+                self.set_status(400)
+                self.finish(str(e))
+                return
+
+            # a sequence can't start while another one or a single exposure is using the camera
+            busy = app.exposure_in_progress()
+            if app.sequence is not None and app.sequence["finished"] is None:
+                busy = app.sequence
+            if busy is not None:
+                self.set_status(409)
+                self.finish(json.dumps(busy))
+                return
+
+            app.start_sequence(
+                nframes=nframes,
+                exptime=exptime,
+                exptype=self.get_argument("exptype", default="Light"),
+                filt=self.get_argument("filt", default=None),
+            )
+            self.finish(json.dumps(app.sequence))
+
+    class SequenceStopHandler(tornado.web.RequestHandler):
+        """
+        Stop the running sequence once the exposure in progress has been read out and processed
+        """
+
+        def get(self):
+            app = self.application
+            app.stop_sequence()
+            self.finish(json.dumps(app.sequence or {"id": None, "state": "none"}))
+
+    class SequenceStatusHandler(tornado.web.RequestHandler):
+        """
+        Report the state of the latest sequence. If wait is given, block for up to that many
+        seconds for it to finish before replying.
+        """
+
+        async def get(self):
+            app = self.application
+            wait = float(self.get_argument("wait", default=0))
+            if app.sequence is None:
+                self.finish(json.dumps({"id": None, "state": "none"}))
+                return
+
+            if wait > 0:
+                try:
+                    await app.sequence_event.wait(
+                        timeout=datetime.timedelta(seconds=wait)
+                    )
+                except tornado.util.TimeoutError:
+                    pass
+
+            self.finish(json.dumps(app.sequence))
 
     class LatestHandler(tornado.web.RequestHandler):
         """
-        Serve up the latest image
+        Serve up the latest image. The FITS bytes are serialized once per image and
+        clients that already have it get a 304.
+        """
+
+        def compute_etag(self):
+            latest = self.application.latest_fits
+            return None if latest is None else latest.etag
+
+        def get(self):
+            latest = self.application.latest_fits
+            if latest is not None:
+                self.set_header("Cache-Control", "no-cache")
+                self.set_header("Last-Modified", latest.modified)
+
+                # tornado checks If-None-Match against compute_etag() in finish()
+                since = self.request.headers.get("If-Modified-Since")
+                if "If-None-Match" not in self.request.headers and since is not None:
+                    try:
+                        since = email.utils.parsedate_to_datetime(since)
+                        if since.tzinfo is None:
+                            since = since.replace(tzinfo=datetime.timezone.utc)
+                        unmodified = since >= latest.modified.replace(microsecond=0)
+                    except (TypeError, ValueError):
+                        # invalid dates are ignored, as RFC 7232 requires
+                        unmodified = False
+                    if unmodified:
+                        self.set_status(304)
+                        self.finish()
+                        return
+
+                self.write(latest.data)
+            self.finish()
+
+    class PreviewHandler(tornado.web.RequestHandler):
+        """
+        Serve a binned and stretched PNG (or WebP) preview of the latest image. Previews are
+        cached until the next image arrives.
+        """
+
+        async def get(self):
+            fmt = self.get_argument("format", default="png")
+            try:
+                size, stretch = check_preview_args(
+                    self.get_argument("size", default=512),
+                    self.get_argument("stretch", default="zscale"),
+                    fmt,
+                )
+            except ValueError as e:
+                self.set_status(400)
+                self.finish(f"Bad preview arguments: {e}")
+                return
+
+            preview = await self.application.ioloop.run_in_executor(
+                None, self.application.get_preview, size, stretch, fmt
+            )
+            if preview is None:
+                self.set_status(404)
+                self.finish()
+                return
+
+            self.set_header("Content-Type", PREVIEW_FORMATS[fmt])
+            self.set_header("Cache-Control", "no-cache")
+            self.write(preview)
+            self.finish()
+
+    class LatestStatsHandler(tornado.web.RequestHandler):
+        """
+        Send JSON of the quality statistics of the latest image
         """
 
         def get(self):
-            if self.application.latest_image is not None:
-                # use io.BytesIO to convert the FITS data structure into a byte stream
-                binout = io.BytesIO()
-                self.application.latest_image.writeto(binout)
-                self.write(binout.getvalue())
-                binout.close()
+            stats = self.application.latest_stats
+            if stats is None:
+                self.set_status(404)
+                self.finish()
+                return
+            filename = getattr(self.application, "last_filename", None)
+            self.write(
+                dict(stats, filename=None if filename is None else str(filename))
+            )
+            self.finish()
+
+    class FramesHandler(tornado.web.RequestHandler):
+        """
+        Send JSON list of the frames held in memory, oldest first
+        """
+
+        def get(self):
+            frames = self.application.frames
+            info = {
+                "nframes": len(frames),
+                "nbytes": frames.nbytes,
+                "maxframes": frames.maxframes,
+                "maxbytes": frames.maxbytes,
+                "frames": frames.summary(self.application.summary_keys),
+            }
+            self.write(json.dumps(info, default=str))
+            self.finish()
+
+    class FrameHandler(tornado.web.RequestHandler):
+        """
+        Serve a recent frame from memory as FITS or as a preview. The frame is chosen by id, by
+        back (0 is the latest, 1 the one before), by filename, or by time (the newest frame taken
+        at or before the given Unix time or ISO date).
+        """
+
+        def find_frame(self):
+            frames = self.application.frames
+            frame_id = self.get_argument("id", default=None)
+            back = self.get_argument("back", default=None)
+            filename = self.get_argument("filename", default=None)
+            timestamp = self.get_argument("time", default=None)
+
+            if frame_id is not None:
+                return frames.get(int(frame_id))
+            if filename is not None:
+                return frames.by_filename(filename)
+            if timestamp is not None:
+                try:
+                    timestamp = float(timestamp)
+                except ValueError:
+                    timestamp = datetime.datetime.fromisoformat(timestamp).timestamp()
+                return frames.at_time(timestamp)
+            return frames.back(int(back or 0))
+
+        async def get(self):
+            fmt = self.get_argument("format", default="fits")
+            try:
+                size, stretch = check_preview_args(
+                    self.get_argument("size", default=512),
+                    self.get_argument("stretch", default="zscale"),
+                    None if fmt == "fits" else fmt,
+                )
+            except ValueError as e:
+                self.set_status(400)
+                self.finish(f"Bad frame arguments: {e}")
+                return
+
+            try:
+                frame = self.find_frame()
+            except ValueError as e:
+                self.set_status(400)
+                self.finish(f"Bad frame selection: {e}")
+                return
+
+            if frame is None:
+                self.set_status(404)
+                self.finish()
+                return
+
+            if fmt == "fits":
+                data = await self.application.ioloop.run_in_executor(
+                    None, self.application.frame_fits, frame
+                )
+                self.set_header("Content-Type", "application/fits")
+                if frame.filename is not None:
+                    self.set_header(
+                        "Content-Disposition", f'inline; filename="{frame.filename}"'
+                    )
+            else:
+                data = await self.application.ioloop.run_in_executor(
+                    None, self.application.frame_preview, frame, size, stretch, fmt
+                )
+                self.set_header("Content-Type", PREVIEW_FORMATS[fmt])
+            self.set_header("X-Frame-Id", str(frame.id))
+            self.write(data)
+            self.finish()
+
+    class StackHandler(tornado.web.RequestHandler):
+        """
+        Serve the current stack as FITS or as a preview
+        """
+
+        async def get(self):
+            fmt = self.get_argument("format", default="fits")
+            try:
+                size, stretch = check_preview_args(
+                    self.get_argument("size", default=512),
+                    self.get_argument("stretch", default="zscale"),
+                    None if fmt == "fits" else fmt,
+                )
+            except ValueError as e:
+                self.set_status(400)
+                self.finish(f"Bad stack arguments: {e}")
+                return
+
+            data = await self.application.ioloop.run_in_executor(
+                None, self.application.stack_product, fmt, size, stretch
+            )
+            if data is None:
+                self.set_status(404)
+                self.finish()
+                return
+
+            if fmt == "fits":
+                self.set_header("Content-Type", "application/fits")
+            else:
+                self.set_header("Content-Type", PREVIEW_FORMATS[fmt])
+            self.set_header("Cache-Control", "no-cache")
+            self.set_header("X-Stack-Frames", str(len(self.application.stack)))
+            self.write(data)
+            self.finish()
+
+    class StackInfoHandler(tornado.web.RequestHandler):
+        """
+        Send JSON of the stack settings and the frames that are in it
+        """
+
+        def get(self):
+            state = self.application.stack.state()
+            state["enabled"] = self.application.stacking
+            self.write(json.dumps(state, default=str))
+            self.finish()
+
+    class StackStartHandler(tornado.web.RequestHandler):
+        """
+        Start a new stack that every following frame is added to. The mode (sum, mean, or median)
+        and depth, the number of frames to combine, default to those of the current stack.
+        """
+
+        def get(self):
+            app = self.application
+            try:
+                mode = self.get_argument("mode", default=app.stack.mode)
+                depth = int(self.get_argument("depth", default=app.stack.depth))
+                app.stack = Stack(mode=mode, depth=depth, maxbytes=app.stack.maxbytes)
+            except ValueError as e:
+                self.set_status(400)
+                self.finish(str(e))
+                return
+            app.stacking = True
+            state = app.stack.state()
+            state["enabled"] = app.stacking
+            self.write(json.dumps(state, default=str))
+            self.finish()
+
+    class StackStopHandler(tornado.web.RequestHandler):
+        """
+        Stop adding frames to the stack. The stack is kept until the next one is started.
+        """
+
+        def get(self):
+            app = self.application
+            app.stacking = False
+            state = app.stack.state()
+            state["enabled"] = app.stacking
+            self.write(json.dumps(state, default=str))
+            self.finish()
+
+    class CalibrationHandler(tornado.web.RequestHandler):
+        """
+        Send JSON list of the master biases and darks in the calibration library. Subtracting them
+        from incoming images can be turned on or off with enabled=1 or enabled=0.
+        """
+
+        def get(self):
+            app = self.application
+            enabled = self.get_argument("enabled", default=None)
+            if enabled is not None:
+                app.calibrate = enabled.lower() in ("1", "true", "on", "yes")
+            calibration = app.calibration
+            info = {
+                "enabled": app.calibrate,
+                "directory": calibration.directory,
+                "nbytes": calibration.nbytes,
+                "masters": calibration.summary(),
+            }
+            self.write(json.dumps(info, default=str))
+            self.finish()
+
+    class CalibrationBuildHandler(tornado.web.RequestHandler):
+        """
+        Combine the newest nframes buffered frames of the given kind (bias or dark) into a master
+        and add it to the calibration library
+        """
+
+        async def get(self):
+            app = self.application
+            kind = self.get_argument("kind", default="dark")
+            try:
+                nframes = int(self.get_argument("nframes", default=5))
+                if kind not in CALIBRATION_KINDS or nframes < 1:
+                    raise ValueError(f"Unsupported master {kind} of {nframes} frames")
+            except ValueError as e:
+                self.set_status(400)
+                self.finish(str(e))
+                return
+
+            try:
+                master = await app.ioloop.run_in_executor(
+                    app.process_executor, app.build_master, kind, nframes
+                )
+            except Exception as e:
+                log.error(f"Unable to build master {kind}: {e}")
+                self.set_status(500)
+                self.finish(str(e))
+                return
+
+            if master is None:
+                self.set_status(404)
+                self.finish(f"No {kind} frames in memory")
+                return
+            info = dict(master._asdict(), geometry=list(master.geometry))
+            self.write(json.dumps(info, default=str))
+            self.finish()
+
+    class MetricsHandler(tornado.web.RequestHandler):
+        """
+        Export pipeline stage timings, request latencies, and queue depths in the Prometheus text format
+        """
+
+        def get(self):
+            self.set_header("Content-Type", CONTENT_TYPE)
+            self.write(self.application.metrics.render())
+            self.finish()
+
+    class WriterStatsHandler(tornado.web.RequestHandler):
+        """
+        Send JSON dict of FITS write queue depth and latency statistics
+        """
+
+        def get(self):
+            self.write(json.dumps(self.application.writer.stats()))
             self.finish()
 
     class ResetHandler(tornado.web.RequestHandler):
@@ -162,7 +666,8 @@ class CAMsrv(tornado.web.Application):
             else:
                 try:
                     log.info("Disconnecting camera...")
-                    cam.disconnect()
+                    with self.application.camera_time.time(op="disconnect"):
+                        cam.disconnect()
                 except Exception as e:
                     log.error("Error resetting camera connection: %s" % e)
                     cam = None
@@ -178,17 +683,18 @@ class CAMsrv(tornado.web.Application):
         def get(self):
             cam = self.application.camera
             if cam is not None:
-                if cam.cooler == "Off":
-                    log.info("Cooling off, turning on...")
-                    cam.cooling_on()
-                    log.info(
-                        "Setting set-point temperature to %f"
-                        % self.application.requested_temp
-                    )
-                    cam.temperature = self.application.requested_temp
-                else:
-                    log.info("Cooling on, turning off...")
-                    cam.cooling_off()
+                with self.application.camera_time.time(op="cooling"):
+                    if cam.cooler == "Off":
+                        log.info("Cooling off, turning on...")
+                        cam.cooling_on()
+                        log.info(
+                            "Setting set-point temperature to %f"
+                            % self.application.requested_temp
+                        )
+                        cam.temperature = self.application.requested_temp
+                    else:
+                        log.info("Cooling on, turning off...")
+                        cam.cooling_off()
             self.finish()
 
     class DisconnectHandler(tornado.web.RequestHandler):
@@ -197,7 +703,8 @@ class CAMsrv(tornado.web.Application):
         """
 
         def get(self):
-            self.application.camera.quit()
+            with self.application.camera_time.time(op="disconnect"):
+                self.application.camera.quit()
             self.application.camera = None
             log.info("Disconnected camera from INDI server.")
             self.finish()
@@ -214,7 +721,8 @@ class CAMsrv(tornado.web.Application):
                 t = float(temp)
                 log.info("Setting set-point temperature to %f" % t)
                 self.application.requested_temp = t
-                cam.temperature = t
+                with self.application.camera_time.time(op="temperature"):
+                    cam.temperature = t
             else:
                 log.warning("Unable to set camera temperature to %s" % temp)
             self.finish()
@@ -227,8 +735,9 @@ class CAMsrv(tornado.web.Application):
         def get(self):
             cam = self.application.camera
             if cam is not None:
-                curr_frame = cam.frame
-                curr_bin = cam.binning
+                with self.application.camera_time.time(op="config"):
+                    curr_frame = cam.frame
+                    curr_bin = cam.binning
                 framedict = {
                     "X": int(self.get_argument("frame_x", curr_frame["X"])),
                     "Y": int(self.get_argument("frame_y", curr_frame["Y"])),
@@ -239,58 +748,57 @@ class CAMsrv(tornado.web.Application):
                     "X": int(self.get_argument("x_bin", curr_bin["X"])),
                     "Y": int(self.get_argument("y_bin", curr_bin["Y"])),
                 }
-                cam.binning = bindict
-                cam.frame = framedict
+                with self.application.camera_time.time(op="config"):
+                    cam.binning = bindict
+                    cam.frame = framedict
             self.finish()
 
     class StatusHandler(tornado.web.RequestHandler):
         """
-        Send JSON dict of status information
+        Send JSON dict of status information. This is served from the status sampler's latest
+        snapshot unless it is older than the max_age argument, in seconds.
         """
 
-        def get(self):
-            cam = self.application.camera
-            status = {
-                "cooling": "Off",
-                "cooling_power": "N/A",
-                "temperature": "N/A",
-                "requested_temp": self.application.requested_temp,
-                "status": False,
-            }
+        async def get(self):
+            app = self.application
+            max_age = self.get_argument("max_age", default=None)
+            try:
+                max_age = None if max_age is None else float(max_age)
+            except ValueError as e:
+                self.set_status(400)
+                self.finish(str(e))
+                return
+            app.start_status_sampler()
+
+            status = app.last_status
+            age = app.status_age
+            if status is None or (max_age is not None and age > max_age):
+                status = await app.poll_status()
+
+            if status is None:
+                # the camera has never been read successfully
+                self.set_status(503)
+                self.finish(json.dumps({"error": "Camera status is not available"}))
+                return
+
+            self.write(json.dumps(dict(status, timestamp=app.status_time)))
+            self.finish()
 
-            if cam is None:
-                return status
+    class EventsHandler(tornado.websocket.WebSocketHandler):
+        """
+        Push status changes and new image notifications to connected clients. One poller on the
+        server feeds all of them so the camera is queried the same amount no matter how many
+        clients are watching.
+        """
 
-            # make sure we can connect to camera and bail early if we can't
-            if cam is not None:
-                try:
-                    cam.connected
-                except Exception as e:
-                    log.error("Error checking camera connection: %s" % e)
-                    cam = None
-                    self.write(json.dumps(status))
-                    return
+        def open(self):
+            self.application.add_event_client(self)
 
-            # we can check the connection and if we're connected, then query camera and fill in the status
-            if cam.connected:
-                # don't always get the cooling power
-                try:
-                    cooling_power = "%.1f" % cam.cooling_power
-                except Exception:
-                    log.warning("Camera cooling power not available.")
-                    cooling_power = "N/A"
+        def on_close(self):
+            self.application.remove_event_client(self)
 
-                status = {
-                    "cooling": cam.cooler,
-                    "cooling_power": cooling_power,
-                    "temperature": "%.1f" % cam.temperature,
-                    "requested_temp": self.application.requested_temp,
-                    "binning": cam.binning,
-                    "frame": cam.frame,
-                    "status": True,
-                }
-            self.write(json.dumps(status))
-            self.finish()
+        def on_message(self, message):
+            pass
 
     class MallocHandler(tornado.web.RequestHandler):
         """
@@ -298,6 +806,12 @@ class CAMsrv(tornado.web.Application):
         """
 
         def get(self):
+            if not tracemalloc.is_tracing():
+                self.set_status(409)
+                self.finish(
+                    "tracemalloc is not tracing, set CAMSRV_TRACEMALLOC to enable it"
+                )
+                return
             nlines = int(self.get_argument("lines", default=10))
             snapshot = tracemalloc.take_snapshot()
             stats = snapshot.statistics("lineno")
@@ -313,6 +827,12 @@ class CAMsrv(tornado.web.Application):
         """
 
         def get(self):
+            if not tracemalloc.is_tracing():
+                self.set_status(409)
+                self.finish(
+                    "tracemalloc is not tracing, set CAMSRV_TRACEMALLOC to enable it"
+                )
+                return
             snaptype = self.get_argument("snaptype", default="lineno")
             n = int(self.get_argument("n", default=0))
             snapshot = tracemalloc.take_snapshot()
@@ -324,12 +844,314 @@ class CAMsrv(tornado.web.Application):
                 log.error(err)
                 self.write(err)
                 self.finish()
+                return
             top_stats = f"Top memory usage of {hog_stats.count} blocks: {hog_stats.size/1024} KiB\n"
             for ll in hog_stats.traceback.format():
                 top_stats += f"\t{ll}\n"
             self.write(top_stats)
             self.finish()
 
+    class MemoryHandler(tornado.web.RequestHandler):
+        """
+        Send JSON dict of memory samples, soft limit hits, and tracemalloc snapshots. If sample is
+        given, a new sample is taken first.
+        """
+
+        async def get(self):
+            app = self.application
+            if self.get_argument("sample", default=None) is not None:
+                await app.sample_memory()
+            self.write(json.dumps(app.memory.stats()))
+            self.finish()
+
+    class MemorySnapshotHandler(tornado.web.RequestHandler):
+        """
+        Take a tracemalloc snapshot and send its ID for comparing against later with /memory/diff
+        """
+
+        async def get(self):
+            app = self.application
+            try:
+                snapid = await app.ioloop.run_in_executor(
+                    None, app.memory.take_snapshot
+                )
+            except RuntimeError as e:
+                self.set_status(409)
+                self.finish(str(e))
+                return
+            self.write(json.dumps({"id": snapid}))
+            self.finish()
+
+    class MemoryDiffHandler(tornado.web.RequestHandler):
+        """
+        Show the top differences in memory allocations between snapshots old and new. If new isn't
+        given, a new snapshot is taken and compared to old.
+        """
+
+        async def get(self):
+            app = self.application
+            old = int(self.get_argument("old"))
+            new = self.get_argument("new", default=None)
+            new = None if new is None else int(new)
+            key_type = self.get_argument("key", default="lineno")
+            nlines = int(self.get_argument("lines", default=10))
+            try:
+                diff = await app.ioloop.run_in_executor(
+                    None, app.memory.compare, old, new, key_type, nlines
+                )
+            except RuntimeError as e:
+                self.set_status(409)
+                self.finish(str(e))
+                return
+            except KeyError as e:
+                self.set_status(404)
+                self.finish(str(e))
+                return
+            self.set_header("Content-Type", "text/plain")
+            self.write(diff)
+            self.finish()
+
+    def log_request(self, handler):
+        """
+        Log each request and record its latency by handler
+        """
+        super(CAMsrv, self).log_request(handler)
+        self.request_time.observe(
+            handler.request.request_time(),
+            handler=type(handler).__name__,
+            method=handler.request.method,
+            code=handler.get_status(),
+        )
+
+    def setup_metrics(self):
+        """
+        Create the metrics exported by /metrics
+        """
+        self.metrics = MetricsRegistry()
+        self.stage_time = self.metrics.histogram(
+            "stage_seconds",
+            "Time spent in each stage of taking and processing an image",
+        )
+        self.camera_time = self.metrics.histogram(
+            "camera_seconds", "Round trip time of camera commands"
+        )
+        self.request_time = self.metrics.histogram(
+            "request_seconds", "HTTP request latency by handler"
+        )
+        self.images = self.metrics.counter("images_total", "Images processed by source")
+        self.exposures_done = self.metrics.counter(
+            "exposures_total", "Exposures finished by final state"
+        )
+        self.sequences_done = self.metrics.counter(
+            "sequences_total", "Exposure sequences finished by final state"
+        )
+        self.metrics.gauge(
+            "exposures_active",
+            "Exposures queued or in progress by state",
+            func=lambda: {
+                (("state", state),): sum(
+                    1 for r in list(self.exposures.values()) if r["state"] == state
+                )
+                for state in ("queued", "exposing", "processing")
+            },
+        )
+        self.metrics.gauge(
+            "writer_backlog",
+            "FITS files waiting to be written",
+            func=lambda: self.writer.backlog,
+        )
+        self.metrics.counter(
+            "writer_rejected_total",
+            "FITS files that weren't written because the queue was full",
+            func=lambda: self.writer.nrejected,
+        )
+        self.metrics.counter(
+            "writer_failed_total",
+            "FITS files that failed to write",
+            func=lambda: self.writer.nfailed,
+        )
+        self.metrics.gauge(
+            "event_clients",
+            "Connected websocket clients",
+            func=lambda: len(self.event_clients),
+        )
+        self.metrics.gauge(
+            "frame_buffer_frames",
+            "Frames held in memory",
+            func=lambda: len(self.frames),
+        )
+        self.metrics.gauge(
+            "frame_buffer_bytes",
+            "Bytes of frames held in memory",
+            func=lambda: self.frames.nbytes,
+        )
+        self.metrics.gauge(
+            "telemetry_age_seconds",
+            "Age of the oldest cached telemetry value in each group",
+            func=self.telemetry_ages,
+        )
+
+    def telemetry_ages(self):
+        ages = self.telemetry.ages()
+        oldest = {}
+        for group, keys in self.telemetry.groups.items():
+            group_ages = [ages[k] for k in keys if ages[k] is not None]
+            if group_ages:
+                oldest[(("group", group),)] = max(group_ages)
+        return oldest
+
+    def read_status(self):
+        """
+        Query the camera and return a dict of status information
+        """
+        with self.camera_time.time(op="status"):
+            return self._read_status()
+
+    def _read_status(self):
+        cam = self.camera
+        status = {
+            "cooling": "Off",
+            "cooling_power": "N/A",
+            "temperature": "N/A",
+            "requested_temp": self.requested_temp,
+            "status": False,
+        }
+
+        if cam is None:
+            return status
+
+        # make sure we can connect to camera and bail early if we can't
+        try:
+            connected = cam.connected
+        except Exception as e:
+            log.error("Error checking camera connection: %s" % e)
+            return status
+
+        # we can check the connection and if we're connected, then query camera and fill in the status
+        if connected:
+            # don't always get the cooling power
+            try:
+                cooling_power = "%.1f" % cam.cooling_power
+            except Exception:
+                log.warning("Camera cooling power not available.")
+                cooling_power = "N/A"
+
+            status = {
+                "cooling": cam.cooler,
+                "cooling_power": cooling_power,
+                "temperature": "%.1f" % cam.temperature,
+                "requested_temp": self.requested_temp,
+                "binning": cam.binning,
+                "frame": cam.frame,
+                "status": True,
+            }
+        return status
+
+    def add_event_client(self, client):
+        """
+        Register a websocket client and make sure the status sampler is running
+        """
+        self.event_clients.add(client)
+        if self.last_status is not None:
+            client.write_message(
+                json.dumps({"type": "status", "data": self.last_status})
+            )
+        self.start_status_sampler()
+
+    def remove_event_client(self, client):
+        """
+        Unregister a websocket client. The sampler stops itself once nobody is using it.
+        """
+        self.event_clients.discard(client)
+
+    def start_status_sampler(self):
+        """
+        Note that someone wants camera status and start sampling it if we aren't already
+        """
+        self._status_requested = time.time()
+        if not self.status_poller.is_running():
+            self.status_poller.start()
+            self.ioloop.spawn_callback(self.poll_status)
+
+    @property
+    def status_age(self):
+        """
+        Seconds since the camera status was last read
+        """
+        if self.status_time is None:
+            return None
+        return time.time() - self.status_time
+
+    def broadcast(self, event_type, data):
+        """
+        Send an event to all websocket clients. This can be called from any thread.
+        """
+        message = json.dumps({"type": event_type, "data": data}, default=str)
+        self.ioloop.add_callback(self._broadcast, message)
+
+    def _broadcast(self, message):
+        for client in list(self.event_clients):
+            try:
+                client.write_message(message)
+            except tornado.websocket.WebSocketClosedError:
+                self.event_clients.discard(client)
+
+    async def sample_status(self):
+        """
+        Periodic callback that samples the camera status until there have been neither websocket
+        clients nor /status requests for status_idle_timeout seconds
+        """
+        idle = time.time() - self._status_requested > self.status_idle_timeout
+        if len(self.event_clients) == 0 and idle:
+            self.status_poller.stop()
+            return
+        await self.poll_status()
+
+    async def poll_status(self):
+        """
+        Read the camera status off of the IOLoop, broadcast it if it has changed, and return it.
+        Callers that arrive while a read is in progress share its result.
+        """
+        if self._status_future is not None:
+            try:
+                return await self._status_future
+            except Exception:
+                return self.last_status
+
+        self._status_future = self.ioloop.run_in_executor(None, self.read_status)
+        try:
+            status = await self._status_future
+        except Exception as e:
+            log.error(f"Error polling camera status: {e}")
+            return self.last_status
+        finally:
+            self._status_future = None
+
+        self.status_time = time.time()
+        if status != self.last_status:
+            self.last_status = status
+            self._broadcast(json.dumps({"type": "status", "data": status}))
+        return status
+
+    def notify_new_image(self):
+        """
+        Tell websocket clients about the new latest image
+        """
+        if self.latest_image is None:
+            return
+        hdr = self.latest_image.header
+        summary = {k: hdr[k] for k in self.summary_keys if k in hdr}
+        filename = getattr(self, "last_filename", None)
+        self.broadcast(
+            "image",
+            {
+                "filename": None if filename is None else str(filename),
+                "header": summary,
+                "url": "latest",
+                "preview": "preview",
+            },
+        )
+
     def connect_camera(self):
         # check the actual camera
         self.camera = None
@@ -339,9 +1161,639 @@ class CAMsrv(tornado.web.Application):
         except (ConnectionRefusedError, socket.gaierror):
             log.warning("Can't connect to INDI CCD Simulator...")
 
+    @property
+    def latest_image(self):
+        return self._latest_image
+
+    @latest_image.setter
+    def latest_image(self, hdu):
+        self._latest_image = hdu
+        self._latest_fits = None
+        self._latest_raw = None
+        self._latest_stats = None
+        self._previews = {}
+
+    def get_preview(self, size=512, stretch="zscale", fmt="png"):
+        """
+        Return an encoded preview of latest_image, making it only if it isn't already cached
+        """
+        hdu = self._latest_image
+        if hdu is None or hdu.data is None:
+            return None
+        previews = self._previews
+        key = (size, stretch, fmt)
+        if key not in previews:
+            with self.stage_time.time(stage="preview"):
+                previews[key] = make_preview(
+                    hdu.data, size=size, stretch=stretch, fmt=fmt
+                )
+        return previews[key]
+
+    @property
+    def latest_fits(self):
+        """
+        LatestFITS for latest_image. The image is only serialized the first time this is accessed
+        so /latest and save_latest() share the same bytes.
+        """
+        hdu = self._latest_image
+        latest = self._latest_fits
+        if hdu is None:
+            return None
+        if latest is None or latest.hdu is not hdu:
+            with self.stage_time.time(stage="serialize"):
+                raw = self._latest_raw
+                if raw is not None and raw.hdu is hdu:
+                    data = raw.tobytes()
+                else:
+                    binout = io.BytesIO()
+                    hdu.writeto(binout)
+                    data = binout.getvalue()
+            latest = LatestFITS(
+                hdu=hdu,
+                data=data,
+                etag=f'"{hashlib.sha1(data).hexdigest()}"',
+                modified=datetime.datetime.now(datetime.timezone.utc),
+            )
+            self._latest_fits = latest
+        return latest
+
+    @property
+    def latest_stats(self):
+        """
+        Quality statistics of latest_image. These are measured as images come in, but are
+        measured here if latest_image was set some other way.
+        """
+        if self._latest_stats is None and self._latest_image is not None:
+            self._latest_stats = frame_stats(
+                self._latest_image.data,
+                saturation=self.saturation,
+                spots=self.count_spots,
+            )
+        return self._latest_stats
+
     def save_latest(self):
         pass
 
+    def cached_bytes(self):
+        """
+        Bytes held by the frame buffer, the stack, calibration masters, the serialized latest
+        image, and its previews
+        """
+        nbytes = self.frames.nbytes + sum(len(p) for p in list(self._previews.values()))
+        nbytes += self.stack.nbytes + self.calibration.nbytes
+        latest = self._latest_fits
+        if latest is not None:
+            nbytes += len(latest.data)
+        return nbytes
+
+    def drop_caches(self):
+        """
+        Free cached frames and previews, keeping only the latest frame. Returns the number of bytes freed.
+        """
+        freed = self.frames.clear(keep=1)
+        previews = self._previews
+        self._previews = {}
+        freed += sum(len(p) for p in previews.values())
+        return freed
+
+    async def sample_memory(self):
+        """
+        Sample memory use off of the IOLoop, dropping caches if over the soft limit
+        """
+        try:
+            return await self.ioloop.run_in_executor(None, self.memory.sample)
+        except Exception as e:
+            log.error(f"Error sampling memory use: {e}")
+
+    def fill_header(self, hdulist):
+        """
+        Add telescope telemetry to the image header. Images are still saved if this fails.
+        """
+        with self.stage_time.time(stage="header"):
+            try:
+                hdulist = update_header(hdulist, telemetry=self.telemetry)
+            except Exception as e:
+                log.warning(f"Unable to fill in header with telescope telemetry: {e}")
+        return hdulist
+
+    def measure_quality(self, hdulist, saturated=None):
+        """
+        Measure the quality statistics of a corrected image and add them to its header. If the
+        image has been calibrated, the saturated pixels have to be counted beforehand and passed
+        in as saturated.
+        """
+        hdu = hdulist[0]
+        with self.stage_time.time(stage="stats"):
+            try:
+                stats = frame_stats(
+                    hdu.data, saturation=self.saturation, spots=self.count_spots
+                )
+            except Exception as e:
+                log.warning(f"Unable to measure image statistics: {e}")
+                return None
+        if saturated is not None:
+            stats["saturated"] = saturated
+        add_header_cards(hdu.header, stats)
+        return stats
+
+    def calibrate_frame(self, hdulist):
+        """
+        Subtract the master bias and dark that best match the image, if there are any, and note
+        which were used in its header. Returns a dict of the masters used and the number of
+        saturated pixels before calibration, which is empty if the image wasn't calibrated.
+        """
+        hdu = hdulist[0]
+        if not self.calibrate or len(self.calibration) == 0:
+            return {}
+        with self.stage_time.time(stage="calibrate"):
+            try:
+                calibrated, used = self.calibration.calibrate(
+                    hdu.data, hdu.header, saturation=self.saturation
+                )
+            except Exception as e:
+                log.warning(f"Unable to calibrate image: {e}")
+                return {}
+            if calibrated is None:
+                return {}
+        hdu.data = calibrated
+        # master filenames are too long to leave room for comments
+        if "bias" in used:
+            hdu.header["BIASFILE"] = used["bias"]
+        if "dark" in used:
+            hdu.header["DARKFILE"] = used["dark"]
+            hdu.header["DARKSCAL"] = (
+                round(used["dark_scale"], 6),
+                "Exposure time scaling of master dark",
+            )
+        return used
+
+    def build_master(self, kind, nframes=5):
+        """
+        Combine the newest nframes buffered frames of kind, e.g. taken with /sequence?exptype=Dark,
+        into a master and add it to the calibration library. Only frames with the same geometry
+        and exposure time as the newest one are used. Returns the Master or None if there are no
+        frames of kind.
+        This blocks so it should be run in self.process_executor.
+        """
+        hdus = []
+        match = None
+        for i in range(len(self.frames)):
+            frame = self.frames.back(i)
+            if frame is None:
+                break
+            header = frame.hdu.header
+            if frame_kind(header) != kind:
+                continue
+            key = (frame_geometry(frame.hdu.data.shape, header), header.get("EXPTIME"))
+            if match is None:
+                match = key
+            if key == match:
+                hdus.append(frame.hdu)
+                if len(hdus) == nframes:
+                    break
+        if not hdus:
+            return None
+        with self.stage_time.time(stage="master"):
+            master = self.calibration.build(hdus, kind=kind)
+        log.info(f"Built master {kind} {master.filename} from {len(hdus)} frames")
+        return master
+
+    def update_autoexposure(self, header, stats):
+        """
+        Give the auto-exposure the exposure time and statistics of a light frame
+        """
+        imagetyp = str(header.get("IMAGETYP", "Light")).lower()
+        exptime = header.get("EXPTIME")
+        if stats is None or exptime is None or "light" not in imagetyp:
+            return None
+        return self.autoexposure.update(float(exptime), stats)
+
+    def ingest_blob(self, blob_data):
+        """
+        Make a FITS image received as an INDI BLOB the latest image, filling in its header,
+        subtracting calibration masters, correcting bad pixels, and measuring its quality
+        statistics. The pixel data are mapped straight out of the received buffer and, if they
+        aren't calibrated or corrected, are written back out without being re-encoded.
+        """
+        with self.stage_time.time(stage="ingest"):
+            hdulist, raw = read_blob(blob_data)
+        self.fill_header(hdulist)
+        calibration = self.calibrate_frame(hdulist)
+        with self.stage_time.time(stage="correct"):
+            corrected = self.correct_bad_pixels(hdulist[0].data, hdulist[0].header)
+        stats = self.measure_quality(hdulist, saturated=calibration.get("saturated"))
+        self.update_autoexposure(hdulist[0].header, stats)
+        self.images.inc(source="blob")
+        self.latest_image = hdulist[0]
+        self._latest_stats = stats
+        if raw is not None:
+            raw.modified = bool(calibration) or corrected > 0
+            self._latest_raw = raw
+        return hdulist
+
+    def process_blob(self, blob_data):
+        """
+        Ingest a FITS image received as an INDI BLOB and save and buffer it. Returns its HDUList.
+        This blocks so it should be run in self.process_executor.
+        """
+        hdulist = self.ingest_blob(blob_data)
+        # serialize here so it's done in the processing thread rather than on the IOLoop
+        self.latest_fits
+        self.get_preview()
+        self.save_latest()
+        self.buffer_latest()
+        return hdulist
+
+    async def receive_blob(self, blob_data):
+        """
+        Coroutine that processes a received BLOB in self.process_executor, like exposures, so the
+        IOLoop is free while it's being ingested, and then tells websocket clients about it.
+        Returns the image's HDUList, or None if it couldn't be processed.
+        """
+        try:
+            hdulist = await self.ioloop.run_in_executor(
+                self.process_executor, self.process_blob, blob_data
+            )
+        except Exception as e:
+            log.error(f"Exposure Failed: {e}")
+            return None
+        self.notify_new_image()
+        return hdulist
+
+    def buffer_latest(self):
+        """
+        Add latest_image to the in-memory ring buffer of recent frames and, if stacking is on, to
+        the stack
+        """
+        if self.latest_image is None:
+            return None
+        frame = self.frames.add(
+            self.latest_image, filename=getattr(self, "last_filename", None)
+        )
+        if self.stacking:
+            self.stack_frame(frame)
+        return frame
+
+    def stack_frame(self, frame):
+        """
+        Add a buffered Frame to the stack
+        """
+        with self.stage_time.time(stage="stack"):
+            try:
+                nframes = self.stack.add(
+                    frame.hdu,
+                    {
+                        "id": frame.id,
+                        "filename": frame.filename,
+                        "timestamp": frame.timestamp,
+                    },
+                )
+            except Exception as e:
+                log.warning(f"Unable to stack frame {frame.id}: {e}")
+                return
+        if nframes is None:
+            log.info(
+                f"Not stacking frame {frame.id}, it isn't a {self.stack.imagetyp} frame"
+            )
+            return
+        self.broadcast("stack", {"nframes": nframes, "mode": self.stack.mode})
+
+    def stack_product(self, fmt="fits", size=512, stretch="zscale"):
+        """
+        Current stack serialized to FITS or as an encoded preview. These are cached until the next
+        frame is stacked.
+        """
+        hdu = self.stack.hdu()
+        if hdu is None:
+            return None
+        cache = self._stack_cache
+        if cache.get("hdu") is not hdu:
+            cache = self._stack_cache = {"hdu": hdu}
+        key = (fmt, size, stretch)
+        if key not in cache:
+            if fmt == "fits":
+                with self.stage_time.time(stage="serialize"):
+                    binout = io.BytesIO()
+                    hdu.writeto(binout)
+                    cache[key] = binout.getvalue()
+            else:
+                with self.stage_time.time(stage="preview"):
+                    cache[key] = make_preview(
+                        hdu.data, size=size, stretch=stretch, fmt=fmt
+                    )
+        return cache[key]
+
+    def frame_fits(self, frame):
+        """
+        Serialize a buffered Frame to FITS, reusing the cached bytes if it is the latest image
+        """
+        if frame.hdu is self._latest_image:
+            return self.latest_fits.data
+        binout = io.BytesIO()
+        frame.hdu.writeto(binout)
+        return binout.getvalue()
+
+    def frame_preview(self, frame, size=512, stretch="zscale", fmt="png"):
+        """
+        Make a preview of a buffered Frame, using the preview cache if it is the latest image
+        """
+        if frame.hdu is self._latest_image:
+            return self.get_preview(size, stretch, fmt)
+        return make_preview(frame.hdu.data, size=size, stretch=stretch, fmt=fmt)
+
+    def correct_bad_pixels(self, im, header=None):
+        """
+        Replace the pixels flagged in self.bad_pixel_mask, in place, with the median of their neighbors.
+        The mask is binned and windowed to match the readout configuration given by the FITS header or,
+        failing that, the camera. The camera is only asked for what the header doesn't have.
+        Returns the number of bad pixels in the derived mask, which is 0 if im wasn't touched.
+        """
+        if self.bad_pixel_mask is None:
+            return 0
+
+        # derived masks only need to be rebuilt when the full-frame mask changes
+        if (
+            self._bad_pixel_masks is None
+            or self._bad_pixel_masks.source is not self.bad_pixel_mask
+        ):
+            self._bad_pixel_masks = BadPixelMasks(self.bad_pixel_mask)
+
+        hdr = {} if header is None else header
+        frame = binning = None
+        need_frame = "XORGSUBF" not in hdr or "YORGSUBF" not in hdr
+        need_binning = "XBINNING" not in hdr or "YBINNING" not in hdr
+        if self.camera is not None and (need_frame or need_binning):
+            try:
+                with self.camera_time.time(op="config"):
+                    if need_frame:
+                        frame = self.camera.frame
+                    if need_binning:
+                        binning = self.camera.binning
+            except Exception as e:
+                log.warning(f"Unable to read readout configuration from camera: {e}")
+
+        geometry = readout_geometry(
+            im.shape,
+            self.bad_pixel_mask.shape,
+            header=header,
+            frame=frame,
+            binning=binning,
+        )
+        if geometry is None:
+            log.warning(
+                "Wrong readout configuration for making bad pixel corrections..."
+            )
+            return 0
+
+        corrector = self._bad_pixel_masks.corrector(geometry)
+        corrector.correct(im)
+        return corrector.npix
+
+    def process_image(self, hdulist):
+        """
+        Fill in the header, subtract calibration masters, correct bad pixels, measure quality
+        statistics, and save a newly read out image. Returns a ProcessedImage.
+        This blocks so it should be run in self.process_executor.
+        """
+        hdulist = self.fill_header(hdulist)
+        calibration = self.calibrate_frame(hdulist)
+        with self.stage_time.time(stage="correct"):
+            self.correct_bad_pixels(hdulist[0].data, hdulist[0].header)
+        stats = self.measure_quality(hdulist, saturated=calibration.get("saturated"))
+        autoexposure = self.update_autoexposure(hdulist[0].header, stats)
+        self.images.inc(source="exposure")
+        self.latest_image = hdulist[0]
+        self._latest_stats = stats
+        # serialize here so it's done in the processing thread rather than on the IOLoop
+        self.latest_fits
+        self.get_preview()
+        self.save_latest()
+        self.buffer_latest()
+        self.notify_new_image()
+        return ProcessedImage(getattr(self, "last_filename", None), autoexposure)
+
+    def _expose(self, exptime, exptype, filt):
+        """
+        Configure the camera and take an exposure. This blocks until the camera
+        has been read out so it should be run in self.executor.
+        """
+        cam = self.camera
+        if filt is not None and filt in cam.filters:
+            with self.camera_time.time(op="filter"):
+                cam.filter = filt
+
+        if exptype not in cam.frame_types:
+            exptype = "Light"
+
+        start = time.perf_counter()
+        with self.camera_time.time(op="expose"):
+            hdulist = cam.expose(exptime=exptime, exptype=exptype)
+        # whatever the exposure took beyond exptime went to readout and transferring the image
+        self.camera_time.observe(
+            max(0.0, time.perf_counter() - start - exptime), op="readout"
+        )
+        return hdulist
+
+    def exposure_in_progress(self):
+        """
+        Record of the exposure that is queued, exposing, or being processed, or None if there isn't one
+        """
+        for record in reversed(self.exposures.values()):
+            if record["state"] in ("queued", "exposing", "processing"):
+                return record
+        return None
+
+    def start_exposure(self, exptime, exptype="Light", filt=None, auto=False):
+        """
+        Queue up an exposure and return its ID. The exposure, header update, bad pixel
+        correction, and save all run off of the IOLoop. If auto is True, exptime is picked
+        by self.autoexposure and light frames are retaken until they are on target.
+        """
+        if auto:
+            exptime = self.autoexposure.suggest(default=self.default_exptime)
+        expid = next(self._exposure_ids)
+        self.exposures[expid] = {
+            "id": expid,
+            "state": "queued",
+            "exptime": exptime,
+            "exptype": exptype,
+            "filename": None,
+            "error": None,
+            "started": time.time(),
+            "finished": None,
+            "auto": auto,
+            "iterations": 0,
+            "converged": None,
+        }
+        self.exposure_events[expid] = tornado.locks.Event()
+
+        # only keep track of the most recent exposures
+        while len(self.exposures) > self.max_exposure_records:
+            oldid, _ = self.exposures.popitem(last=False)
+            self.exposure_events.pop(oldid, None)
+
+        tornado.ioloop.IOLoop.current().spawn_callback(
+            self.run_exposure, expid, exptime, exptype, filt
+        )
+        return expid
+
+    async def run_exposure(self, expid, exptime, exptype, filt):
+        """
+        Coroutine that chains the camera exposure and image processing through their executors
+        """
+        record = self.exposures[expid]
+        ioloop = tornado.ioloop.IOLoop.current()
+        try:
+            while True:
+                record["state"] = "exposing"
+                record["iterations"] += 1
+                with self.stage_time.time(stage="expose"):
+                    hdulist = await ioloop.run_in_executor(
+                        self.executor, self._expose, exptime, exptype, filt
+                    )
+                if hdulist is None:
+                    log.error("Exposure failed.")
+                    record["state"] = "failed"
+                    record["error"] = "Exposure failed."
+                    break
+
+                record["state"] = "processing"
+                processed = await ioloop.run_in_executor(
+                    self.process_executor, self.process_image, hdulist
+                )
+                if processed.filename is not None:
+                    record["filename"] = str(processed.filename)
+                record["state"] = "done"
+
+                # only this frame's own measurement can decide whether to retake it. frames that
+                # aren't light frames or couldn't be measured end the loop.
+                last = processed.autoexposure
+                if not record["auto"] or last is None:
+                    break
+                record["converged"] = last["converged"]
+                if (
+                    last["converged"]
+                    or record["iterations"] >= self.autoexposure.max_iterations
+                ):
+                    break
+                exptime = record["exptime"] = last["next_exptime"]
+                log.info(
+                    f"Auto-exposure retaking exposure {expid} with {exptime:.3f} s"
+                )
+        except Exception as e:
+            log.error(f"Error taking exposure {expid}: {e}")
+            record["state"] = "failed"
+            record["error"] = str(e)
+        finally:
+            record["finished"] = time.time()
+            self.exposures_done.inc(state=record["state"])
+            event = self.exposure_events.get(expid)
+            if event is not None:
+                event.set()
+
+    def start_sequence(self, nframes=0, exptime=1.0, exptype="Light", filt=None):
+        """
+        Start taking nframes exposures back to back, or keep going until stop_sequence() is called
+        if nframes is 0. Each frame is processed while the next one is exposing.
+        """
+        self.sequence = {
+            "id": next(self._sequence_ids),
+            "state": "queued",
+            "nframes": nframes,
+            "exptime": exptime,
+            "exptype": exptype,
+            "nexposed": 0,
+            "nprocessed": 0,
+            "filename": None,
+            "error": None,
+            "started": time.time(),
+            "finished": None,
+            "frames_per_hour": None,
+        }
+        self.sequence_event = tornado.locks.Event()
+        tornado.ioloop.IOLoop.current().spawn_callback(
+            self.run_sequence, self.sequence, filt
+        )
+        return self.sequence["id"]
+
+    def stop_sequence(self):
+        """
+        Don't start any more exposures in the running sequence
+        """
+        record = self.sequence
+        if record is not None and record["finished"] is None:
+            record["state"] = "stopping"
+            self.broadcast("sequence", record)
+
+    async def process_sequence_frame(self, record, hdulist):
+        """
+        Coroutine that processes a frame from a sequence and keeps track of its progress
+        """
+        processed = await tornado.ioloop.IOLoop.current().run_in_executor(
+            self.process_executor, self.process_image, hdulist
+        )
+        filename = processed.filename
+        record["nprocessed"] += 1
+        record["filename"] = None if filename is None else str(filename)
+        record["frames_per_hour"] = (
+            3600.0 * record["nprocessed"] / (time.time() - record["started"])
+        )
+        self.broadcast("sequence", record)
+
+    async def run_sequence(self, record, filt):
+        """
+        Coroutine that pipelines a sequence of exposures. The next exposure is started as soon as
+        the camera has been read out while the previous frame is processed. Only one frame is
+        processed at a time so if processing can't keep up, the camera waits for it rather than
+        frames piling up in memory.
+        """
+        ioloop = tornado.ioloop.IOLoop.current()
+        processing = None
+        if record["state"] == "queued":
+            record["state"] = "running"
+        self.broadcast("sequence", record)
+        try:
+            while record["state"] == "running" and (
+                record["nframes"] == 0 or record["nexposed"] < record["nframes"]
+            ):
+                with self.stage_time.time(stage="expose"):
+                    hdulist = await ioloop.run_in_executor(
+                        self.executor,
+                        self._expose,
+                        record["exptime"],
+                        record["exptype"],
+                        filt,
+                    )
+                if hdulist is None:
+                    raise RuntimeError("Exposure failed.")
+                record["nexposed"] += 1
+
+                if processing is not None:
+                    with self.stage_time.time(stage="pipeline_wait"):
+                        await processing
+                processing = asyncio.ensure_future(
+                    self.process_sequence_frame(record, hdulist)
+                )
+
+            if processing is not None:
+                await processing
+            record["state"] = "stopped" if record["state"] == "stopping" else "done"
+        except Exception as e:
+            log.error(f"Error taking sequence {record['id']}: {e}")
+            record["state"] = "failed"
+            record["error"] = str(e)
+            if processing is not None and not processing.done():
+                # let the frame that's being processed finish so it isn't lost
+                try:
+                    await processing
+                except Exception:
+                    pass
+        finally:
+            record["finished"] = time.time()
+            self.sequences_done.inc(state=record["state"])
+            self.broadcast("sequence", record)
+            self.sequence_event.set()
+
     def __init__(self, camhost="localhost", camport=7624, connect=True):
         parent = importlib.resources.files("camsrv") / "web_resources"
         template_path = parent / "templates"
@@ -352,6 +1804,8 @@ class CAMsrv(tornado.web.Application):
         self.camhost = camhost
         self.camport = camport
 
+        self.setup_metrics()
+
         self.parent = parent
         self.home_template = "sim.html"
 
@@ -365,6 +1819,114 @@ class CAMsrv(tornado.web.Application):
         self.default_exptime = 1.0
 
         self.bad_pixel_mask = None
+        self._bad_pixel_masks = None
+
+        # frame quality statistics. spots are only counted for WFS cameras.
+        self.saturation = 65535
+        self.count_spots = False
+
+        # exposure times for exptime=auto are scaled so the peak (or spot flux) hits the target
+        self.autoexposure = AutoExposure(
+            target=float(os.environ.get("CAMSRV_AUTOEXP_TARGET", 30000)),
+            metric=os.environ.get("CAMSRV_AUTOEXP_METRIC", "peak"),
+        )
+
+        # telescope telemetry for image headers is refreshed in the background. the redis
+        # backend is faster, but can only be used within the observatory network.
+        self.telemetry = TelemetryCache(
+            backend=os.environ.get("CAMSRV_TELEMETRY", "api"), metrics=self.metrics
+        )
+
+        # images are saved by a writer thread so slow disks don't hold up the servers. each server
+        # runs in its own process so the output format can be chosen per camera.
+        self.writer = FITSWriter(
+            fmt=os.environ.get("CAMSRV_OUTPUT_FORMAT", "none"), metrics=self.metrics
+        )
+
+        # recent frames are kept in memory, up to CAMSRV_FRAME_BUFFER_MB, so they can be compared
+        # without reading them back from disk
+        self.frames = FrameBuffer(
+            maxbytes=float(os.environ.get("CAMSRV_FRAME_BUFFER_MB", 256)) * 2**20
+        )
+
+        # frames can be co-added on the server, e.g. to build up faint WFS stars from short
+        # exposures. stacking is off until /stack/start is requested.
+        self.stack = Stack(
+            mode=os.environ.get("CAMSRV_STACK_MODE", "mean"),
+            depth=int(os.environ.get("CAMSRV_STACK_DEPTH", 8)),
+            maxbytes=float(os.environ.get("CAMSRV_STACK_MB", 128)) * 2**20,
+        )
+        self.stacking = False
+        self._stack_cache = {}
+
+        # master biases and darks can be subtracted from images as they come in. that replaces the
+        # raw data that are saved, so it's off unless CAMSRV_CALIBRATE=1 or it's turned on through
+        # /calibration. servers that save data keep the masters in a calibration directory next to
+        # it unless CAMSRV_CALIBRATION_DIR is set.
+        self.calibration = CalibrationLibrary(
+            directory=os.environ.get("CAMSRV_CALIBRATION_DIR"),
+            maxbytes=float(os.environ.get("CAMSRV_CALIBRATION_MB", 64)) * 2**20,
+        )
+        self.calibrate = os.environ.get("CAMSRV_CALIBRATE", "0") != "0"
+
+        # memory use is sampled every CAMSRV_MEMORY_INTERVAL seconds. if CAMSRV_MEMORY_LIMIT_MB is set,
+        # cached frames and previews are dropped whenever the RSS is over it.
+        limit = os.environ.get("CAMSRV_MEMORY_LIMIT_MB")
+        self.memory = MemoryMonitor(
+            soft_limit=None if limit is None else float(limit) * 2**20,
+            on_limit=self.drop_caches,
+            cached_bytes=self.cached_bytes,
+        )
+        self.memory_sampler = tornado.ioloop.PeriodicCallback(
+            self.sample_memory,
+            float(os.environ.get("CAMSRV_MEMORY_INTERVAL", 30.0)) * 1000,
+        )
+        self.memory_sampler.start()
+
+        # camera I/O and image processing each get their own worker so neither blocks the IOLoop
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.process_executor = ThreadPoolExecutor(max_workers=1)
+        self._exposure_ids = itertools.count(1)
+        self.exposures = OrderedDict()
+        self.exposure_events = {}
+        self.max_exposure_records = 50
+
+        # only one sequence can run at a time since there's only one camera
+        self._sequence_ids = itertools.count(1)
+        self.sequence = None
+        self.sequence_event = None
+
+        # /status and websocket clients share one status sampler that reads the camera every
+        # status_interval seconds for as long as someone is asking for it
+        self.ioloop = tornado.ioloop.IOLoop.current()
+        self.event_clients = set()
+        self.last_status = None
+        self.status_time = None
+        self._status_future = None
+        self._status_requested = 0.0
+        self.status_interval = float(os.environ.get("CAMSRV_STATUS_INTERVAL", 2.0))
+        self.status_idle_timeout = 30.0
+        self.status_poller = tornado.ioloop.PeriodicCallback(
+            self.sample_status, self.status_interval * 1000
+        )
+        self.summary_keys = [
+            "DATE-OBS",
+            "EXPTIME",
+            "IMAGETYP",
+            "FILTER",
+            "NAXIS1",
+            "NAXIS2",
+            "XBINNING",
+            "YBINNING",
+            "RA",
+            "DEC",
+            "AIRMASS",
+            "BKGND",
+            "NOISE",
+            "PEAKVAL",
+            "NSATPIX",
+            "NSPOTS",
+        ]
 
         self.settings = dict(
             template_path=template_path, static_path=static_path, debug=True
@@ -373,15 +1935,36 @@ class CAMsrv(tornado.web.Application):
         self.handlers = [
             (r"/", self.HomeHandler),
             (r"/expose", self.ExposureHandler),
+            (r"/autoexposure", self.AutoExposureHandler),
+            (r"/exposure", self.ExposureStatusHandler),
+            (r"/sequence", self.SequenceHandler),
+            (r"/sequence/stop", self.SequenceStopHandler),
+            (r"/sequence/status", self.SequenceStatusHandler),
             (r"/disconnect", self.DisconnectHandler),
             (r"/latest", self.LatestHandler),
+            (r"/preview", self.PreviewHandler),
+            (r"/latest_stats", self.LatestStatsHandler),
+            (r"/frames", self.FramesHandler),
+            (r"/frame", self.FrameHandler),
+            (r"/stack", self.StackHandler),
+            (r"/stack/info", self.StackInfoHandler),
+            (r"/stack/start", self.StackStartHandler),
+            (r"/stack/stop", self.StackStopHandler),
+            (r"/calibration", self.CalibrationHandler),
+            (r"/calibration/build", self.CalibrationBuildHandler),
+            (r"/writer", self.WriterStatsHandler),
+            (r"/metrics", self.MetricsHandler),
             (r"/cooling", self.CoolingHandler),
             (r"/reset", self.ResetHandler),
             (r"/status", self.StatusHandler),
+            (r"/events", self.EventsHandler),
             (r"/temperature", self.TemperatureHandler),
             (r"/ccdconf", self.CCDHandler),
             (r"/profiler", self.MallocHandler),
             (r"/memhog", self.MemHogHandler),
+            (r"/memory", self.MemoryHandler),
+            (r"/memory/snapshot", self.MemorySnapshotHandler),
+            (r"/memory/diff", self.MemoryDiffHandler),
             (r"/js9/(.*)", tornado.web.StaticFileHandler, dict(path=js9_path)),
             (
                 r"/bootstrap/(.*)",
@@ -455,6 +2038,8 @@ def main(port=SIMSRVPORT):
     print(f"Simulator server running at http://127.0.0.1:{port}/")
     print("Press Ctrl+C to quit")
 
+    # keep telescope telemetry for image headers fresh in the background
+    application.telemetry.start()
     tornado.ioloop.IOLoop.instance().start()
 
 
@@ -4,7 +4,6 @@ MMTO F/5 WFS camera interface
 
 import importlib.resources
 import os
-import time
 import asyncio
 import importlib
 import tornado
@@ -16,22 +15,24 @@ from tornado.log import enable_pretty_logging
 from tornado.httpclient import AsyncHTTPClient
 import urllib.parse
 import base64
-from scipy.ndimage import median_filter
 from pathlib import Path
 import logging
 import logging.handlers
 from astropy.io import fits
-import io
 import json
 from pyindi.webclient import INDIWebApp
 
 dev = os.environ.get("WFSDEV", False)
 if dev:
-    from header import update_header
     from camsrv import CAMsrv
+    from msg import MSGPool
+    from f5wfs_camera import F5WFS_Cam
+    from f5wfs_hardware import F5WFS_Power
 else:
-    from .header import update_header
     from .camsrv import CAMsrv
+    from .msg import MSGPool
+    from .f5wfs_camera import F5WFS_Cam
+    from .f5wfs_hardware import F5WFS_Power
 
 enable_pretty_logging()
 logger = logging.getLogger("")
@@ -69,10 +70,8 @@ class F5WFSsrv(CAMsrv):
 
         def get(self):
             cam = self.application.camera
-            log.info(
-                "Setting f/5 WFS camera to its\
-                 default configuration, full-frame with 1x1 binning..."
-            )
+            log.info("Setting f/5 WFS camera to its\
+                 default configuration, full-frame with 1x1 binning...")
             cam.default_config()
 
     class ResetDriverHandler(tornado.web.RequestHandler):
@@ -218,6 +217,14 @@ class F5WFSsrv(CAMsrv):
             else:
                 self.write("None")
 
+    class MSGHealthHandler(tornado.web.RequestHandler):
+        """
+        Return the state of the connections to the F/5 hardware's MSG servers
+        """
+
+        def get(self):
+            self.finish({"connections": self.application.msg_pool.health()})
+
     class HelpMeHandler(tornado.web.RequestHandler):
 
         def get(self):
@@ -233,11 +240,15 @@ class F5WFSsrv(CAMsrv):
     def save_latest(self):
         log.info("Saving latest")
         if self.latest_image is not None:
-            imagename = Path("f5wfs_" + time.strftime("%Y%m%d-%H%M%S") + ".fits")
-            filename = self.datadir / imagename
-            self.last_filename = filename
+            filename = self.writer.next_filename(self.datadir, "f5wfs")
             log.info(f"saving to {filename}")
-            self.latest_image.writeto(filename)
+            # frames the writer turns away are never saved so they don't get a filename
+            if self.writer.submit(
+                filename, self.latest_fits.data, hdu=self.latest_image
+            ):
+                self.last_filename = filename
+            else:
+                self.last_filename = None
 
     def __init__(self, camhost="badname", camport=7624, connect=False):
         self.extra_handlers = [
@@ -250,6 +261,7 @@ class F5WFSsrv(CAMsrv):
             (r"/helpme.html", self.HelpMeHandler),
             (r"/remote_access", self.RemoteUSBHandler),
             (r"/restart_me", self.RestartMeHandler),
+            (r"/msg", self.MSGHealthHandler),
         ]
 
         iwa = INDIWebApp(
@@ -265,6 +277,41 @@ class F5WFSsrv(CAMsrv):
 
         self.home_template = "f5wfs.html"
 
+        # clients of the F/5 hardware's MSG servers. the camera itself is run through INDI, so their
+        # connections are only opened when they're first used. this app's own pool is what /msg
+        # and the msg_* metrics report on.
+        self.msg_pool = MSGPool(
+            request_time=self.metrics.histogram(
+                "msg_request_seconds", "Round trip time of MSG server requests"
+            )
+        )
+        self.wfscam = F5WFS_Cam(
+            host=os.environ.get("F5WFSCAMHOST", "f5wfs.mmto.arizona.edu"),
+            port=int(os.environ.get("F5WFSCAMPORT", 6868)),
+            pool=self.msg_pool,
+        )
+        self.wfspower = F5WFS_Power(
+            host=os.environ.get("F5WFSPOWERHOST", "f5wfs.mmto.arizona.edu"),
+            port=int(os.environ.get("F5WFSPOWERPORT", 4447)),
+            pool=self.msg_pool,
+        )
+        self.metrics.gauge(
+            "msg_connected",
+            "Whether each MSG server is connected",
+            func=lambda: {
+                (("server", c["server"]),): int(c["connected"])
+                for c in self.msg_pool.health()
+            },
+        )
+        self.metrics.counter(
+            "msg_reconnects_total",
+            "Number of times each MSG server has been reconnected to",
+            func=lambda: {
+                (("server", c["server"]),): max(0, c["connects"] - 1)
+                for c in self.msg_pool.health()
+            },
+        )
+
         if "WFSROOT" in os.environ:
             self.datadir = Path(os.environ["WFSROOT"])
         elif "HOME" in os.environ:
@@ -272,9 +319,14 @@ class F5WFSsrv(CAMsrv):
         else:
             self.datadir = Path("wfsdat")
 
+        # master biases and darks are kept with the data
+        if "CAMSRV_CALIBRATION_DIR" not in os.environ:
+            self.calibration.open(self.datadir / "calibration")
+
         self.latest_image = None
         self.requested_temp = -10.0
         self.default_exptime = 10.0
+        self.count_spots = True
 
         # We have to make one for f5
         bp_file = importlib.resources.files(__name__) / "data" / "f5_mask.fits"
@@ -289,28 +341,9 @@ class F5WFSsrv(CAMsrv):
 
         @param blob
         The blob object from the indidriver in this case it is the
-        image from the sbig wfs camera.
+        image from the sbig wfs camera. It is processed off of the IOLoop.
         """
-        buff = io.BytesIO(blob["data"])
-        hdulist = fits.open(buff)
-        if hdulist is not None:
-            hdulist = update_header(hdulist)
-            if self.bad_pixel_mask is not None:
-                im = hdulist[0].data
-                if im.shape != self.bad_pixel_mask.shape:
-                    log.warning(
-                        "Wrong readout configuration for\
-                      making bad pixel corrections..."
-                    )
-                else:
-                    blurred = median_filter(im, size=5)
-                    im[self.bad_pixel_mask] = blurred[self.bad_pixel_mask]
-
-            self.latest_image = hdulist[0]
-            self.save_latest()
-
-        else:
-            log.error("Exposure Failed")
+        self.ioloop.spawn_callback(self.receive_blob, blob["data"])
 
 
 def main(port=F5WFSPORT):
@@ -322,6 +355,8 @@ def main(port=F5WFSPORT):
     print(f"F/5 WFS camera server running at http://127.0.0.1:{port}/")
     print("Press Ctrl+C to quit")
 
+    # keep telescope telemetry for image headers fresh in the background
+    application.telemetry.start()
     tornado.ioloop.IOLoop.instance().start()
 
 
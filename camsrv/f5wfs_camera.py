@@ -2,14 +2,12 @@
 MSG-based Interface to the F/5-hecto WFS camera
 """
 
-import io
 import asyncio
 import logging
 from enum import Enum, auto
 
-from astropy.io import fits
-
-from saomsg.client import MSGClient
+from .ingest import read_blob
+from .msg import MSGDevice, MSGError
 
 logger = logging.getLogger("")
 logger.setLevel(logging.DEBUG)
@@ -45,9 +43,27 @@ class ExpType(Enum):
     dark = "dark"
 
 
-class F5WFS_Cam(MSGClient):
-    def __init__(self, host="localhost", port=6868):
-        super(F5WFS_Cam, self).__init__(host=host, port=port)
+class F5WFS_Cam(MSGDevice):
+    """
+    Interface to the F/5 WFS camera's MSG server. Requests go through the server's shared
+    connection in pool and can be pipelined, e.g. a status poll costs one round trip no matter
+    how many parameters it reads.
+    """
+
+    # maximum size of a FITS image, in bytes, that we ask the server for
+    FITS_MAX_BYTES = 1322240
+
+    def __init__(
+        self,
+        host="localhost",
+        port=6868,
+        poll_interval=0.1,
+        readout_timeout=30.0,
+        pool=None,
+    ):
+        super(F5WFS_Cam, self).__init__(host=host, port=port, pool=pool)
+        self.poll_interval = poll_interval
+        self.readout_timeout = readout_timeout
 
     @property
     def ccd_info(self):
@@ -62,13 +78,6 @@ class F5WFS_Cam(MSGClient):
         }
         return info
 
-    @property
-    def connected(self):
-        """
-        Query connection status
-        """
-        return self.running
-
     @property
     async def temperature(self):
         """
@@ -101,6 +110,18 @@ class F5WFS_Cam(MSGClient):
         timer = await self.get("timer")
         return int(timer)
 
+    async def status(self):
+        """
+        Read the camera state, timer, temperature, and setpoint in one round trip
+        """
+        state, timer, temp, setp = await self.get("state", "timer", "temp", "setp")
+        return {
+            "state": CamState[state],
+            "timer": int(timer),
+            "temperature": float(temp),
+            "setpoint": int(setp),
+        }
+
     async def cooler(self, state):
         """
         Toggle cooler on/off using a state of type Cooler
@@ -122,6 +143,28 @@ class F5WFS_Cam(MSGClient):
         status = await self.run("readout")
         return status
 
+    async def wait_for_state(self, *states, end=None):
+        """
+        Poll the camera until it reaches one of states. While exposing, the camera's timer is used
+        to sleep through the rest of the exposure rather than polling throughout it. The timer only
+        counts whole seconds, so if the loop time the exposure should end at is given as end, it is
+        used to narrow that down.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            state, timer = await self.get("state", "timer")
+            state = CamState[state]
+            if state in states:
+                return state
+            delay = self.poll_interval
+            if state == CamState.Exposing:
+                timer = int(timer)
+                remaining = timer - 1
+                if end is not None:
+                    remaining = min(max(end - loop.time(), remaining), timer)
+                delay = max(delay, remaining)
+            await asyncio.sleep(delay)
+
     async def abort(self):
         """
         Abort current exposure
@@ -129,67 +172,74 @@ class F5WFS_Cam(MSGClient):
         logging.debug("Sending abort command...")
         status = await self.run("abort")
         if status:
-            while True:
-                if await self.state == CamState.Idle:
-                    logging.debug("Camera idle. Abort complete.")
-                    break
-                await asyncio.sleep(0.5)
+            await asyncio.wait_for(
+                self.wait_for_state(CamState.Idle), self.readout_timeout
+            )
+            logging.debug("Camera idle. Abort complete.")
         else:
             logging.error("Problem sending abort command.")
         return status
 
-    async def expose(self, exptime, exptype=ExpType.light):
+    async def read_fits(self, progress=None):
         """
-        Acquire an exposure, read it out, and return a FITS object
+        Transfer the image that was read out into a buffer allocated once the server says how big it
+        is. progress(nread, nbytes) is called after each chunk. The image is returned as an HDUList
+        whose data are a view of the buffer.
         """
-        logging.debug(f"Taking a {exptime} second {exptype.value} exposure...")
-        status = await self.run("expose", 0, exptype.value, exptime)
-        if status:
-            while True:
-                if await self.state == CamState.Exposed:
-                    break
-                await asyncio.sleep(0.5)
-        else:
-            logging.error("Exposure command failed")
-            status = await self.idle()
-            return status
+        # the 0 isn't used and FITS_MAX_BYTES is the maximum expected nbytes. the actual
+        # nbytes of the image data are sent in the reply.
+        buf = await self.msg.fetch(
+            ("fits", 0, self.FITS_MAX_BYTES),
+            progress=progress,
+            timeout=self.readout_timeout,
+        )
+        logging.debug(f"Transferred {len(buf)} bytes of FITS data")
+        hdulist, _ = read_blob(buf)
+        return hdulist
+
+    async def _expose(self, exptime, exptype, progress):
+        end = asyncio.get_running_loop().time() + exptime
+        if not await self.run("expose", 0, exptype.value, exptime):
+            await self.idle()
+            raise MSGError("Exposure command failed")
+        await self.wait_for_state(CamState.Exposed, end=end)
 
         logging.debug("Exposure complete. Beginning readout...")
-        status = await self.run("readout")
-        if status:
-            while True:
-                if await self.state == CamState.Read:
-                    break
-                await asyncio.sleep(0.5)
-        else:
-            logging.error("Readout command failed")
-            status = await self.idle()
-            return status
+        if not await self.run("readout"):
+            await self.idle()
+            raise MSGError("Readout command failed")
+        await self.wait_for_state(CamState.Read)
 
         logging.debug("Readout complete. Transferring FITS data...")
-        # the 0 isn't used and the 1322240 is a maximum expected nbytes. the actual
-        # nbytes of the image data are sent in the reply.
-        fits_msg = "1 fits 0 1322240\n"
-        self.writer.write(fits_msg.encode())
-        await self.writer.drain()
-
-        rawreply = await self.reader.readline()
-        # pull the first line to parse out how many bytes we need to read
-        reply_data = rawreply.decode().split()
-        if reply_data[1] == "blk":
-            nbytes = int(reply_data[2])
-            logging.debug(f"Ready to transfer {nbytes} of FITS data")
-            fits_blob = await self.reader.readexactly(nbytes)
-            hdulist = fits.open(io.BytesIO(fits_blob))
-            status = await self.idle()
-            hdr = hdulist[0].header
-            hdr["CAMTEMP"] = await self.temperature
-            hdr["CAMSETP"] = await self.setpoint
-            return hdulist
-        else:
-            logging.error(f"Failed reply to fits command: {reply_data}")
-            status = await self.idle()
-            return status
-
-        status = await self.idle()
-        return status
+        hdulist = await self.read_fits(progress=progress)
+
+        # idle the camera and read the cooler state at the same time
+        _, (temp,), (setp,) = await self.request(
+            ("idle",), ("get", "temp"), ("get", "setp")
+        )
+        hdr = hdulist[0].header
+        hdr["CAMTEMP"] = float(temp)
+        hdr["CAMSETP"] = int(setp)
+        return hdulist
+
+    async def expose(self, exptime, exptype=ExpType.light, timeout=None, progress=None):
+        """
+        Acquire an exposure, read it out, and return it as an HDUList. progress is passed on to
+        read_fits(). If the exposure takes longer than timeout seconds, by default exptime plus
+        readout_timeout, or is cancelled, the camera is told to abort and TimeoutError or
+        CancelledError is raised. MSGError is raised if the camera rejects a command.
+        """
+        if timeout is None:
+            timeout = exptime + self.readout_timeout
+        logging.debug(f"Taking a {exptime} second {exptype.value} exposure...")
+        try:
+            return await asyncio.wait_for(
+                self._expose(exptime, exptype, progress), timeout
+            )
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            logging.error(f"Aborting {exptime} second exposure: {type(e).__name__}")
+            try:
+                await self.abort()
+            except Exception as abort_error:
+                logging.error(f"Unable to abort exposure: {abort_error}")
+            raise
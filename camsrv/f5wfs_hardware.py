@@ -5,7 +5,7 @@ Interface to the F/5-hecto WFS hardware via the waveserv MSG server
 import logging
 from enum import Enum
 
-from saomsg.client import MSGClient
+from .msg import MSGDevice
 
 logger = logging.getLogger("")
 logger.setLevel(logging.INFO)
@@ -16,17 +16,16 @@ class Power(Enum):
     off = "off"
 
 
-class F5WFS_Power(MSGClient):
+class F5WFS_Power(MSGDevice):
     """
     Interface to the MSG server that operates the networked power switch that feeds
     the F/5 WFS hardware.
     """
 
-    def __init__(self, host="localhost", port=4447):
-        super(F5WFS_Power, self).__init__(host=host, port=port)
+    def __init__(self, host="localhost", port=4447, pool=None):
+        super(F5WFS_Power, self).__init__(host=host, port=port, pool=pool)
         self.switches = {"computer": "wfs_control", "drives": "wfs_drive"}
 
-    @property
     async def power(self, switch):
         """
         Get the power status for specified switch
@@ -35,11 +34,12 @@ class F5WFS_Power(MSGClient):
             logging.error(f"Unsupported switch {switch}.")
             return
         state = await self.get(self.switches[switch])
-        logging.debug(f"Got {state} for wfs_control from WFS power switch server")
+        logging.debug(
+            f"Got {state} for {self.switches[switch]} from WFS power switch server"
+        )
         return Power[state]
 
-    @power.setter
-    async def power(self, switch, state):
+    async def set_power(self, switch, state):
         """
         Set switch power state where state is a member of the Power class.
         """
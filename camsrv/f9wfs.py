@@ -3,7 +3,6 @@ MMTO F/9 WFS camera interface
 """
 
 import os
-import time
 import importlib
 
 import tornado
@@ -12,10 +11,8 @@ import tornado.httpserver
 import tornado.ioloop
 import tornado.websocket
 from tornado.log import enable_pretty_logging
-import io
 from pathlib import Path
 
-from scipy.ndimage import median_filter
 import logging
 import logging.handlers
 
@@ -26,10 +23,8 @@ from pyindi.webclient import INDIWebApp
 
 dev = os.environ.get("WFSDEV", False)
 if dev:
-    from header import update_header
     from camsrv import CAMsrv
 else:
-    from .header import update_header
     from .camsrv import CAMsrv
 
 enable_pretty_logging()
@@ -95,11 +90,14 @@ class F9WFSsrv(CAMsrv):
 
     def save_latest(self):
         if self.latest_image is not None:
-            filename = self.datadir / Path(
-                "f9wfs_" + time.strftime("%Y%m%d-%H%M%S") + ".fits"
-            )
-            self.latest_image.writeto(filename)
-            self.last_filename = filename
+            filename = self.writer.next_filename(self.datadir, "f9wfs")
+            # frames the writer turns away are never saved so they don't get a filename
+            if self.writer.submit(
+                filename, self.latest_fits.data, hdu=self.latest_image
+            ):
+                self.last_filename = filename
+            else:
+                self.last_filename = None
 
     def __init__(self, camhost="f9indi", camport=7624, connect=True):
         self.extra_handlers = [
@@ -129,9 +127,14 @@ class F9WFSsrv(CAMsrv):
         else:
             self.datadir = Path("wfsdat")
 
+        # master biases and darks are kept with the data
+        if "CAMSRV_CALIBRATION_DIR" not in os.environ:
+            self.calibration.open(self.datadir / "calibration")
+
         self.latest_image = None
         self.requested_temp = -25.0
         self.default_exptime = 10.0
+        self.count_spots = True
 
         bp_file = importlib.resources.files(__name__) / "data" / "f9_mask.fits"
 
@@ -145,28 +148,9 @@ class F9WFSsrv(CAMsrv):
 
         @param blob
         The blob object from the indidriver in this case it is the
-        image from the sbig wfs camera.
+        image from the sbig wfs camera. It is processed off of the IOLoop.
         """
-        buff = io.BytesIO(blob["data"])
-        hdulist = fits.open(buff)
-        if hdulist is not None:
-            hdulist = update_header(hdulist)
-            if self.bad_pixel_mask is not None:
-                im = hdulist[0].data
-                if im.shape != self.bad_pixel_mask.shape:
-                    log.warning(
-                        "Wrong readout configuration for\
-                      making bad pixel corrections..."
-                    )
-                else:
-                    blurred = median_filter(im, size=5)
-                    im[self.bad_pixel_mask] = blurred[self.bad_pixel_mask]
-
-            self.latest_image = hdulist[0]
-            self.save_latest()
-
-        else:
-            log.error("Exposure Failed")
+        self.ioloop.spawn_callback(self.receive_blob, blob["data"])
 
 
 def main(port=F9WFSPORT):
@@ -178,6 +162,8 @@ def main(port=F9WFSPORT):
     print(f"F/9 WFS camera server running at http://127.0.0.1:{port}/")
     print("Press Ctrl+C to quit")
 
+    # keep telescope telemetry for image headers fresh in the background
+    application.telemetry.start()
     tornado.ioloop.IOLoop.instance().start()
 
 
@@ -0,0 +1,128 @@
+"""
+Ring buffer of recently read out frames so they can be compared without going back to disk
+"""
+
+import bisect
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from pathlib import Path
+
+__all__ = ["Frame", "FrameBuffer", "frame_nbytes"]
+
+Frame = namedtuple("Frame", ["id", "filename", "timestamp", "hdu", "nbytes"])
+
+
+def frame_nbytes(hdu):
+    """
+    Approximate memory used by hdu, its data plus 80 bytes per header card
+    """
+    nbytes = 80 * len(hdu.header)
+    if hdu.data is not None:
+        nbytes += hdu.data.nbytes
+    return nbytes
+
+
+class FrameBuffer:
+    """
+    Keep the last maxframes frames, evicting the oldest ones once they take up more than maxbytes.
+    The newest frame is always kept even if it is bigger than maxbytes on its own. Frames are
+    numbered sequentially and can be looked up by ID, filename, or the time they were added.
+    """
+
+    def __init__(self, maxframes=64, maxbytes=256 * 2**20):
+        self.maxframes = maxframes
+        self.maxbytes = maxbytes
+        self.lock = threading.Lock()
+        self.frames = OrderedDict()
+        self.filenames = {}
+        self.nbytes = 0
+        self._next_id = 1
+
+    def __len__(self):
+        return len(self.frames)
+
+    def add(self, hdu, filename=None, timestamp=None):
+        """
+        Add hdu to the buffer and return its Frame
+        """
+        with self.lock:
+            frame = Frame(
+                id=self._next_id,
+                filename=None if filename is None else Path(filename).name,
+                timestamp=time.time() if timestamp is None else timestamp,
+                hdu=hdu,
+                nbytes=frame_nbytes(hdu),
+            )
+            self._next_id += 1
+            self.frames[frame.id] = frame
+            if frame.filename is not None:
+                self.filenames[frame.filename] = frame.id
+            self.nbytes += frame.nbytes
+
+            while len(self.frames) > 1 and (
+                len(self.frames) > self.maxframes or self.nbytes > self.maxbytes
+            ):
+                self._evict()
+            return frame
+
+    def _evict(self):
+        _, old = self.frames.popitem(last=False)
+        self.nbytes -= old.nbytes
+        if old.filename is not None and self.filenames.get(old.filename) == old.id:
+            del self.filenames[old.filename]
+
+    def clear(self, keep=0):
+        """
+        Drop all but the newest keep frames. Returns the number of bytes freed.
+        """
+        with self.lock:
+            nbytes = self.nbytes
+            while len(self.frames) > keep:
+                self._evict()
+            return nbytes - self.nbytes
+
+    def get(self, frame_id):
+        return self.frames.get(frame_id)
+
+    def back(self, n=0):
+        """
+        Frame n before the newest one, so back(0) is the newest and back(1) the one before it
+        """
+        with self.lock:
+            if not 0 <= n < len(self.frames):
+                return None
+            return list(self.frames.values())[-1 - n]
+
+    def by_filename(self, filename):
+        frame_id = self.filenames.get(Path(filename).name)
+        return None if frame_id is None else self.frames.get(frame_id)
+
+    def at_time(self, timestamp):
+        """
+        Newest frame that was added at or before timestamp, in Unix seconds
+        """
+        with self.lock:
+            frames = list(self.frames.values())
+        times = [f.timestamp for f in frames]
+        i = bisect.bisect_right(times, timestamp)
+        return None if i == 0 else frames[i - 1]
+
+    def summary(self, summary_keys=()):
+        """
+        List of dicts describing each frame, oldest first, with the header values given by summary_keys
+        """
+        with self.lock:
+            frames = list(self.frames.values())
+        return [
+            {
+                "id": f.id,
+                "filename": f.filename,
+                "timestamp": f.timestamp,
+                "nbytes": f.nbytes,
+                "header": {
+                    k: f.hdu.header[k] for k in summary_keys if k in f.hdu.header
+                },
+            }
+            for f in frames
+        ]
@@ -3,6 +3,12 @@ Utilities for querying MMT systems to get information to include in image header
 """
 
 import json
+import math
+import time
+import logging
+import threading
+from collections import namedtuple
+
 import urllib3
 
 import redis
@@ -15,6 +21,25 @@ urllib3.disable_warnings()
 API_HOST = "http://api.mmto.arizona.edu/APIv1"
 REDIS_HOST = "ops2.mmto.arizona.edu"
 
+# all redis clients share one connection pool so connections are reused across requests
+REDIS_POOL = redis.ConnectionPool(host=REDIS_HOST, decode_responses=True)
+
+log = logging.getLogger("tornado.application")
+
+# how often, in seconds, each group of telemetry keys is refreshed. keys are grouped by their prefix.
+TELEMETRY_TTL = {
+    "mount": 1.0,
+    "hexapod": 5.0,
+    "ds": 60.0,
+}
+DEFAULT_TTL = 10.0
+
+# where telemetry can be fetched from. redis is faster, but only reachable within the observatory network.
+TELEMETRY_BACKENDS = ["api", "redis"]
+
+# how old, in seconds, cached telemetry can get before update_header fetches it synchronously
+TELEMETRY_MAX_AGE = 120.0
+
 HEADER_MAP = {
     "mount_mini_ra": {
         "fitskey": "RA",
@@ -254,44 +279,339 @@ HEADER_MAP = {
 }
 
 
-def get_redis_keys(r=redis.StrictRedis(host=REDIS_HOST)):
-    keys = sorted([k.decode() for k in r.keys()])
+# HEADER_MAP compiled into the cards that update_header adds to each image. parse converts
+# the raw telemetry value into what goes in the header.
+HeaderCard = namedtuple("HeaderCard", ["key", "fitskey", "comment", "unit", "parse"])
+
+
+def parse_value(value):
+    """
+    Convert a telemetry value to an int or float if possible, otherwise leave it as is
+    """
+    if isinstance(value, (int, float)) or value is None:
+        return value
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        pass
+    try:
+        v = float(value)
+    except (TypeError, ValueError):
+        return value
+    # FITS headers can't hold NaN or inf
+    return v if math.isfinite(v) else value
+
+
+def parse_quantity(value):
+    """
+    Convert a telemetry value that has units to a float. Sexagesimal strings, e.g. RA and Dec,
+    are converted to decimal in the same units.
+    """
+    if isinstance(value, str) and ":" in value:
+        fields = value.strip().split(":")
+        try:
+            parts = [abs(float(p)) for p in fields]
+        except ValueError:
+            return value
+        sign = -1.0 if fields[0].strip().startswith("-") else 1.0
+        return sign * sum(p / 60.0**i for i, p in enumerate(parts))
+    v = parse_value(value)
+    return float(v) if isinstance(v, int) else v
+
+
+# room left for the comment in an 80 character card after the keyword, a fixed-format value, and separators
+MAX_COMMENT_LENGTH = 47
+
+
+def compile_header_map(header_map=HEADER_MAP):
+    """
+    Build the list of HeaderCards for a header map. Units, if any, are put in the comment
+    following the FITS convention, e.g. [deg], as long as they're simple and fit in the card.
+    """
+    cards = []
+    for key, info in header_map.items():
+        units = info["units"]
+        comment = info["comment"]
+        if units is None:
+            unit = None
+            parse = parse_value
+        else:
+            # some entries are scaled quantities, e.g. proper motions per century
+            units = u.Unit(units)
+            unit = units.to_string()
+            parse = parse_quantity
+            labeled = f"[{unit}] {comment}"
+            if units.scale == 1.0 and len(labeled) <= MAX_COMMENT_LENGTH:
+                comment = labeled
+        cards.append(HeaderCard(key, info["fitskey"], comment, unit, parse))
+    return cards
+
+
+HEADER_CARDS = compile_header_map()
+
+
+def build_cards(data, cards=HEADER_CARDS):
+    """
+    Given dict of telemetry values, return list of (keyword, value, comment) tuples for the available keys
+    """
+    return [
+        (c.fitskey, c.parse(data[c.key]), c.comment) for c in cards if c.key in data
+    ]
+
+
+def get_redis_client(pool=REDIS_POOL):
+    """
+    Get a redis client that uses the shared connection pool
+    """
+    return redis.StrictRedis(connection_pool=pool)
+
+
+def get_redis_keys(r=None, pattern="*"):
+    """
+    Get list of redis keys. Uses SCAN so the server isn't blocked like it is by KEYS.
+    """
+    if r is None:
+        r = get_redis_client()
+    keys = sorted(
+        set(
+            k.decode() if isinstance(k, bytes) else k
+            for k in r.scan_iter(match=pattern, count=1000)
+        )
+    )
     return keys
 
 
-def get_redis(keys=[], r=redis.StrictRedis(host=REDIS_HOST)):
+def get_redis(keys=[], r=None):
+    """
+    Given list of keys, return a dict containing the redis values for each key using a single MGET
+    """
+    if r is None:
+        r = get_redis_client()
     if not isinstance(keys, list):
         keys = [keys]
     vals = r.mget(keys)
-    return dict(zip(keys, vals))
+    vals = [v.decode() if isinstance(v, bytes) else v for v in vals]
+    return {k: v for k, v in zip(keys, vals) if v is not None}
 
 
-def get_api_keys(http=urllib3.PoolManager()):
+def get_api_keys(http=urllib3.PoolManager(), host=API_HOST):
     """
     Get list of redis keys via the MMTO web api
     """
-    url = API_HOST + "/keys"
+    url = host + "/keys"
     r = http.request("GET", url)
     data = json.loads(r.data.decode("utf-8"))
     return sorted(data)
 
 
-def get_api(keys=[], http=urllib3.PoolManager()):
+def get_api(keys=[], http=urllib3.PoolManager(), host=API_HOST):
     """
     Given list of keys, return a dict containing the redis values for each keys
     """
     if not isinstance(keys, list):
         keys = [keys]
-    url = API_HOST + "/vals"
+    url = host + "/vals"
     r = http.request("POST", url, fields={"keys": ",".join(keys)})
     data = json.loads(r.data.decode("utf-8"))
     return data
 
 
-def update_header(f=fits.hdu.image.PrimaryHDU()):
+def key_group(key):
+    """
+    Telemetry keys are grouped by the subsystem prefix, e.g. mount, hexapod, or ds
+    """
+    return key.split("_")[0]
+
+
+class TelemetryCache:
+    """
+    Snapshot of telemetry values from the MMTO API or redis that is refreshed in a background thread.
+    Each group of keys is refreshed on its own schedule as set by ttls, and each value is
+    stamped with the time it was fetched. Keys the backend doesn't return are remembered as missing
+    for max_age seconds so they don't cause a fetch for every image. If a MetricsRegistry is
+    given, the round trip time of each fetch is recorded in it. The background refresh is started
+    by start(), or by the first get() if autostart is True.
+    """
+
+    def __init__(
+        self,
+        keys=None,
+        ttls=TELEMETRY_TTL,
+        max_age=TELEMETRY_MAX_AGE,
+        http=None,
+        host=API_HOST,
+        autostart=False,
+        backend="api",
+        redis_client=None,
+        metrics=None,
+    ):
+        if backend not in TELEMETRY_BACKENDS:
+            raise ValueError(
+                f"Unknown telemetry backend {backend}, must be one of {TELEMETRY_BACKENDS}"
+            )
+        if keys is None:
+            keys = list(HEADER_MAP.keys())
+        self.keys = list(keys)
+        self.ttls = ttls
+        self.max_age = max_age
+        self.http = urllib3.PoolManager() if http is None else http
+        self.host = host
+        self.autostart = autostart
+        self.backend = backend
+        self.redis = redis_client
+
+        self.fetch_time = None
+        if metrics is not None:
+            self.fetch_time = metrics.histogram(
+                "telemetry_fetch_seconds", "Round trip time of telemetry fetches"
+            )
+
+        self.groups = {}
+        for k in self.keys:
+            self.groups.setdefault(key_group(k), []).append(k)
+
+        self.values = {}
+        self.timestamps = {}
+        self.missing = {}
+        self.lock = threading.Lock()
+        self._next_refresh = {g: 0.0 for g in self.groups}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def ttl(self, group):
+        return self.ttls.get(group, DEFAULT_TTL)
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def refresh(self, keys=None):
+        """
+        Fetch the given keys, or all of them, from the backend and update the snapshot
+        """
+        if keys is None:
+            keys = self.keys
+        start = time.perf_counter()
+        if self.backend == "redis":
+            if self.redis is None:
+                self.redis = get_redis_client()
+            data = get_redis(list(keys), r=self.redis)
+        else:
+            data = get_api(list(keys), http=self.http, host=self.host)
+        if self.fetch_time is not None:
+            self.fetch_time.observe(time.perf_counter() - start, backend=self.backend)
+        now = time.time()
+        with self.lock:
+            for k in keys:
+                if k in data:
+                    self.values[k] = data[k]
+                    self.timestamps[k] = now
+                    self.missing.pop(k, None)
+                else:
+                    self.missing[k] = now
+        return data
+
+    def refresh_due(self):
+        """
+        Refresh each group whose TTL has expired and return how long to wait until the next one is due
+        """
+        now = time.time()
+        for group, keys in self.groups.items():
+            if now < self._next_refresh[group]:
+                continue
+            # schedule the next refresh up front so a failing API is not hammered
+            self._next_refresh[group] = now + self.ttl(group)
+            try:
+                self.refresh(keys)
+            except Exception as e:
+                log.warning(f"Unable to refresh {group} telemetry: {e}")
+        return max(0.0, min(self._next_refresh.values()) - time.time())
+
+    def _run(self):
+        while not self._stop.is_set():
+            wait = self.refresh_due()
+            self._stop.wait(wait)
+
+    def start(self):
+        """
+        Start the background refresh thread if it isn't already running
+        """
+        if self.running:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="telemetry-cache", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def ages(self, keys=None):
+        """
+        Return dict of how many seconds old each cached value is. Missing values have an age of None.
+        """
+        if keys is None:
+            keys = self.keys
+        now = time.time()
+        with self.lock:
+            return {
+                k: now - self.timestamps[k] if k in self.timestamps else None
+                for k in keys
+            }
+
+    def snapshot(self, keys=None):
+        """
+        Return the cached values and their ages without touching the network
+        """
+        if keys is None:
+            keys = self.keys
+        ages = self.ages(keys)
+        with self.lock:
+            values = {k: self.values[k] for k in keys if k in self.values}
+        return values, ages
+
+    def get(self, keys=None):
+        """
+        Return the cached values and their ages. Any values that are missing or older than
+        max_age are fetched synchronously first, except for ones the backend left out of a reply
+        within the last max_age seconds. If autostart is True, the background refresh is started on
+        first use.
+        """
+        if keys is None:
+            keys = self.keys
+        if self.autostart:
+            self.start()
+
+        now = time.time()
+        with self.lock:
+            missing = {k for k, t in self.missing.items() if now - t <= self.max_age}
+        stale = [
+            k
+            for k, age in self.ages(keys).items()
+            if (age is None or age > self.max_age) and k not in missing
+        ]
+        if len(stale) > 0:
+            try:
+                self.refresh(stale)
+            except Exception as e:
+                log.warning(
+                    f"Unable to fetch stale telemetry, using cached values: {e}"
+                )
+                if len(self.values) == 0:
+                    raise
+
+        return self.snapshot(keys)
+
+
+def update_header(f=fits.hdu.image.PrimaryHDU(), telemetry=None):
     """
     Given a FITS PrimaryHDU object or a list of HDUs, insert data from redis into the primary headers
-    and return updates HDU or HDU list
+    and return updates HDU or HDU list. If a TelemetryCache is given, its snapshot is used instead of
+    querying the API for each image.
     """
     if isinstance(f, fits.hdu.image.PrimaryHDU):
         header = f.header
@@ -308,12 +628,17 @@ def update_header(f=fits.hdu.image.PrimaryHDU()):
         )
 
     keys = list(HEADER_MAP.keys())
-    data = get_api(keys)
+    if telemetry is None:
+        data = get_api(keys)
+    else:
+        data, ages = telemetry.get(keys)
+        ages = [a for a in ages.values() if a is not None]
+        if len(ages) > 0:
+            header["TELAGE"] = (
+                round(max(ages), 3),
+                "Age of oldest telemetry value (s)",
+            )
 
-    for k in keys:
-        if k not in header:
-            header.append((HEADER_MAP[k]["fitskey"], data[k], HEADER_MAP[k]["comment"]))
-        else:
-            header.comments[k] = HEADER_MAP[k]["comment"]
+    header.extend(build_cards(data), update=True)
 
     return f
@@ -0,0 +1,153 @@
+"""
+Read FITS images received as INDI BLOBs without going through astropy's file layer
+"""
+
+import io
+import logging
+
+import numpy as np
+from astropy.io import fits
+
+log = logging.getLogger("tornado.application")
+
+__all__ = ["RawImage", "read_blob"]
+
+BLOCK = 2880
+CARD = 80
+
+# numpy dtypes for each BITPIX in FITS (big endian) and native byte order
+BITPIX_DTYPES = {
+    8: np.uint8,
+    16: np.int16,
+    32: np.int32,
+    64: np.int64,
+    -32: np.float32,
+    -64: np.float64,
+}
+
+
+def header_length(buf):
+    """
+    Length in bytes, including padding, of the FITS header at the start of buf
+    """
+    for start in range(0, len(buf), BLOCK):
+        block = bytes(buf[start:][:BLOCK])
+        for card in range(0, len(block), CARD):
+            if block[card:][:CARD].rstrip() == b"END":
+                return start + BLOCK
+    raise ValueError("No END card found in FITS header")
+
+
+class RawImage:
+    """
+    Primary image of a FITS file with the pixel data mapped straight out of the buffer it was
+    received in. The header is parsed once and the data are only byte-swapped, in place if
+    the buffer is writeable, when the machine's byte order isn't big endian. A read-only buffer,
+    e.g. bytes, costs one copy and is kept as is so tobytes() can reuse its data section if the
+    pixels haven't been modified. Set modified if they are.
+    """
+
+    def __init__(self, buf):
+        self.buffer = memoryview(buf).cast("B")
+        self.header_size = header_length(self.buffer)
+        header = fits.Header.fromstring(
+            bytes(self.buffer[: self.header_size]).decode("ascii")
+        )
+
+        self.bitpix = header["BITPIX"]
+        if self.bitpix not in BITPIX_DTYPES:
+            raise ValueError(f"Unsupported BITPIX {self.bitpix}")
+        naxis = header["NAXIS"]
+        if naxis == 0:
+            raise ValueError("FITS file has no primary image")
+        self.shape = tuple(header[f"NAXIS{i}"] for i in range(naxis, 0, -1))
+
+        # signed 16-bit data with BZERO = 32768 is how FITS stores unsigned 16-bit images
+        bscale = header.get("BSCALE", 1)
+        self.bzero = header.get("BZERO", 0)
+        self.unsigned = self.bitpix == 16 and self.bzero == 32768
+        if bscale != 1 or (self.bzero != 0 and not self.unsigned):
+            raise ValueError(f"Unsupported scaling BSCALE={bscale}, BZERO={self.bzero}")
+
+        dtype = np.dtype(BITPIX_DTYPES[self.bitpix])
+        self.data_size = int(np.prod(self.shape)) * dtype.itemsize
+        if self.header_size + self.data_size > len(self.buffer):
+            raise ValueError("FITS data section is truncated")
+
+        self.data = self._map(dtype.newbyteorder(">"))
+        self.hdu = fits.PrimaryHDU(data=self.data, header=header)
+        self.modified = False
+
+    @property
+    def data_section(self):
+        start = self.header_size
+        end = start + self.data_size
+        return self.buffer[start:end]
+
+    @property
+    def in_place(self):
+        """
+        True if self.data is a view of the received buffer rather than a copy
+        """
+        return not self.buffer.readonly
+
+    def _map(self, fits_dtype):
+        raw = np.frombuffer(self.data_section, dtype=fits_dtype).reshape(self.shape)
+        native = raw.dtype.newbyteorder("=")
+
+        if self.buffer.readonly:
+            if self.unsigned:
+                return raw.view(">u2") ^ np.uint16(0x8000)
+            return raw.astype(native)
+
+        if not raw.dtype.isnative:
+            raw.byteswap(inplace=True)
+        data = raw.view(native)
+        if self.unsigned:
+            data = data.view(np.uint16)
+            data ^= np.uint16(0x8000)
+        return data
+
+    def tobytes(self):
+        """
+        Serialize the image with its current header into a single preallocated buffer. The received
+        data section is copied over as is if the pixels are unchanged and it is still intact, otherwise
+        the pixels are converted straight into the output. Returned as bytes since that is all
+        tornado's RequestHandler.write() accepts.
+        """
+        hdu = self.hdu
+        if hdu.data is not self.data or hdu.header["BITPIX"] != self.bitpix:
+            out = io.BytesIO()
+            hdu.writeto(out)
+            return out.getvalue()
+
+        header = hdu.header.tostring().encode("ascii")
+        out = bytearray(len(header) + self.data_size + (-self.data_size % BLOCK))
+        out[: len(header)] = header
+        if self.modified or self.in_place:
+            fits_dtype = self.data.dtype.newbyteorder(">")
+            pixels = np.frombuffer(
+                out, dtype=fits_dtype, count=self.data.size, offset=len(header)
+            ).reshape(self.shape)
+            if self.unsigned:
+                np.bitwise_xor(self.data, np.uint16(0x8000), out=pixels)
+            else:
+                pixels[...] = self.data
+        else:
+            start = len(header)
+            end = start + self.data_size
+            memoryview(out)[start:end] = self.data_section
+        return bytes(out)
+
+
+def read_blob(buf):
+    """
+    Read a FITS BLOB as a RawImage. Returns the image's HDUList and the RawImage, or None for the
+    latter if the file needed to be read by astropy, e.g. because it is compressed or scaled.
+    """
+    try:
+        raw = RawImage(buf)
+        return fits.HDUList([raw.hdu]), raw
+    except (ValueError, KeyError) as e:
+        log.debug(f"Reading FITS BLOB with astropy instead: {e}")
+        return fits.open(io.BytesIO(buf)), None
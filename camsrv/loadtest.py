@@ -0,0 +1,276 @@
+"""
+Load test a camera server running against a simulated camera and INDI BLOB feed. Everything runs
+locally so no camera, INDI server, or network access is needed.
+
+Usage: camsrv-loadtest --server f5wfs --duration 30 --concurrency 20 --mix status=10,latest=5,expose=1
+"""
+
+import sys
+import json
+import logging
+import time
+import random
+import socket
+import asyncio
+import argparse
+import importlib
+import tempfile
+import multiprocessing
+from pathlib import Path
+
+import numpy as np
+
+import tornado.httpclient
+import tornado.httpserver
+
+__all__ = ["REQUESTS", "SERVERS", "main", "parse_mix", "run_load", "summarize"]
+
+# module and class of each server that can be load tested
+SERVERS = {
+    "sim": ("camsrv.camsrv", "CAMsrv"),
+    "matcam": ("camsrv.matcam", "MATsrv"),
+    "ratcam": ("camsrv.ratcam", "RATsrv"),
+    "f5wfs": ("camsrv.f5wfs", "F5WFSsrv"),
+    "f9wfs": ("camsrv.f9wfs", "F9WFSsrv"),
+}
+
+# request paths for each kind of request in a mix
+REQUESTS = {
+    "home": "/",
+    "status": "/status",
+    "latest": "/latest",
+    "preview": "/preview",
+    "static": "/js9.min.js",
+    "expose": "/expose?exptime={exptime}",
+    "metrics": "/metrics",
+}
+
+DEFAULT_MIX = "status=10,latest=4,preview=2,static=2,expose=1"
+
+
+def parse_mix(mix):
+    """
+    Parse a request mix like "status=10,latest=5" into a dict of request kinds to relative weights
+    """
+    weights = {}
+    for item in mix.split(","):
+        kind, _, weight = item.partition("=")
+        kind = kind.strip()
+        if kind not in REQUESTS:
+            raise ValueError(
+                f"Unknown request kind {kind}, must be one of {list(REQUESTS)}"
+            )
+        weights[kind] = float(weight) if weight else 1.0
+    return weights
+
+
+def create_server(server, shape=(512, 512), datadir=None):
+    """
+    Instantiate a server with a FakeCamera and offline telemetry, saving images to datadir
+    """
+    from .simulate import FakeCamera, offline_telemetry
+
+    module, name = SERVERS[server]
+    cls = getattr(importlib.import_module(module), name)
+    app = cls(connect=False)
+    app.camera = FakeCamera(shape=shape)
+    app.telemetry = offline_telemetry(metrics=app.metrics)
+    if datadir is not None:
+        app.datadir = Path(datadir)
+        app.calibration.open(app.datadir / "calibration")
+    return app
+
+
+def serve(server, port, shape, blob_interval, ready):
+    """
+    Run a server with a simulated BLOB feed until the process is terminated
+    """
+    from .simulate import BlobFeed
+
+    logging.getLogger("tornado.access").setLevel(logging.WARNING)
+
+    async def run():
+        with tempfile.TemporaryDirectory(prefix="camsrv-loadtest-") as datadir:
+            app = create_server(server, shape=shape, datadir=datadir)
+            http_server = tornado.httpserver.HTTPServer(app, max_buffer_size=2**30)
+            http_server.listen(port, address="127.0.0.1")
+            # seed the server with an image so /latest and /preview don't start out as 404s
+            feed = BlobFeed(app, shape=shape, interval=blob_interval or 1.0)
+            feed.send()
+            if blob_interval > 0:
+                feed.start()
+            ready.set()
+            await asyncio.Event().wait()
+
+    asyncio.run(run())
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def run_load(url, mix, duration=10.0, concurrency=10, exptime=0.1, timeout=60.0):
+    """
+    Send requests chosen at random according to the weights in mix from concurrency clients for
+    duration seconds. Returns a list of (kind, latency, HTTP code) for every request.
+    """
+    kinds = list(mix)
+    weights = [mix[k] for k in kinds]
+    client = tornado.httpclient.AsyncHTTPClient(
+        force_instance=True, max_clients=concurrency
+    )
+    results = []
+    deadline = time.perf_counter() + duration
+
+    async def worker():
+        while time.perf_counter() < deadline:
+            kind = random.choices(kinds, weights)[0]
+            path = REQUESTS[kind].format(exptime=exptime)
+            start = time.perf_counter()
+            try:
+                response = await client.fetch(
+                    url + path, raise_error=False, request_timeout=timeout
+                )
+                code = response.code
+            except Exception:
+                code = 599
+            results.append((kind, time.perf_counter() - start, code))
+
+    try:
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+    finally:
+        client.close()
+    return results
+
+
+def summarize(results, duration):
+    """
+    Throughput and latency percentiles, in ms, for each kind of request and for all of them together
+    """
+    summary = {}
+    groups = {"all": results}
+    for kind in sorted({r[0] for r in results}):
+        groups[kind] = [r for r in results if r[0] == kind]
+
+    for kind, group in groups.items():
+        if len(group) == 0:
+            continue
+        latencies = np.array([r[1] for r in group]) * 1000.0
+        p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+        summary[kind] = {
+            "requests": len(group),
+            # a 409 is an exposure turned away because another one is in progress
+            "errors": sum(1 for r in group if r[2] >= 400 and r[2] != 409),
+            "rate": len(group) / duration,
+            "mean": float(latencies.mean()),
+            "p50": float(p50),
+            "p90": float(p90),
+            "p99": float(p99),
+            "max": float(latencies.max()),
+        }
+    return summary
+
+
+def format_summary(summary):
+    columns = ["requests", "errors", "rate", "mean", "p50", "p90", "p99", "max"]
+    lines = [f"{'':10s}" + "".join(f"{c:>10s}" for c in columns)]
+    for kind, stats in summary.items():
+        row = f"{kind:10s}{stats['requests']:10d}{stats['errors']:10d}"
+        row += "".join(f"{stats[c]:10.1f}" for c in columns[2:])
+        lines.append(row)
+    lines.append("rate is requests/s, latencies are in ms")
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--server", choices=SERVERS, default="sim", help="Server to load test"
+    )
+    parser.add_argument(
+        "--url",
+        default=None,
+        help="Test an already running server instead of starting one",
+    )
+    parser.add_argument(
+        "--port", type=int, default=None, help="Port to run the server on"
+    )
+    parser.add_argument(
+        "--duration", type=float, default=30.0, help="Seconds to run the test for"
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=10, help="Number of concurrent clients"
+    )
+    parser.add_argument(
+        "--mix",
+        default=DEFAULT_MIX,
+        help=f"Weights for each kind of request, one of {list(REQUESTS)}",
+    )
+    parser.add_argument(
+        "--exptime", type=float, default=0.1, help="Exposure time for expose requests"
+    )
+    parser.add_argument(
+        "--blob-interval",
+        type=float,
+        default=1.0,
+        help="Seconds between simulated BLOBs, 0 for none",
+    )
+    parser.add_argument(
+        "--size",
+        type=int,
+        nargs=2,
+        default=[512, 512],
+        help="Height and width of simulated frames",
+    )
+    parser.add_argument(
+        "--json", default=None, help="Also write the summary to this file"
+    )
+    args = parser.parse_args(argv)
+
+    mix = parse_mix(args.mix)
+    process = None
+    url = args.url
+    if url is None:
+        port = args.port or free_port()
+        ctx = multiprocessing.get_context("spawn")
+        ready = ctx.Event()
+        process = ctx.Process(
+            target=serve,
+            args=(args.server, port, tuple(args.size), args.blob_interval, ready),
+            daemon=True,
+        )
+        process.start()
+        if not ready.wait(60):
+            process.terminate()
+            sys.exit(f"{args.server} server failed to start")
+        url = f"http://127.0.0.1:{port}"
+
+    try:
+        results = asyncio.run(
+            run_load(
+                url,
+                mix,
+                duration=args.duration,
+                concurrency=args.concurrency,
+                exptime=args.exptime,
+            )
+        )
+    finally:
+        if process is not None:
+            process.terminate()
+            process.join()
+
+    summary = summarize(results, args.duration)
+    print(
+        f"{args.server if args.url is None else url}: {args.concurrency} clients for {args.duration} s"
+    )
+    print(format_summary(summary))
+    if args.json is not None:
+        with open(args.json, "w") as fp:
+            json.dump({"args": vars(args), "summary": summary}, fp, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,7 +4,6 @@ MMTO Mount Aligment Telescope interface
 
 import os
 import socket
-import time
 
 from pathlib import Path
 
@@ -47,10 +46,14 @@ class MATsrv(CAMsrv):
 
     def save_latest(self):
         if self.latest_image is not None:
-            filename = self.datadir / Path(
-                "matcam_" + time.strftime("%Y%m%d-%H%M%S") + ".fits"
-            )
-            self.latest_image.writeto(filename)
+            filename = self.writer.next_filename(self.datadir, "matcam")
+            # frames the writer turns away are never saved so they don't get a filename
+            if self.writer.submit(
+                filename, self.latest_fits.data, hdu=self.latest_image
+            ):
+                self.last_filename = filename
+            else:
+                self.last_filename = None
 
     def __init__(self, camhost="matcam", camport=7624, connect=True):
         super(MATsrv, self).__init__(camhost=camhost, camport=camport, connect=connect)
@@ -62,6 +65,10 @@ class MATsrv(CAMsrv):
         else:
             self.datadir = Path("/mmt/matcam/latest")
 
+        # master biases and darks are kept with the data
+        if "CAMSRV_CALIBRATION_DIR" not in os.environ:
+            self.calibration.open(self.datadir / "calibration")
+
         self.latest_image = None
         self.requested_temp = -15.0
 
@@ -75,6 +82,8 @@ def main(port=MATCAMPORT):
     print(f"MATcam server running at http://127.0.0.1:{port}/")
     print("Press Ctrl+C to quit")
 
+    # keep telescope telemetry for image headers fresh in the background
+    application.telemetry.start()
     tornado.ioloop.IOLoop.instance().start()
 
 
@@ -0,0 +1,171 @@
+"""
+Memory usage sampling, tracemalloc snapshot diffs, and a soft memory limit for long-running servers
+"""
+
+import os
+import time
+import logging
+import resource
+import threading
+import tracemalloc
+from collections import OrderedDict, deque
+
+import numpy as np
+
+log = logging.getLogger("tornado.application")
+
+__all__ = ["MemoryMonitor", "numpy_bytes", "rss_bytes", "start_tracing"]
+
+PAGESIZE = resource.getpagesize()
+
+
+def start_tracing(nframes=None):
+    """
+    Start tracemalloc if CAMSRV_TRACEMALLOC is set to the number of stack frames to record, or
+    if nframes is given. Tracing slows down every allocation so it is off by default.
+    """
+    if nframes is None:
+        nframes = os.environ.get("CAMSRV_TRACEMALLOC")
+    if nframes and not tracemalloc.is_tracing():
+        tracemalloc.start(int(nframes))
+    return tracemalloc.is_tracing()
+
+
+def rss_bytes():
+    """
+    Current resident set size of this process. Falls back to the peak RSS where /proc isn't available.
+    """
+    try:
+        with open("/proc/self/statm") as fp:
+            return int(fp.read().split()[1]) * PAGESIZE
+    except (OSError, IndexError, ValueError):
+        # ru_maxrss is in kilobytes on linux, but bytes on macOS
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def numpy_bytes():
+    """
+    Bytes currently allocated for NumPy array data, or None if tracemalloc isn't tracing
+    """
+    if not tracemalloc.is_tracing():
+        return None
+    snapshot = tracemalloc.take_snapshot().filter_traces(
+        [tracemalloc.DomainFilter(True, np.lib.tracemalloc_domain)]
+    )
+    return sum(stat.size for stat in snapshot.statistics("filename"))
+
+
+class MemoryMonitor:
+    """
+    Sample the process's memory use and keep a history of the last maxsamples samples. If RSS grows
+    beyond soft_limit bytes, on_limit is called to free up caches. Numbered tracemalloc snapshots
+    can be taken and compared to see where memory is going.
+    """
+
+    def __init__(
+        self,
+        soft_limit=None,
+        on_limit=None,
+        cached_bytes=None,
+        maxsamples=360,
+        maxsnapshots=8,
+    ):
+        self.soft_limit = soft_limit
+        self.on_limit = on_limit
+        self.cached_bytes = cached_bytes
+        self.samples = deque(maxlen=maxsamples)
+        self.lock = threading.Lock()
+        self.nlimited = 0
+        self.freed = 0
+
+        self.snapshots = OrderedDict()
+        self.maxsnapshots = maxsnapshots
+        self._snapshot_id = 0
+
+    @property
+    def tracing(self):
+        return tracemalloc.is_tracing()
+
+    def sample(self):
+        """
+        Record a sample of RSS, NumPy allocations, and cached bytes, and enforce the soft limit
+        """
+        sample = {
+            "time": time.time(),
+            "rss": rss_bytes(),
+            "numpy": numpy_bytes(),
+            "cached": None if self.cached_bytes is None else self.cached_bytes(),
+        }
+        if self.tracing:
+            sample["traced"], sample["traced_peak"] = tracemalloc.get_traced_memory()
+
+        if (
+            self.soft_limit is not None
+            and sample["rss"] > self.soft_limit
+            and self.on_limit is not None
+        ):
+            freed = self.on_limit()
+            log.warning(
+                f"RSS of {sample['rss'] / 2**20:.1f} MB is over the soft limit of "
+                f"{self.soft_limit / 2**20:.1f} MB, freed {freed / 2**20:.1f} MB of cached images"
+            )
+            with self.lock:
+                self.nlimited += 1
+                self.freed += freed
+            sample["freed"] = freed
+
+        with self.lock:
+            self.samples.append(sample)
+        return sample
+
+    def stats(self):
+        """
+        Return dict of the latest sample, the sample history, and how often the soft limit was hit
+        """
+        with self.lock:
+            samples = list(self.samples)
+            return {
+                "tracing": self.tracing,
+                "soft_limit": self.soft_limit,
+                "limited": self.nlimited,
+                "freed": self.freed,
+                "latest": samples[-1] if samples else None,
+                "samples": samples,
+                "snapshots": {i: s[0] for i, s in self.snapshots.items()},
+            }
+
+    def take_snapshot(self):
+        """
+        Take a tracemalloc snapshot and return its ID. Only the most recent maxsnapshots are kept.
+        """
+        if not self.tracing:
+            raise RuntimeError(
+                "tracemalloc is not tracing, set CAMSRV_TRACEMALLOC to enable it"
+            )
+        snapshot = tracemalloc.take_snapshot()
+        with self.lock:
+            self._snapshot_id += 1
+            self.snapshots[self._snapshot_id] = (time.time(), snapshot)
+            while len(self.snapshots) > self.maxsnapshots:
+                self.snapshots.popitem(last=False)
+            return self._snapshot_id
+
+    def compare(self, old_id, new_id=None, key_type="lineno", nlines=10):
+        """
+        Return the top nlines differences between two snapshots as text. If new_id is None, the old
+        snapshot is compared to a new one taken now.
+        """
+        if old_id not in self.snapshots:
+            raise KeyError(f"No snapshot {old_id}")
+        old = self.snapshots[old_id][1]
+        if new_id is None:
+            new_id = self.take_snapshot()
+        if new_id not in self.snapshots:
+            raise KeyError(f"No snapshot {new_id}")
+        new = self.snapshots[new_id][1]
+
+        stats = new.compare_to(old, key_type)
+        text = f"Top {nlines} memory differences between snapshots {old_id} and {new_id}:\n"
+        for s in stats[:nlines]:
+            text += f"\t{s}\n"
+        return text
@@ -0,0 +1,202 @@
+"""
+Counters, gauges, and histograms exported in the Prometheus text exposition format
+"""
+
+import math
+import time
+import threading
+from contextlib import contextmanager
+
+__all__ = [
+    "Counter",
+    "DEFAULT_BUCKETS",
+    "Gauge",
+    "Histogram",
+    "MetricsRegistry",
+    "CONTENT_TYPE",
+]
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# seconds, from sub-millisecond array operations out to long exposures
+DEFAULT_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+    120.0,
+)
+
+
+def format_value(value):
+    if value is None:
+        return "NaN"
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (
+        (k, str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"'))
+        for k, v in labels
+    )
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+class Metric:
+    """
+    Base class for a named metric with values for each combination of labels. If func is given, the
+    values are instead read from func() at export time. func can return a number or a dict of label
+    tuples to numbers.
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name, documentation, func=None):
+        self.name = name
+        self.documentation = documentation
+        self.func = func
+        self.lock = threading.Lock()
+        self.values = {}
+
+    @staticmethod
+    def key(labels):
+        return tuple(sorted(labels.items()))
+
+    def samples(self):
+        """
+        List of (suffix, labels, value) to export
+        """
+        if self.func is not None:
+            try:
+                value = self.func()
+            except Exception:
+                return []
+            if isinstance(value, dict):
+                return [("", k, v) for k, v in value.items()]
+            return [("", (), value)]
+        with self.lock:
+            return [("", k, v) for k, v in self.values.items()]
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        for suffix, labels, value in self.samples():
+            lines.append(
+                f"{self.name}{suffix}{format_labels(labels)} {format_value(value)}"
+            )
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self.values.get(self.key(labels), 0)
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self.values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Context manager that observes how long its block takes to run, even if it raises
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels):
+        counts, _ = self.values.get(self.key(labels), ([0], 0.0))
+        return sum(counts)
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            items = [(k, list(c), s) for k, (c, s) in self.values.items()]
+        for key, counts, total in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                le = (("le", format_value(float(bound))),)
+                samples.append(("_bucket", key + le, cumulative))
+            samples.append(("_sum", key, total))
+            samples.append(("_count", key, cumulative))
+        return samples
+
+
+class MetricsRegistry:
+    """
+    Collection of metrics that can be rendered together for a /metrics endpoint
+    """
+
+    def __init__(self, prefix="camsrv"):
+        self.prefix = prefix
+        self.metrics = {}
+
+    def _add(self, metric):
+        if metric.name in self.metrics:
+            return self.metrics[metric.name]
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, func=None):
+        return self._add(Counter(f"{self.prefix}_{name}", documentation, func=func))
+
+    def gauge(self, name, documentation, func=None):
+        return self._add(Gauge(f"{self.prefix}_{name}", documentation, func=func))
+
+    def histogram(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        return self._add(
+            Histogram(f"{self.prefix}_{name}", documentation, buckets=buckets)
+        )
+
+    def render(self):
+        return "\n".join(m.render() for m in self.metrics.values()) + "\n"
@@ -0,0 +1,332 @@
+"""
+Persistent, shared connections to MSG servers that reconnect on their own
+"""
+
+import time
+import asyncio
+import itertools
+import logging
+
+log = logging.getLogger("tornado.application")
+
+__all__ = ["MSGConnection", "MSGDevice", "MSGError", "MSGPool", "default_pool"]
+
+
+class MSGError(Exception):
+    """
+    Raised when the MSG server rejects a request
+    """
+
+
+class MSGConnection:
+    """
+    Connection to one MSG server that is shared by all of its clients. Requests are written as
+    they are made and a single reader task matches replies to them by message ID, so concurrent
+    get()s and run()s don't wait on each other. If the connection drops, outstanding requests
+    fail with ConnectionError and it is reopened, waiting from min_backoff up to max_backoff
+    seconds, doubling each time, between failed attempts. If a metrics Histogram is given as
+    request_time, the round trip time of each request is recorded in it, labelled by server.
+    """
+
+    def __init__(
+        self,
+        host,
+        port,
+        timeout=10.0,
+        min_backoff=0.5,
+        max_backoff=30.0,
+        request_time=None,
+    ):
+        self.host = host
+        self.port = port
+        self.request_time = request_time
+        self.timeout = timeout
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.backoff = min_backoff
+
+        self.reader = None
+        self.writer = None
+        self.pending = {}
+        self._ids = itertools.count(1)
+        self._ready = None
+        self._task = None
+
+        self.state = "idle"
+        self.connects = 0
+        self.failures = 0
+        self.requests = 0
+        self.last_error = None
+        self.connected_since = None
+
+    @property
+    def address(self):
+        return f"{self.host}:{self.port}"
+
+    @property
+    def connected(self):
+        return self.writer is not None and not self.writer.is_closing()
+
+    def start(self):
+        """
+        Start connecting in the background if we aren't already
+        """
+        if self._task is None or self._task.done():
+            self._ready = asyncio.Event()
+            self._task = asyncio.ensure_future(self._run())
+
+    async def close(self):
+        """
+        Close the connection and stop reconnecting
+        """
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.state = "idle"
+
+    async def _run(self):
+        try:
+            while True:
+                self.state = "connecting"
+                try:
+                    self.reader, self.writer = await asyncio.wait_for(
+                        asyncio.open_connection(self.host, self.port), self.timeout
+                    )
+                except (OSError, asyncio.TimeoutError) as e:
+                    self.failures += 1
+                    self.last_error = str(e) or type(e).__name__
+                    log.warning(
+                        f"Unable to connect to MSG server {self.address}, "
+                        f"retrying in {self.backoff:.1f} s: {self.last_error}"
+                    )
+                    self.state = "backoff"
+                    await asyncio.sleep(self.backoff)
+                    self.backoff = min(2 * self.backoff, self.max_backoff)
+                    continue
+
+                log.info(f"Connected to MSG server {self.address}")
+                self.state = "connected"
+                self.connects += 1
+                self.backoff = self.min_backoff
+                self.connected_since = time.time()
+                self._ready.set()
+                try:
+                    await self._read_replies()
+                except (OSError, ValueError, asyncio.IncompleteReadError) as e:
+                    self.last_error = str(e) or type(e).__name__
+                    log.warning(
+                        f"Lost connection to MSG server {self.address}: {self.last_error}"
+                    )
+                finally:
+                    self._disconnect()
+        finally:
+            self._disconnect()
+
+    def _disconnect(self):
+        if self._ready is not None:
+            self._ready.clear()
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+        self.connected_since = None
+        pending, self.pending = self.pending, {}
+        for future, _ in pending.values():
+            if not future.done():
+                future.set_exception(
+                    ConnectionError(f"Lost connection to MSG server {self.address}")
+                )
+
+    async def _read_replies(self):
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                raise ConnectionError("MSG server closed the connection")
+            words = line.decode().split()
+            if not words:
+                continue
+            msgid, reply = words[0], words[1:]
+            future, progress = self.pending.get(msgid, (None, None))
+
+            # a blk reply is followed by that many bytes of data, which have to be read even if
+            # nobody is waiting for them any more to keep the connection in sync
+            data = None
+            if len(reply) > 1 and reply[0] == "blk":
+                data = await self._read_block(int(reply[1]), progress)
+
+            self.pending.pop(msgid, None)
+            if future is None:
+                log.debug(
+                    f"Ignoring unexpected reply from MSG server {self.address}: {line!r}"
+                )
+            elif not future.done():
+                future.set_result((reply, data))
+
+    async def _read_block(self, nbytes, progress=None, chunk_size=65536):
+        """
+        Read nbytes into a buffer allocated up front, calling progress(nread, nbytes) after each chunk
+        """
+        buf = bytearray(nbytes)
+        view = memoryview(buf)
+        nread = 0
+        while nread < nbytes:
+            chunk = await self.reader.read(min(chunk_size, nbytes - nread))
+            if not chunk:
+                raise ConnectionError(
+                    "MSG server closed the connection during a data transfer"
+                )
+            end = nread + len(chunk)
+            view[nread:end] = chunk
+            nread = end
+            if progress is not None:
+                progress(nread, nbytes)
+        return buf
+
+    async def _submit(self, commands, progress=None, timeout=None):
+        """
+        Send commands, each a sequence of words, and return their (reply, data) in order
+        """
+        self.start()
+        timeout = self.timeout if timeout is None else timeout
+        if not self.connected:
+            try:
+                await asyncio.wait_for(self._ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                raise ConnectionError(
+                    f"Not connected to MSG server {self.address}: {self.last_error}"
+                ) from None
+
+        loop = asyncio.get_running_loop()
+        ids = [str(next(self._ids)) for _ in commands]
+        futures = []
+        for msgid in ids:
+            future = loop.create_future()
+            self.pending[msgid] = (future, progress)
+            futures.append(future)
+        lines = [" ".join([i, *map(str, cmd)]) + "\n" for i, cmd in zip(ids, commands)]
+        self.requests += len(commands)
+        start = time.perf_counter()
+        try:
+            self.writer.write("".join(lines).encode())
+            await self.writer.drain()
+            return await asyncio.wait_for(asyncio.gather(*futures), timeout)
+        finally:
+            for msgid in ids:
+                self.pending.pop(msgid, None)
+            if self.request_time is not None:
+                self.request_time.observe(
+                    time.perf_counter() - start, server=self.address
+                )
+
+    async def request(self, *commands, timeout=None):
+        """
+        Send commands to the MSG server and wait for all of their replies. Returns the words that
+        follow the ack in each reply. Raises MSGError if any of them are rejected.
+        """
+        replies = await self._submit(commands, timeout=timeout)
+        for cmd, (reply, _) in zip(commands, replies):
+            if not reply or reply[0] != "ack":
+                raise MSGError(f"{' '.join(map(str, cmd))} failed: {' '.join(reply)}")
+        return [reply[1:] for reply, _ in replies]
+
+    async def fetch(self, command, progress=None, timeout=None):
+        """
+        Send a command that replies with a block of data and return the data as a bytearray
+        """
+        ((reply, data),) = await self._submit(
+            [command], progress=progress, timeout=timeout
+        )
+        if data is None:
+            raise MSGError(f"{' '.join(map(str, command))} failed: {' '.join(reply)}")
+        return data
+
+    def health(self):
+        """
+        Connection state and counters for monitoring
+        """
+        return {
+            "server": self.address,
+            "state": self.state,
+            "connected": self.connected,
+            "connected_since": self.connected_since,
+            "connects": self.connects,
+            "failures": self.failures,
+            "backoff": self.backoff,
+            "requests": self.requests,
+            "pending": len(self.pending),
+            "last_error": self.last_error,
+        }
+
+
+class MSGPool:
+    """
+    One MSGConnection for each MSG server, shared by every client of that server. Options are
+    passed on to each new MSGConnection.
+    """
+
+    def __init__(self, **options):
+        self.options = options
+        self.connections = {}
+
+    def connection(self, host, port):
+        key = (host, int(port))
+        if key not in self.connections:
+            self.connections[key] = MSGConnection(host, int(port), **self.options)
+        return self.connections[key]
+
+    def health(self):
+        return [c.health() for c in self.connections.values()]
+
+    async def close(self):
+        for connection in self.connections.values():
+            await connection.close()
+
+
+# the pool MSGDevices use unless they are given another
+default_pool = MSGPool()
+
+
+class MSGDevice:
+    """
+    Base class for clients of an MSG server whose requests go through its shared connection in pool,
+    default_pool by default
+    """
+
+    def __init__(self, host="localhost", port=0, pool=None):
+        self.host = host
+        self.port = port
+        self.msg = (default_pool if pool is None else pool).connection(host, port)
+
+    @property
+    def connected(self):
+        return self.msg.connected
+
+    @property
+    def running(self):
+        return self.msg.connected
+
+    async def request(self, *commands, timeout=None):
+        return await self.msg.request(*commands, timeout=timeout)
+
+    async def get(self, *params):
+        """
+        Read one or more parameters from the MSG server in a single round trip
+        """
+        values = [
+            " ".join(v) for v in await self.request(*[("get", p) for p in params])
+        ]
+        return values[0] if len(params) == 1 else values
+
+    async def run(self, cmd, *args):
+        """
+        Run a command on the MSG server. Returns True if it was accepted.
+        """
+        try:
+            await self.request((cmd, *args))
+        except MSGError as e:
+            log.error(str(e))
+            return False
+        return True
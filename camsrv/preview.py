@@ -0,0 +1,146 @@
+"""
+Downsampled, stretched preview images for quick display in a browser
+"""
+
+import io
+import zlib
+import struct
+
+import numpy as np
+
+from astropy.visualization import ZScaleInterval, PercentileInterval, MinMaxInterval
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+__all__ = [
+    "PREVIEW_FORMATS",
+    "STRETCHES",
+    "bin_image",
+    "check_preview_args",
+    "stretch_image",
+    "make_preview",
+]
+
+STRETCHES = {
+    "zscale": ZScaleInterval,
+    "minmax": MinMaxInterval,
+}
+
+# WebP needs Pillow, but PNG can be written with just zlib
+PREVIEW_FORMATS = {"png": "image/png"}
+if Image is not None:
+    PREVIEW_FORMATS["webp"] = "image/webp"
+
+
+# range of preview sizes, in pixels along the longest side, that can be requested
+MIN_SIZE = 16
+MAX_SIZE = 4096
+
+
+def check_preview_args(size, stretch, fmt=None):
+    """
+    Convert and check the size, stretch, and format of a requested preview, raising ValueError if
+    any of them are unsupported. The format isn't checked if fmt is None. Returns size as an int
+    and stretch.
+    """
+    size = int(size)
+    if not MIN_SIZE <= size <= MAX_SIZE:
+        raise ValueError(f"Preview size {size} must be from {MIN_SIZE} to {MAX_SIZE}")
+    if stretch not in STRETCHES:
+        try:
+            percentile = float(stretch)
+        except ValueError:
+            raise ValueError(
+                f"Stretch {stretch} must be one of {list(STRETCHES)} or a percentile"
+            )
+        if not 0 < percentile <= 100:
+            raise ValueError(f"Percentile stretch {stretch} must be from 0 to 100")
+    if fmt is not None and fmt not in PREVIEW_FORMATS:
+        raise ValueError(
+            f"Unsupported preview format {fmt}, must be one of {list(PREVIEW_FORMATS)}"
+        )
+    return size, stretch
+
+
+def bin_image(im, factor):
+    """
+    Bin an image by averaging factor x factor blocks. Rows and columns that don't fill a block are dropped.
+    """
+    if factor <= 1:
+        return np.asarray(im, dtype=np.float32)
+    ny = im.shape[0] // factor
+    nx = im.shape[1] // factor
+    trimmed = np.asarray(im[: ny * factor, : nx * factor], dtype=np.float32)
+    return trimmed.reshape(ny, factor, nx, factor).mean(axis=(1, 3))
+
+
+def stretch_image(im, stretch="zscale"):
+    """
+    Scale an image to 8-bit using the named stretch. A number, e.g. "99.5", is used as a percentile clip.
+    """
+    if stretch in STRETCHES:
+        interval = STRETCHES[stretch]()
+    else:
+        interval = PercentileInterval(float(stretch))
+
+    finite = np.isfinite(im)
+    if not finite.all():
+        im = np.where(finite, im, np.nanmedian(im) if finite.any() else 0.0)
+
+    vmin, vmax = interval.get_limits(im)
+    if vmax <= vmin:
+        vmax = vmin + 1.0
+    scaled = (im - vmin) * (255.0 / (vmax - vmin))
+    return np.clip(scaled, 0, 255).astype(np.uint8)
+
+
+def _png_chunk(tag, data):
+    chunk = tag + data
+    return (
+        struct.pack(">I", len(data))
+        + chunk
+        + struct.pack(">I", zlib.crc32(chunk) & 0xFFFFFFFF)
+    )
+
+
+def encode_png(im8):
+    """
+    Encode a 2D uint8 array as a grayscale PNG
+    """
+    ny, nx = im8.shape
+    # each scanline is prefixed with a 0 byte for no filtering
+    raw = np.zeros((ny, nx + 1), dtype=np.uint8)
+    raw[:, 1:] = im8
+    header = struct.pack(">IIBBBBB", nx, ny, 8, 0, 0, 0, 0)
+    return b"".join(
+        [
+            b"\x89PNG\r\n\x1a\n",
+            _png_chunk(b"IHDR", header),
+            _png_chunk(b"IDAT", zlib.compress(raw.tobytes(), 6)),
+            _png_chunk(b"IEND", b""),
+        ]
+    )
+
+
+def make_preview(im, size=512, stretch="zscale", fmt="png"):
+    """
+    Bin im so its largest dimension is no more than size, stretch it to 8 bits, and encode it.
+    FITS images have their origin at the bottom left so the preview is flipped to match how JS9 shows them.
+    """
+    if fmt not in PREVIEW_FORMATS:
+        raise ValueError(
+            f"Unsupported preview format {fmt}, must be one of {list(PREVIEW_FORMATS)}"
+        )
+
+    factor = max(1, int(np.ceil(max(im.shape) / size)))
+    im8 = stretch_image(bin_image(im, factor), stretch=stretch)[::-1]
+
+    if fmt == "png":
+        return encode_png(np.ascontiguousarray(im8))
+
+    out = io.BytesIO()
+    Image.fromarray(im8).save(out, format=fmt.upper(), lossless=True)
+    return out.getvalue()
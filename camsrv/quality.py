@@ -0,0 +1,94 @@
+"""
+Per-frame quality statistics: background, noise, peak, saturation, and Shack-Hartmann spot counts
+"""
+
+import numpy as np
+from scipy import ndimage
+
+__all__ = [
+    "HEADER_CARDS",
+    "add_header_cards",
+    "clipped_stats",
+    "count_spots",
+    "frame_stats",
+]
+
+# FITS keyword and comment for each statistic
+HEADER_CARDS = {
+    "background": ("BKGND", "Sigma-clipped background (ADU)"),
+    "noise": ("NOISE", "Sigma-clipped background noise (ADU)"),
+    "peak": ("PEAKVAL", "Maximum pixel value (ADU)"),
+    "saturated": ("NSATPIX", "Number of saturated pixels"),
+    "nspots": ("NSPOTS", "Number of WFS spots detected"),
+    "spot_flux": ("SPOTFLUX", "Mean background-subtracted WFS spot flux (ADU)"),
+}
+
+
+def clipped_stats(im, nsigma=3.0, maxiters=3, maxpix=2**15):
+    """
+    Median and standard deviation of im after iteratively clipping pixels more than nsigma
+    standard deviations from the median. Large images are subsampled to about maxpix pixels
+    since the background doesn't need every pixel to be well determined.
+    """
+    stride = max(1, int(np.ceil(np.sqrt(im.size / maxpix))))
+    sample = np.asarray(im[::stride, ::stride], dtype=np.float32).ravel()
+    for _ in range(maxiters):
+        median = np.median(sample)
+        std = sample.std()
+        keep = np.abs(sample - median) <= nsigma * std
+        if keep.all() or not keep.any():
+            break
+        sample = sample[keep]
+    return float(np.median(sample)), float(sample.std())
+
+
+def count_spots(im, background, noise, nsigma=5.0, min_pixels=3):
+    """
+    Count the spots in a Shack-Hartmann frame as groups of at least min_pixels connected pixels
+    more than nsigma times the noise above the background. Returns the number of spots and their
+    mean background-subtracted flux.
+    """
+    bright = im > background + nsigma * max(noise, 1.0)
+    labels, nlabels = ndimage.label(bright)
+    if nlabels == 0:
+        return 0, 0.0
+    # only the bright pixels need to be summed up by label
+    spot_labels = labels[bright]
+    npix = np.bincount(spot_labels, minlength=nlabels + 1)
+    flux = np.bincount(spot_labels, weights=im[bright], minlength=nlabels + 1)
+    spots = npix >= min_pixels
+    spots[0] = False
+    nspots = int(np.count_nonzero(spots))
+    if nspots == 0:
+        return 0, 0.0
+    return nspots, float((flux[spots] - npix[spots] * background).mean())
+
+
+def frame_stats(im, saturation=65535, spots=False):
+    """
+    Quality statistics for a frame as a dict keyed like HEADER_CARDS. Spots are only counted if
+    spots is True, i.e. for WFS frames.
+    """
+    background, noise = clipped_stats(im)
+    stats = {
+        "background": background,
+        "noise": noise,
+        "peak": float(im.max()),
+        "saturated": int(np.count_nonzero(im >= saturation)),
+    }
+    if spots:
+        stats["nspots"], stats["spot_flux"] = count_spots(im, background, noise)
+    return stats
+
+
+def add_header_cards(header, stats):
+    """
+    Write frame_stats() results into a FITS header
+    """
+    for key, value in stats.items():
+        if key in HEADER_CARDS:
+            keyword, comment = HEADER_CARDS[key]
+            if isinstance(value, float):
+                value = round(value, 2)
+            header[keyword] = (value, comment)
+    return header
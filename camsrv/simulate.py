@@ -0,0 +1,243 @@
+"""
+Offline stand-ins for the camera, its INDI BLOB feed, and the MMTO API for testing the servers
+without any hardware or network access
+"""
+
+import io
+import json
+import math
+import time
+import asyncio
+import logging
+from collections import Counter
+
+import numpy as np
+from astropy.io import fits
+
+import tornado.ioloop
+
+from .header import HEADER_MAP, TelemetryCache
+
+log = logging.getLogger("tornado.application")
+
+__all__ = [
+    "BlobFeed",
+    "FakeCamera",
+    "FakeMSGCamera",
+    "StubAPI",
+    "make_frame",
+    "offline_telemetry",
+]
+
+
+def make_frame(
+    shape=(512, 512), nspots=200, seed=None, background=1000.0, noise=10.0, peak=5000.0
+):
+    """
+    Shack-Hartmann-like uint16 frame of Gaussian spots that peak at peak ADU above a noisy
+    background
+    """
+    rng = np.random.default_rng(seed)
+    im = rng.normal(background, noise, shape)
+
+    yy, xx = np.mgrid[-5:6, -5:6]
+    spot = peak * np.exp(-(xx**2 + yy**2) / 4.0)
+    n = int(math.sqrt(nspots))
+    for y in np.linspace(5, shape[0] - 6, n).astype(int):
+        for x in np.linspace(5, shape[1] - 6, n).astype(int):
+            im[slice(y - 5, y + 6), slice(x - 5, x + 6)] += spot
+
+    return fits.PrimaryHDU(np.clip(im, 0, 65535).astype(np.uint16))
+
+
+class StubResponse:
+    def __init__(self, data):
+        self.data = data
+
+
+class StubAPI:
+    """
+    Stand-in for the urllib3 PoolManager used to query the MMTO API that returns value for every key
+    """
+
+    def __init__(self, value="1.5"):
+        self.value = value
+
+    def request(self, method, url, fields=None):
+        keys = fields["keys"].split(",") if fields else list(HEADER_MAP)
+        return StubResponse(json.dumps({k: self.value for k in keys}).encode())
+
+
+def offline_telemetry(metrics=None):
+    """
+    TelemetryCache that is served by StubAPI instead of the MMTO API
+    """
+    return TelemetryCache(http=StubAPI(), max_age=math.inf, metrics=metrics)
+
+
+class FakeCamera:
+    """
+    Stand-in for an indiclient camera that "exposes" by sleeping for the exposure time and then
+    returns a synthetic frame. Light frames have spots whose peaks grow by rate ADU per second.
+    """
+
+    def __init__(self, shape=(512, 512), readout_time=0.0, rate=5000.0):
+        self.shape = shape
+        self.readout_time = readout_time
+        self.rate = rate
+        self.filters = ["N/A"]
+        self.filter = "N/A"
+        self.frame_types = ["Light", "Dark", "Bias", "Flat"]
+        self.cooler = "On"
+        self.temperature = -10.0
+        self.cooling_power = 25.0
+        self.binning = {"X": 1, "Y": 1}
+        self.frame = {"X": 0, "Y": 0, "width": shape[1], "height": shape[0]}
+        self.ccd_info = {"CCD_MAX_X": shape[1], "CCD_MAX_Y": shape[0]}
+        self.connected = True
+        self.nexposures = 0
+
+    def expose(self, exptime=1.0, exptype="Light"):
+        time.sleep(exptime + self.readout_time)
+        self.nexposures += 1
+        peak = self.rate * exptime if exptype == "Light" else 0.0
+        hdu = make_frame(self.shape, seed=self.nexposures, peak=peak)
+        hdu.header["EXPTIME"] = exptime
+        hdu.header["IMAGETYP"] = exptype
+        return fits.HDUList([hdu])
+
+    def cooling_on(self):
+        self.cooler = "On"
+
+    def cooling_off(self):
+        self.cooler = "Off"
+
+    def disconnect(self):
+        pass
+
+    def quit(self):
+        pass
+
+
+class BlobFeed:
+    """
+    Deliver a synthetic FITS BLOB to app every interval seconds the way pyINDI's INDIWebApp does
+    for the WFS servers, i.e. by handing it to CAMsrv.receive_blob() on the IOLoop.
+    """
+
+    def __init__(self, app, shape=(512, 512), interval=1.0, nframes=8):
+        self.app = app
+        self.blobs = []
+        for i in range(nframes):
+            out = io.BytesIO()
+            make_frame(shape, seed=i).writeto(out)
+            self.blobs.append(out.getvalue())
+        self.nsent = 0
+        self.callback = tornado.ioloop.PeriodicCallback(self.send, interval * 1000)
+
+    def start(self):
+        self.callback.start()
+
+    def stop(self):
+        self.callback.stop()
+
+    def send(self):
+        """
+        Deliver the next BLOB. Returns a Future for its HDUList once it has been processed.
+        """
+        blob = self.blobs[self.nsent % len(self.blobs)]
+        self.nsent += 1
+        return asyncio.ensure_future(self.app.receive_blob(blob))
+
+
+class FakeMSGCamera:
+    """
+    Local MSG server that behaves like the F/5 WFS camera's: expose, readout, fits, idle, and
+    abort commands drive the same state machine, and state, timer, temp, and setp can be read
+    with get. Commands in reject are nak'd. requests counts the commands received.
+    """
+
+    def __init__(self, shape=(512, 512), readout_time=0.05, reject=()):
+        self.shape = shape
+        self.readout_time = readout_time
+        self.reject = set(reject)
+        self.requests = Counter()
+        self.temp = -20.0
+        self.setp = -20
+        self.state = "Idle"
+        self.ready_at = 0.0
+        self.server = None
+        self.port = None
+        self.writers = set()
+        self.nconnections = 0
+
+    async def start(self, host="127.0.0.1", port=None):
+        # restart on the same port by default so clients can reconnect
+        if port is None:
+            port = self.port or 0
+        self.server = await asyncio.start_server(self.handle, host, port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self.port
+
+    async def stop(self):
+        self.server.close()
+        for writer in list(self.writers):
+            writer.close()
+        await self.server.wait_closed()
+
+    @property
+    def timer(self):
+        """
+        Whole seconds left in the current exposure
+        """
+        if self.state != "Exposing":
+            return 0
+        return math.ceil(max(0.0, self.ready_at - time.monotonic()))
+
+    def update(self):
+        if time.monotonic() >= self.ready_at:
+            self.state = {"Exposing": "Exposed", "Reading": "Read"}.get(
+                self.state, self.state
+            )
+
+    def reply(self, cmd, args):
+        self.update()
+        if cmd in self.reject:
+            return f"nak {cmd} rejected"
+        if cmd == "get":
+            return f"ack {getattr(self, args[0])}"
+        if cmd == "expose":
+            self.state = "Exposing"
+            self.ready_at = time.monotonic() + float(args[2])
+        elif cmd == "readout":
+            self.state = "Reading"
+            self.ready_at = time.monotonic() + self.readout_time
+        elif cmd in ("idle", "abort"):
+            self.state = "Idle"
+        elif cmd == "cooler":
+            pass
+        else:
+            return f"nak unknown command {cmd}"
+        return "ack"
+
+    async def handle(self, reader, writer):
+        self.writers.add(writer)
+        self.nconnections += 1
+        try:
+            while line := await reader.readline():
+                msgid, cmd, *args = line.decode().split()
+                self.requests[cmd] += 1
+                if cmd == "fits":
+                    out = io.BytesIO()
+                    make_frame(self.shape, seed=self.requests["fits"]).writeto(out)
+                    writer.write(
+                        f"{msgid} blk {out.tell()}\n".encode() + out.getvalue()
+                    )
+                else:
+                    writer.write(f"{msgid} {self.reply(cmd, args)}\n".encode())
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self.writers.discard(writer)
+            writer.close()
@@ -0,0 +1,185 @@
+"""
+Co-add recent frames into a running sum, mean, or median so faint WFS stars can be built up
+from short exposures
+"""
+
+import threading
+
+import numpy as np
+from astropy.io import fits
+
+__all__ = ["MODES", "Stack"]
+
+MODES = ("sum", "mean", "median")
+
+# header values that have to match for frames to be stacked together
+GEOMETRY_KEYS = ("XBINNING", "YBINNING", "XORGSUBF", "YORGSUBF")
+
+
+def frame_geometry(hdu):
+    """
+    Shape, binning, and subframe origin of a frame. Frames are only stacked if these all match.
+    """
+    header = hdu.header
+    return (hdu.data.shape,) + tuple(
+        str(header.get(key, "")).strip().lower() for key in GEOMETRY_KEYS
+    )
+
+
+def frame_type(hdu):
+    return str(hdu.header.get("IMAGETYP", "")).strip().lower()
+
+
+class Stack:
+    """
+    Combine the last depth frames of the same geometry. The frames are copied into a float32 ring
+    buffer that is allocated once, and a running sum is updated as frames are added and dropped,
+    so sums and means cost one pass over the new frame. Medians are only computed when the stack is
+    read. depth is capped so the ring buffer fits in maxbytes. If depth is 0, sums and means are
+    taken over every frame added since the stack was reset and only the running sum is kept. A
+    frame with a different readout geometry from the ones in the stack starts a new stack, while
+    one of a different image type, e.g. a dark taken between lights, is skipped.
+    """
+
+    def __init__(self, mode="mean", depth=8, maxbytes=256 * 2**20):
+        if mode not in MODES:
+            raise ValueError(f"Unknown stack mode {mode}, must be one of {MODES}")
+        if depth < 0 or (mode == "median" and depth == 0):
+            raise ValueError(f"Unsupported stack depth {depth} for {mode} stacks")
+        self.mode = mode
+        self.depth = depth
+        self.maxbytes = maxbytes
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self._reset()
+
+    def _reset(self):
+        self.geometry = None
+        self.imagetyp = None
+        self.ring = None
+        self.total = None
+        self.frames = []
+        self.nadded = 0
+        self.version = 0
+        self._hdu = None
+        self._header = None
+
+    def __len__(self):
+        return len(self.frames)
+
+    @property
+    def nbytes(self):
+        nbytes = 0
+        for buf in (self.ring, self.total):
+            if buf is not None:
+                nbytes += buf.nbytes
+        return nbytes
+
+    def _allocate(self, hdu):
+        shape = hdu.data.shape
+        self.geometry = frame_geometry(hdu)
+        self.imagetyp = frame_type(hdu)
+        self.total = np.zeros(shape, dtype=np.float32)
+        if self.depth > 0:
+            frame_bytes = 4 * hdu.data.size
+            depth = max(1, min(self.depth, int(self.maxbytes // frame_bytes)))
+            self.ring = np.zeros((depth,) + shape, dtype=np.float32)
+
+    def add(self, hdu, info=None):
+        """
+        Add a frame to the stack. info is a dict describing the frame, e.g. its ID and filename,
+        that is kept for as long as the frame is in the stack. Returns the number of frames in the
+        stack, or None if the frame was skipped because its image type doesn't match the stack's.
+        """
+        with self.lock:
+            if self.geometry is not None and frame_geometry(hdu) != self.geometry:
+                self._reset()
+            if self.imagetyp is not None and frame_type(hdu) != self.imagetyp:
+                return None
+            if self.geometry is None:
+                self._allocate(hdu)
+
+            info = dict(info or {})
+            info["exptime"] = hdu.header.get("EXPTIME")
+            if self.ring is None:
+                self.total += hdu.data
+            else:
+                slot = self.nadded % len(self.ring)
+                if self.nadded >= len(self.ring):
+                    self.total -= self.ring[slot]
+                    self.frames.pop(0)
+                self.ring[slot] = hdu.data
+                if slot == len(self.ring) - 1:
+                    # resum once per pass through the ring so rounding errors don't build up
+                    np.sum(self.ring, axis=0, out=self.total)
+                else:
+                    self.total += self.ring[slot]
+            self.frames.append(info)
+            self.nadded += 1
+            self.version += 1
+            self._hdu = None
+            self._header = hdu.header
+            return len(self.frames)
+
+    def combine(self):
+        """
+        Stacked image as a float32 array, or None if the stack is empty
+        """
+        with self.lock:
+            return self._combine()
+
+    def _combine(self):
+        n = len(self.frames)
+        if n == 0:
+            return None
+        if self.mode == "sum":
+            return self.total.copy()
+        if self.mode == "mean":
+            return self.total / np.float32(n)
+        if n < len(self.ring):
+            return np.median(self.ring[:n], axis=0)
+        return np.median(self.ring, axis=0)
+
+    def hdu(self):
+        """
+        Stacked image as a PrimaryHDU, with the header of the newest frame plus the number of
+        frames combined and their files. It is only built once per added frame.
+        """
+        with self.lock:
+            if self._hdu is not None or len(self.frames) == 0:
+                return self._hdu
+            data = self._combine()
+            header = self._header.copy()
+            header.pop("BZERO", None)
+            header.pop("BSCALE", None)
+            exptimes = [f["exptime"] for f in self.frames if f["exptime"] is not None]
+            if len(exptimes) == len(self.frames):
+                # a sum is as deep as the combined exposure time; means and medians aren't
+                exptime = sum(exptimes)
+                if self.mode != "sum":
+                    exptime /= len(exptimes)
+                header["EXPTIME"] = exptime
+            header["NCOMBINE"] = (len(self.frames), "Number of frames stacked")
+            header["STACKMOD"] = (self.mode, "How the frames were combined")
+            for i, info in enumerate(self.frames[-999:], start=1):
+                if info.get("filename") is not None:
+                    header[f"IMCMB{i:03d}"] = info["filename"]
+            self._hdu = fits.PrimaryHDU(data=data, header=header)
+            return self._hdu
+
+    def state(self):
+        with self.lock:
+            return {
+                "mode": self.mode,
+                "depth": self.depth if self.ring is None else len(self.ring),
+                "imagetyp": self.imagetyp,
+                "nframes": len(self.frames),
+                "nadded": self.nadded,
+                "version": self.version,
+                "shape": None if self.geometry is None else list(self.geometry[0]),
+                "nbytes": self.nbytes,
+                "frames": list(self.frames),
+            }
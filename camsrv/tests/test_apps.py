@@ -2,12 +2,22 @@
 Sanity checks to make sure applications can be instantiated
 """
 
+import io
+import json
+import tracemalloc
+
+import numpy as np
+from astropy.io import fits
 from tornado.testing import AsyncHTTPTestCase, gen_test
+from tornado.websocket import websocket_connect
 
 from ..camsrv import CAMsrv
+from ..f5wfs import F5WFSsrv
 from ..f9wfs import F9WFSsrv
 from ..matcam import MATsrv
+from ..msg import default_pool
 from ..ratcam import RATsrv
+from ..simulate import offline_telemetry
 
 
 class TestSimSrv(AsyncHTTPTestCase):
@@ -20,6 +30,205 @@ class TestSimSrv(AsyncHTTPTestCase):
         response = yield self.http_client.fetch(self.get_url("/"))
         self.assertEqual(response.code, 200)
 
+    def test_expose_disconnected(self):
+        response = self.fetch("/expose")
+        self.assertEqual(response.code, 503)
+        self.assertEqual(json.loads(response.body)["state"], "failed")
+
+        response = self.fetch("/exposure")
+        self.assertEqual(response.code, 200)
+        self.assertEqual(json.loads(response.body)["state"], "none")
+
+    def test_status_cache(self):
+        self.assertEqual(self.fetch("/status?max_age=abc").code, 400)
+
+        # there's nothing to serve until the camera has been read
+        read_status = self._app.read_status
+        self._app.read_status = lambda: 1 / 0
+        response = self.fetch("/status")
+        self.assertEqual(response.code, 503)
+        self.assertIn("error", json.loads(response.body))
+        self._app.read_status = read_status
+
+        response = self.fetch("/status")
+        self.assertEqual(response.code, 200)
+        first = json.loads(response.body)
+        self.assertIn("temperature", first)
+
+        # served from the snapshot unless it's older than max_age
+        response = self.fetch("/status")
+        self.assertEqual(json.loads(response.body)["timestamp"], first["timestamp"])
+        response = self.fetch("/status?max_age=0")
+        self.assertGreater(json.loads(response.body)["timestamp"], first["timestamp"])
+
+    @gen_test
+    async def test_events(self):
+        url = self.get_url("/events").replace("http://", "ws://")
+        ws = await websocket_connect(url)
+        msg = json.loads(await ws.read_message())
+        self.assertEqual(msg["type"], "status")
+        self.assertIn("temperature", msg["data"])
+
+        self._app.latest_image = fits.PrimaryHDU(np.zeros((16, 16), dtype=np.uint16))
+        self._app.notify_new_image()
+        msg = json.loads(await ws.read_message())
+        self.assertEqual(msg["type"], "image")
+        self.assertEqual(msg["data"]["header"]["NAXIS1"], 16)
+
+        ws.close()
+
+    def test_preview(self):
+        response = self.fetch("/preview")
+        self.assertEqual(response.code, 404)
+
+        im = np.arange(64 * 64, dtype=np.uint16).reshape(64, 64)
+        self._app.latest_image = fits.PrimaryHDU(im)
+        response = self.fetch("/preview?size=32")
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.headers["Content-Type"], "image/png")
+        self.assertTrue(response.body.startswith(b"\x89PNG"))
+        self.assertIs(self._app.get_preview(32), self._app.get_preview(32))
+
+        for args in [
+            "format=bmp",
+            "stretch=foo",
+            "stretch=150",
+            "size=abc",
+            "size=-64",
+            "size=100000",
+        ]:
+            response = self.fetch(f"/preview?{args}")
+            self.assertEqual(response.code, 400, args)
+        self.assertEqual(self.fetch("/preview?stretch=99.5").code, 200)
+
+    def test_latest_stats(self):
+        response = self.fetch("/latest_stats")
+        self.assertEqual(response.code, 404)
+
+        im = np.full((64, 64), 100, dtype=np.uint16)
+        im[0, 0] = 65535
+        blob = io.BytesIO()
+        fits.PrimaryHDU(im).writeto(blob)
+
+        self._app.bad_pixel_mask = None
+        self._app.telemetry = offline_telemetry()
+        self._app.ingest_blob(blob.getvalue())
+        response = self.fetch("/latest_stats")
+        self.assertEqual(response.code, 200)
+        stats = json.loads(response.body)
+        self.assertEqual(stats["saturated"], 1)
+        self.assertEqual(stats["background"], 100.0)
+        self.assertEqual(self._app.latest_image.header["NSATPIX"], 1)
+
+    def test_frames(self):
+        response = self.fetch("/frame")
+        self.assertEqual(response.code, 404)
+
+        for i in range(3):
+            im = np.full((32, 32), i, dtype=np.uint16)
+            self._app.latest_image = fits.PrimaryHDU(im)
+            self._app.last_filename = f"test_{i}.fits"
+            self._app.buffer_latest()
+
+        frames = json.loads(self.fetch("/frames").body)
+        self.assertEqual(frames["nframes"], 3)
+        self.assertEqual(frames["frames"][0]["filename"], "test_0.fits")
+
+        response = self.fetch("/frame")
+        self.assertEqual(response.body, self._app.latest_fits.data)
+
+        response = self.fetch("/frame?back=1")
+        self.assertEqual(fits.getdata(io.BytesIO(response.body))[0, 0], 1)
+        response = self.fetch("/frame?filename=test_0.fits")
+        self.assertEqual(fits.getdata(io.BytesIO(response.body))[0, 0], 0)
+        first = frames["frames"][0]
+        response = self.fetch(f"/frame?time={first['timestamp']}")
+        self.assertEqual(response.headers["X-Frame-Id"], str(first["id"]))
+
+        response = self.fetch(f"/frame?id={first['id']}&format=png&size=16")
+        self.assertTrue(response.body.startswith(b"\x89PNG"))
+
+        self.assertEqual(self.fetch("/frame?back=5").code, 404)
+        self.assertEqual(self.fetch("/frame?size=abc").code, 400)
+        self.assertEqual(self.fetch("/frame?format=png&stretch=foo").code, 400)
+        self.assertEqual(self.fetch("/frame?format=png&size=0").code, 400)
+        self.assertEqual(self.fetch("/frame?time=yesterday").code, 400)
+
+    def test_ingest_blob(self):
+        blob = io.BytesIO()
+        fits.PrimaryHDU(np.arange(64 * 64, dtype=np.uint16).reshape(64, 64)).writeto(
+            blob
+        )
+        blob = blob.getvalue()
+
+        self._app.bad_pixel_mask = None
+        self._app.telemetry = offline_telemetry()
+        hdulist = self._app.ingest_blob(blob)
+        self.assertIs(self._app.latest_image, hdulist[0])
+        # no pixels were corrected so the received data are written back out as is
+        self.assertEqual(self._app.latest_fits.data[-5760:], blob[-5760:])
+
+        # or when the mask has no bad pixels in this readout
+        self._app.bad_pixel_mask = np.zeros((64, 64), dtype=bool)
+        self._app.ingest_blob(blob)
+        self.assertFalse(self._app._latest_raw.modified)
+        self.assertEqual(self._app.latest_fits.data[-5760:], blob[-5760:])
+
+        mask = np.zeros((64, 64), dtype=bool)
+        mask[10, 10] = True
+        self._app.bad_pixel_mask = mask
+        self._app.ingest_blob(blob)
+        self.assertTrue(self._app._latest_raw.modified)
+
+    def test_memory(self):
+        stats = json.loads(self.fetch("/memory?sample=1").body)
+        self.assertGreater(stats["latest"]["rss"], 0)
+
+        self._app.latest_image = fits.PrimaryHDU(np.zeros((64, 64), dtype=np.uint16))
+        self._app.buffer_latest()
+        self._app.get_preview(32)
+        self.assertGreater(self._app.cached_bytes(), 0)
+        self._app.drop_caches()
+        self.assertEqual(len(self._app.frames), 1)
+        self.assertEqual(len(self._app._previews), 0)
+
+        if not tracemalloc.is_tracing():
+            self.assertEqual(self.fetch("/memory/snapshot").code, 409)
+            self.assertEqual(self.fetch("/profiler").code, 409)
+
+    def test_metrics(self):
+        self.fetch("/status")
+        response = self.fetch("/metrics")
+        self.assertEqual(response.code, 200)
+        self.assertTrue(response.headers["Content-Type"].startswith("text/plain"))
+        text = response.body.decode()
+        self.assertIn('handler="StatusHandler"', text)
+        self.assertIn("camsrv_writer_backlog 0", text)
+
+    def test_latest_conditional(self):
+        self._app.latest_image = fits.PrimaryHDU(np.zeros((16, 16), dtype=np.uint16))
+        response = self.fetch("/latest")
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.body, self._app.latest_fits.data)
+        etag = response.headers["Etag"]
+
+        response = self.fetch("/latest", headers={"If-None-Match": etag})
+        self.assertEqual(response.code, 304)
+
+        modified = response.headers["Last-Modified"]
+        response = self.fetch("/latest", headers={"If-Modified-Since": modified})
+        self.assertEqual(response.code, 304)
+
+        # bad dates are ignored rather than failing the request
+        for bad in ("yesterday", "Mon, 99 Foo 2024 99:99:99 GMT"):
+            response = self.fetch("/latest", headers={"If-Modified-Since": bad})
+            self.assertEqual(response.code, 200)
+
+        self._app.latest_image = fits.PrimaryHDU(np.ones((16, 16), dtype=np.uint16))
+        response = self.fetch("/latest", headers={"If-None-Match": etag})
+        self.assertEqual(response.code, 200)
+        self.assertNotEqual(response.headers["Etag"], etag)
+
 
 class TestConnected(AsyncHTTPTestCase):
     def get_app(self):
@@ -34,6 +243,17 @@ class TestConnected(AsyncHTTPTestCase):
         response = self.fetch("/disconnect")
         self.assertEqual(response.code, 200)
 
+    def test_expose_async(self):
+        response = self.fetch("/expose?exptime=0.1")
+        self.assertEqual(response.code, 200)
+        expid = json.loads(response.body)["id"]
+        self.assertIsNotNone(expid)
+
+        response = self.fetch(f"/exposure?id={expid}&wait=20", request_timeout=30)
+        self.assertEqual(response.code, 200)
+        self.assertEqual(json.loads(response.body)["state"], "done")
+        self.assertIsNotNone(self._app.latest_image)
+
 
 class TestF9Srv(TestSimSrv):
     def get_app(self):
@@ -51,3 +271,23 @@ class TestRATSrv(TestSimSrv):
     def get_app(self):
         app = RATsrv(connect=False)
         return app
+
+
+class TestF5Srv(AsyncHTTPTestCase):
+    def get_app(self):
+        app = F5WFSsrv(connect=False)
+        return app
+
+    def test_msg(self):
+        # each app has its own connections, which aren't opened until they're used
+        self.assertIsNot(self._app.msg_pool, default_pool)
+        servers = {
+            self._app.wfscam.msg.address: "idle",
+            self._app.wfspower.msg.address: "idle",
+        }
+        health = json.loads(self.fetch("/msg").body)["connections"]
+        self.assertEqual({c["server"]: c["state"] for c in health}, servers)
+
+        text = self.fetch("/metrics").body.decode()
+        for server in servers:
+            self.assertIn(f'camsrv_msg_connected{{server="{server}"}} 0', text)
@@ -0,0 +1,116 @@
+"""
+Tests for picking exposure times from frame statistics
+"""
+
+import json
+
+import pytest
+from tornado.testing import AsyncHTTPTestCase
+
+from ..autoexposure import AutoExposure
+from ..loadtest import create_server
+from ..simulate import FakeCamera
+
+
+def stats(peak, saturated=0, background=1000.0, noise=10.0):
+    return {
+        "background": background,
+        "noise": noise,
+        "peak": peak,
+        "saturated": saturated,
+    }
+
+
+def test_next_exptime():
+    auto = AutoExposure(
+        target=30000.0, max_step=10.0, min_exptime=0.1, max_exptime=60.0
+    )
+    assert auto.next_exptime(1.0, stats(16000.0)) == pytest.approx(2.0)
+    assert auto.next_exptime(2.0, stats(61000.0)) == pytest.approx(1.0)
+
+    # saturated frames are cut by at least half, and steps and exposure times are clamped
+    saturated = stats(65535.0, saturated=10)
+    assert auto.next_exptime(2.0, saturated) == pytest.approx(0.93, abs=0.01)
+    assert auto.next_exptime(2.0, stats(40000.0, saturated=10)) == pytest.approx(1.0)
+    assert auto.next_exptime(1.0, stats(1010.0)) == pytest.approx(10.0)
+    assert auto.next_exptime(10.0, stats(1010.0)) == pytest.approx(60.0)
+    assert auto.next_exptime(0.15, saturated) == 0.1
+
+
+def test_converged():
+    auto = AutoExposure(target=30000.0, tolerance=0.1)
+    assert auto.converged(stats(32000.0))
+    assert not auto.converged(stats(36000.0))
+    assert not auto.converged(stats(32000.0, saturated=1))
+
+    assert auto.suggest(default=5.0) == 5.0
+    last = auto.update(1.0, stats(16000.0))
+    assert not last["converged"]
+    assert auto.suggest() == pytest.approx(2.0)
+
+
+def test_spot_flux():
+    auto = AutoExposure(target=1e5, metric="spot_flux")
+    assert auto.signal(dict(stats(5000.0), nspots=100, spot_flux=5e4)) == 5e4
+    # falls back to the peak if there are no spots
+    assert auto.signal(dict(stats(5000.0), nspots=0, spot_flux=0.0)) == 4000.0
+    with pytest.raises(ValueError):
+        AutoExposure(metric="bogus")
+
+
+class TestAutoExposure(AsyncHTTPTestCase):
+    def get_app(self):
+        app = create_server("sim", shape=(256, 256))
+        app.camera = FakeCamera(shape=(256, 256), rate=1e6)
+        app.default_exptime = 0.01
+        app.autoexposure.target = 30000.0
+        app.autoexposure.min_exptime = 0.001
+        app.bad_pixel_mask = None
+        return app
+
+    def test_expose_auto(self):
+        response = self.fetch("/expose?exptime=auto")
+        expid = json.loads(response.body)["id"]
+        response = self.fetch(f"/exposure?id={expid}&wait=10", request_timeout=20)
+        record = json.loads(response.body)
+        self.assertEqual(record["state"], "done")
+        self.assertTrue(record["converged"])
+        self.assertGreater(record["iterations"], 1)
+        self.assertAlmostEqual(record["exptime"], 0.03, places=2)
+
+        state = json.loads(self.fetch("/autoexposure").body)
+        self.assertTrue(state["last"]["converged"])
+        self.assertAlmostEqual(state["next_exptime"], 0.03, places=2)
+
+    def test_settings(self):
+        state = json.loads(
+            self.fetch("/autoexposure?target=20000&max_iterations=2").body
+        )
+        self.assertEqual(state["target"], 20000.0)
+        self.assertEqual(state["max_iterations"], 2)
+        self.assertIsNone(state["last"])
+        self.assertEqual(state["next_exptime"], 0.01)
+
+        response = self.fetch("/autoexposure?metric=bogus")
+        self.assertEqual(response.code, 400)
+
+    def expose(self, url):
+        expid = json.loads(self.fetch(url).body)["id"]
+        response = self.fetch(f"/exposure?id={expid}&wait=10", request_timeout=20)
+        return json.loads(response.body)
+
+    def test_auto_dark(self):
+        # a stale, unconverged light frame must not make darks be retaken
+        self._app.autoexposure.update(0.01, stats(1010.0))
+        record = self.expose("/expose?exptime=auto&exptype=Dark")
+        self.assertEqual(record["state"], "done")
+        self.assertEqual(record["iterations"], 1)
+        self.assertIsNone(record["converged"])
+
+    def test_auto_without_stats(self):
+        self._app.autoexposure.update(0.01, stats(1010.0))
+        self._app.measure_quality = lambda hdulist, saturated=None: None
+        record = self.expose("/expose?exptime=auto")
+        self.assertEqual(record["state"], "done")
+        self.assertEqual(record["iterations"], 1)
+        self.assertIsNone(record["converged"])
@@ -0,0 +1,164 @@
+"""
+Tests for the sparse bad pixel correction
+"""
+
+import numpy as np
+import pytest
+from tornado.testing import AsyncHTTPTestCase
+
+from ..badpix import (
+    BadPixelCorrector,
+    BadPixelMasks,
+    Geometry,
+    median_filter_correct,
+    readout_geometry,
+)
+from ..loadtest import create_server
+from ..simulate import FakeCamera
+
+
+@pytest.fixture
+def frame():
+    rng = np.random.default_rng(42)
+    im = rng.normal(1000.0, 10.0, (64, 64)).astype(np.float32)
+    mask = np.zeros(im.shape, dtype=bool)
+    mask[10, 10] = mask[10, 11] = mask[30, 40] = True
+    mask[0, 0] = mask[63, 5] = True
+    im[mask] = 60000.0
+    return im, mask
+
+
+def test_correct(frame):
+    im, mask = frame
+    corrector = BadPixelCorrector(mask)
+    assert corrector.npix == mask.sum()
+
+    out = corrector.correct(im.copy())
+    assert np.all(np.abs(out[mask] - 1000.0) < 50.0)
+    assert np.array_equal(out[~mask], im[~mask])
+
+
+def test_matches_median_filter(frame):
+    im, mask = frame
+    # with a flat background, excluding the bad pixels doesn't change the median
+    im[~mask] = 1000.0
+    ref = median_filter_correct(im.copy(), mask)
+    out = BadPixelCorrector(mask).correct(im.copy())
+    assert np.allclose(out[mask], ref[mask])
+
+
+def test_integer_and_edge_cases(frame):
+    im, mask = frame
+    im = im.astype(np.uint16)
+    out = BadPixelCorrector(mask).correct(im.copy())
+    assert out.dtype == np.uint16
+    assert out[mask].max() < 1100
+
+    # a pixel with no good neighbors is left alone
+    allbad = np.ones((3, 3), dtype=bool)
+    small = np.arange(9, dtype=np.float32).reshape(3, 3)
+    assert np.array_equal(BadPixelCorrector(allbad).correct(small.copy()), small)
+
+    with pytest.raises(ValueError):
+        BadPixelCorrector(mask).correct(np.zeros((32, 32)))
+
+
+def test_readout_geometry():
+    full = (64, 64)
+    assert readout_geometry((64, 64), full) == Geometry(0, 0, 64, 64, 1, 1)
+    assert readout_geometry((32, 32), full) is None
+
+    hdr = {"XBINNING": 2, "YBINNING": 2}
+    assert readout_geometry((32, 32), full, header=hdr) == Geometry(0, 0, 64, 64, 2, 2)
+
+    hdr = {"XBINNING": 3, "YBINNING": 3, "XORGSUBF": 2, "YORGSUBF": 1}
+    assert readout_geometry((10, 12), full, header=hdr) == Geometry(6, 3, 36, 30, 3, 3)
+
+    frame = {"X": 8, "Y": 4, "width": 16, "height": 16}
+    geom = readout_geometry((8, 8), full, frame=frame, binning={"X": 2, "Y": 2})
+    assert geom == Geometry(8, 4, 16, 16, 2, 2)
+
+    # window falls off the detector
+    assert readout_geometry((8, 8), full, frame={"X": 60, "Y": 0}) is None
+
+
+def test_derived_masks(frame):
+    _, mask = frame
+    masks = BadPixelMasks(mask, maxsize=2)
+
+    binned = masks.derive(Geometry(0, 0, 64, 64, 2, 2))
+    assert binned.shape == (32, 32)
+    assert binned[5, 5] and binned[15, 20] and binned[0, 0]
+    assert binned.sum() == 4
+
+    window = masks.derive(Geometry(8, 8, 32, 32, 1, 1))
+    assert window.shape == (32, 32)
+    assert window[2, 2] and window[2, 3]
+    assert window.sum() == 2
+
+    g1 = Geometry(0, 0, 64, 64, 2, 2)
+    g2 = Geometry(8, 8, 32, 32, 1, 1)
+    g3 = Geometry(0, 0, 64, 64, 1, 1)
+    c1 = masks.corrector(g1)
+    assert masks.corrector(g1) is c1
+    masks.corrector(g2)
+    masks.corrector(g3)
+    assert list(masks.cache) == [g2, g3]
+
+    im = np.full((32, 32), 1000.0, dtype=np.float32)
+    im[binned] = 60000.0
+    out = masks.corrector(g1).correct(im)
+    assert np.allclose(out, 1000.0)
+
+
+class QueriedCamera(FakeCamera):
+    """
+    FakeCamera that counts how often its readout configuration is read
+    """
+
+    def __init__(self, **kwargs):
+        self.queries = []
+        super().__init__(**kwargs)
+
+    @property
+    def frame(self):
+        self.queries.append("frame")
+        return {"X": 0, "Y": 0, "width": self.shape[1], "height": self.shape[0]}
+
+    @frame.setter
+    def frame(self, value):
+        pass
+
+    @property
+    def binning(self):
+        self.queries.append("binning")
+        return {"X": 1, "Y": 1}
+
+    @binning.setter
+    def binning(self, value):
+        pass
+
+
+class TestServerCorrection(AsyncHTTPTestCase):
+    def get_app(self):
+        app = create_server("sim", shape=(64, 64))
+        app.camera = QueriedCamera(shape=(64, 64))
+        app.bad_pixel_mask = np.zeros((64, 64), dtype=bool)
+        app.bad_pixel_mask[10, 10] = True
+        return app
+
+    def test_header_geometry(self):
+        app = self._app
+        im = np.full((32, 32), 1000.0, dtype=np.float32)
+        im[2, 2] = 60000.0
+        hdr = {"XBINNING": 1, "YBINNING": 1, "XORGSUBF": 8, "YORGSUBF": 8}
+        assert app.correct_bad_pixels(im, hdr) == 1
+        assert im[2, 2] == 1000.0
+        assert app.camera.queries == []
+
+        # the camera fills in whatever the header is missing
+        im = np.full((64, 64), 1000.0, dtype=np.float32)
+        im[10, 10] = 60000.0
+        assert app.correct_bad_pixels(im, {"XBINNING": 1, "YBINNING": 1}) == 1
+        assert im[10, 10] == 1000.0
+        assert app.camera.queries == ["frame"]
@@ -0,0 +1,184 @@
+"""
+Tests for the library of master biases and darks
+"""
+
+import json
+import tempfile
+
+import numpy as np
+import pytest
+from astropy.io import fits
+from tornado.testing import AsyncHTTPTestCase
+
+from ..calibration import CalibrationLibrary, frame_geometry
+from ..loadtest import create_server
+from ..simulate import FakeCamera
+
+
+def make_hdu(value, imagetyp="Light", exptime=1.0, temp=-10.0, shape=(16, 16), xbin=1):
+    hdu = fits.PrimaryHDU(np.full(shape, value, dtype=np.uint16))
+    hdu.header["IMAGETYP"] = imagetyp
+    hdu.header["EXPTIME"] = exptime
+    hdu.header["CCD-TEMP"] = temp
+    hdu.header["XBINNING"] = xbin
+    return hdu
+
+
+def build(library, value, imagetyp, **kwargs):
+    return library.build([make_hdu(value, imagetyp, **kwargs) for _ in range(3)])
+
+
+def test_calibrate(tmp_path):
+    library = CalibrationLibrary(tmp_path)
+    bias = build(library, 1000, "Bias Frame")
+    dark = build(library, 1100, "Dark Frame", exptime=10.0)
+    assert dark.biassub
+    assert np.all(library.data(dark) == 100.0)
+
+    # darks are scaled to the exposure time once the bias is subtracted
+    light = make_hdu(2000, exptime=5.0)
+    calibrated, used = library.calibrate(light.data, light.header, saturation=65535)
+    assert calibrated.dtype == np.float32
+    assert np.all(calibrated == 950.0)
+    assert used == {
+        "bias": bias.filename,
+        "dark": dark.filename,
+        "dark_scale": 0.5,
+        "saturated": 0,
+    }
+
+    # calibration frames themselves are left alone
+    assert (
+        library.calibrate(make_hdu(1000, "Bias").data, make_hdu(1000, "Bias").header)[0]
+        is None
+    )
+
+    # nothing matches a different binning
+    binned = make_hdu(2000, xbin=2)
+    assert library.calibrate(binned.data, binned.header) == (None, {})
+
+
+def test_find(tmp_path):
+    library = CalibrationLibrary(tmp_path, temperature_tolerance=2.0)
+    geometry = frame_geometry((16, 16), make_hdu(0).header)
+    darks = {t: build(library, 1100, "Dark", exptime=t) for t in (1.0, 10.0, 100.0)}
+    cold = build(library, 1100, "Dark", exptime=20.0, temp=-30.0)
+
+    assert library.find("dark", geometry, 2.0, -10.0) == darks[1.0]
+    assert library.find("dark", geometry, 5.0, -10.0) == darks[10.0]
+    assert library.find("dark", geometry, 1000.0, -10.0) == darks[100.0]
+    assert library.find("dark", geometry, 20.0, -10.0) == darks[10.0]
+    assert library.find("dark", geometry, 20.0, -29.0) == cold
+    assert library.find("dark", geometry, 20.0, 0.0) is None
+    assert library.find("bias", geometry) is None
+
+    # a dark that still includes the bias is only used at its own exposure time
+    light = make_hdu(2000, exptime=10.0)
+    calibrated, used = library.calibrate(light.data, light.header)
+    assert np.all(calibrated == 900.0)
+    assert "bias" not in used
+    light = make_hdu(2000, exptime=5.0)
+    assert library.calibrate(light.data, light.header) == (None, {})
+
+
+def test_find_usable_dark(tmp_path):
+    library = CalibrationLibrary(tmp_path)
+    # built before there was a bias, so it can only be used at 5s
+    build(library, 1100, "Dark", exptime=5.0)
+    bias = build(library, 1000, "Bias")
+    dark = build(library, 1200, "Dark", exptime=20.0)
+    assert dark.biassub
+
+    # the 5s dark is closer, but the 20s one is the only one that can be scaled to 6s
+    light = make_hdu(2000, exptime=6.0)
+    calibrated, used = library.calibrate(light.data, light.header)
+    assert used == {"bias": bias.filename, "dark": dark.filename, "dark_scale": 0.3}
+    assert np.allclose(calibrated, 940.0)
+
+
+def test_persistence(tmp_path):
+    library = CalibrationLibrary(tmp_path)
+    bias = build(library, 1000, "Bias")
+    dark = build(library, 1100, "Dark", exptime=10.0)
+    assert (tmp_path / "index.json").exists()
+
+    reopened = CalibrationLibrary(tmp_path)
+    assert len(reopened) == 2
+    assert reopened.nbytes == 0
+    geometry = frame_geometry((16, 16), make_hdu(0).header)
+    assert reopened.find("dark", geometry, 10.0, -10.0) == dark
+    assert np.all(reopened.data(bias) == 1000.0)
+
+    with pytest.raises(ValueError):
+        reopened.build([make_hdu(0, "Dark"), make_hdu(0, "Dark", exptime=2.0)])
+
+
+def test_memory(tmp_path):
+    nbytes = 16 * 16 * 4
+    library = CalibrationLibrary(tmp_path, maxbytes=2 * nbytes)
+    for t in (1.0, 2.0, 3.0, 4.0):
+        build(library, 1100, "Dark", exptime=t)
+    assert library.nbytes <= 2 * nbytes
+
+    # masters that aren't on disk are never dropped
+    library = CalibrationLibrary(maxbytes=2 * nbytes)
+    masters = [build(library, 1100, "Dark", exptime=t) for t in (1.0, 2.0, 3.0)]
+    assert all(np.all(library.data(m) == 1100.0) for m in masters)
+
+
+class TestCalibration(AsyncHTTPTestCase):
+    def get_app(self):
+        app = create_server("sim", shape=(64, 64))
+        app.camera = FakeCamera(shape=(64, 64))
+        app.bad_pixel_mask = None
+        app.calibration.open(self.tmp_path)
+        return app
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.tmp_path = self.tmpdir.name
+        super().setUp()
+
+    def tearDown(self):
+        super().tearDown()
+        self.tmpdir.cleanup()
+
+    def take(self, nframes, exptype, exptime):
+        self.fetch(f"/sequence?nframes={nframes}&exptype={exptype}&exptime={exptime}")
+        response = self.fetch("/sequence/status?wait=10", request_timeout=20)
+        self.assertEqual(json.loads(response.body)["state"], "done")
+
+    def test_build_and_apply(self):
+        self.assertEqual(self.fetch("/calibration/build?kind=bias").code, 404)
+        self.assertEqual(self.fetch("/calibration/build?kind=flat").code, 400)
+
+        self.take(3, "Bias", 0.0)
+        self.take(3, "Dark", 0.02)
+        bias = json.loads(self.fetch("/calibration/build?kind=bias&nframes=3").body)
+        self.assertEqual(bias["ncombine"], 3)
+        dark = json.loads(self.fetch("/calibration/build?kind=dark").body)
+        self.assertTrue(dark["biassub"])
+        self.assertEqual(dark["exptime"], 0.02)
+
+        # calibration replaces the raw data so it has to be turned on
+        info = json.loads(self.fetch("/calibration").body)
+        self.assertFalse(info["enabled"])
+        self.take(1, "Light", 0.01)
+        self.assertNotIn("BIASFILE", self._app.latest_image.header)
+
+        info = json.loads(self.fetch("/calibration?enabled=1").body)
+        self.assertTrue(info["enabled"])
+        self.assertEqual(len(info["masters"]), 2)
+
+        self.take(1, "Light", 0.01)
+        header = self._app.latest_image.header
+        self.assertEqual(header["BIASFILE"], bias["filename"])
+        self.assertEqual(header["DARKFILE"], dark["filename"])
+        self.assertAlmostEqual(header["DARKSCAL"], 0.5)
+
+        # the simulated frames have a 1000 ADU bias level and no dark current
+        self.fetch("/calibration?enabled=0")
+        self.take(1, "Light", 0.01)
+        raw_header = self._app.latest_image.header
+        self.assertNotIn("BIASFILE", raw_header)
+        self.assertAlmostEqual(raw_header["BKGND"] - header["BKGND"], 1000.0, delta=5.0)
@@ -0,0 +1,88 @@
+"""
+Tests for the F/5 WFS camera's MSG client against a local fake MSG server
+"""
+
+import asyncio
+
+from tornado.testing import AsyncTestCase, gen_test
+
+from ..f5wfs_camera import CamState, Cooler, ExpType, F5WFS_Cam, MSGError
+from ..msg import MSGPool
+from ..simulate import FakeMSGCamera
+
+
+class TestF5WFSCam(AsyncTestCase):
+    async def connect(self, **kwargs):
+        self.server = FakeMSGCamera(shape=(64, 64), **kwargs)
+        port = await self.server.start()
+        self.pool = MSGPool()
+        return F5WFS_Cam(
+            host="127.0.0.1", port=port, poll_interval=0.02, pool=self.pool
+        )
+
+    async def close(self, cam):
+        await self.pool.close()
+        await self.server.stop()
+
+    @gen_test
+    async def test_status(self):
+        cam = await self.connect()
+        status = await cam.status()
+        self.assertEqual(status["state"], CamState.Idle)
+        self.assertEqual(status["temperature"], -20.0)
+        self.assertEqual(await cam.setpoint, -20)
+        self.assertTrue(await cam.cooler(Cooler.on))
+        self.assertEqual(self.server.requests["get"], 5)
+        await self.close(cam)
+
+    @gen_test(timeout=10)
+    async def test_expose(self):
+        cam = await self.connect()
+        progress = []
+        hdulist = await cam.expose(
+            1.5,
+            exptype=ExpType.dark,
+            progress=lambda n, total: progress.append((n, total)),
+        )
+        self.assertEqual(hdulist[0].data.shape, (64, 64))
+        self.assertEqual(hdulist[0].header["CAMTEMP"], -20.0)
+        self.assertEqual(hdulist[0].header["CAMSETP"], -20)
+        self.assertEqual(progress[-1][0], progress[-1][1])
+        self.assertEqual(self.server.state, "Idle")
+
+        # the timer lets us sleep through the exposure instead of polling throughout it
+        self.assertLess(self.server.requests["get"], 2 * 10)
+        await self.close(cam)
+
+    @gen_test
+    async def test_timeout(self):
+        cam = await self.connect()
+        with self.assertRaises(asyncio.TimeoutError):
+            await cam.expose(5.0, timeout=0.2)
+        self.assertEqual(self.server.requests["abort"], 1)
+        self.assertEqual(self.server.state, "Idle")
+
+        # the connection is still usable afterwards
+        self.assertEqual(await cam.state, CamState.Idle)
+        await self.close(cam)
+
+    @gen_test
+    async def test_cancel(self):
+        cam = await self.connect()
+        task = asyncio.ensure_future(cam.expose(5.0))
+        await asyncio.sleep(0.2)
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+        self.assertEqual(self.server.requests["abort"], 1)
+        self.assertEqual(self.server.state, "Idle")
+        await self.close(cam)
+
+    @gen_test
+    async def test_rejected(self):
+        cam = await self.connect(reject={"expose"})
+        with self.assertRaises(MSGError):
+            await cam.expose(0.1)
+        self.assertEqual(self.server.requests["idle"], 1)
+        self.assertFalse(await cam.run("expose", 0, "light", 1.0))
+        await self.close(cam)
@@ -0,0 +1,60 @@
+"""
+Tests for the in-memory ring buffer of recent frames
+"""
+
+import numpy as np
+from astropy.io import fits
+
+from ..frames import FrameBuffer, frame_nbytes
+
+
+def make_hdu(value, shape=(32, 32)):
+    return fits.PrimaryHDU(np.full(shape, value, dtype=np.uint16))
+
+
+def test_eviction():
+    nbytes = frame_nbytes(make_hdu(0))
+    frames = FrameBuffer(maxframes=10, maxbytes=3 * nbytes)
+    for i in range(5):
+        frames.add(make_hdu(i), filename=f"/data/test_{i}.fits", timestamp=100.0 + i)
+
+    # limited by memory rather than frame count
+    assert len(frames) == 3
+    assert frames.nbytes == 3 * nbytes
+    assert frames.get(2) is None
+    assert frames.by_filename("test_1.fits") is None
+    assert frames.back(0).id == 5
+    assert frames.back(2).id == 3
+    assert frames.back(3) is None
+
+    frames.maxframes = 2
+    frames.add(make_hdu(5))
+    assert [f["id"] for f in frames.summary()] == [5, 6]
+
+    # the newest frame is kept even if it's too big on its own
+    frames.add(make_hdu(6, shape=(64, 64)))
+    assert len(frames) == 1
+
+    frames.maxframes = 10
+    frames.maxbytes = 100 * nbytes
+    frames.add(make_hdu(7))
+    assert frames.clear(keep=1) > 0
+    assert frames.back(0).id == 8
+    assert frames.clear() > 0
+    assert len(frames) == 0
+    assert frames.nbytes == 0
+
+
+def test_lookup():
+    frames = FrameBuffer()
+    for i in range(3):
+        frames.add(make_hdu(i), filename=f"/data/test_{i}.fits", timestamp=100.0 + i)
+
+    assert frames.by_filename("/elsewhere/test_1.fits").id == 2
+    assert frames.at_time(99.0) is None
+    assert frames.at_time(101.5).id == 2
+    assert frames.at_time(200.0).id == 3
+
+    summary = frames.summary(summary_keys=["NAXIS1", "FILTER"])
+    assert summary[0]["filename"] == "test_0.fits"
+    assert summary[0]["header"] == {"NAXIS1": 32}
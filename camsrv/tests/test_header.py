@@ -0,0 +1,201 @@
+"""
+Tests for filling in image headers from telemetry, using a local stand-in for the MMTO API
+"""
+
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from ..header import (
+    HEADER_CARDS,
+    HEADER_MAP,
+    TelemetryCache,
+    build_cards,
+    get_api,
+    get_redis,
+    get_redis_keys,
+    update_header,
+)
+
+
+class StubAPIHandler(BaseHTTPRequestHandler):
+    """
+    Minimal stand-in for APIv1 that returns a fixed value for every key
+    """
+
+    def do_GET(self):
+        self.reply(sorted(HEADER_MAP.keys()))
+
+    def do_POST(self):
+        self.server.nrequests += 1
+        length = int(self.headers["Content-Length"])
+        body = self.rfile.read(length).decode()
+        # urllib3 sends the keys as a multipart form field
+        keys = body.split("\r\n\r\n")[1].split("\r\n")[0].split(",")
+        self.reply({k: self.server.value for k in keys if k not in self.server.omit})
+
+    def reply(self, data):
+        payload = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def api():
+    server = HTTPServer(("127.0.0.1", 0), StubAPIHandler)
+    server.nrequests = 0
+    server.value = "1.5"
+    server.omit = set()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server, f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+    server.server_close()
+
+
+def test_get_api(api):
+    _, host = api
+    data = get_api(["mount_mini_ra", "ds_outside_temp"], host=host)
+    assert data == {"mount_mini_ra": "1.5", "ds_outside_temp": "1.5"}
+
+
+def test_cache_refresh(api):
+    server, host = api
+    cache = TelemetryCache(host=host)
+    values, ages = cache.snapshot()
+    assert len(values) == 0
+    assert all(a is None for a in ages.values())
+
+    cache.refresh_due()
+    values, ages = cache.snapshot()
+    assert len(values) == len(HEADER_MAP)
+    assert server.nrequests == len(cache.groups)
+
+    # nothing is due right after a refresh so no more requests are made
+    cache.refresh_due()
+    assert server.nrequests == len(cache.groups)
+
+
+def test_cache_stale_fallback(api):
+    server, host = api
+    cache = TelemetryCache(host=host, max_age=60.0, autostart=False)
+    cache.refresh()
+    nreqs = server.nrequests
+
+    cache.get()
+    assert server.nrequests == nreqs
+
+    # age the mount values past max_age so only they are fetched synchronously
+    server.value = "2.5"
+    for k in cache.groups["mount"]:
+        cache.timestamps[k] -= 100.0
+    values, ages = cache.get()
+    assert server.nrequests == nreqs + 1
+    assert values["mount_mini_ra"] == "2.5"
+    assert values["ds_outside_temp"] == "1.5"
+    assert ages["mount_mini_ra"] < 60.0
+
+
+def test_cache_missing_keys(api):
+    server, host = api
+    server.omit = {"mount_mini_ra"}
+    cache = TelemetryCache(host=host, max_age=60.0)
+    values, ages = cache.get()
+    assert "mount_mini_ra" not in values
+    assert ages["mount_mini_ra"] is None
+    nreqs = server.nrequests
+
+    # keys the API doesn't return aren't asked for again until max_age has passed
+    cache.get()
+    assert server.nrequests == nreqs
+    assert not cache.running
+
+    server.omit = set()
+    cache.missing["mount_mini_ra"] -= 100.0
+    values, ages = cache.get()
+    assert server.nrequests == nreqs + 1
+    assert values["mount_mini_ra"] == "1.5"
+
+
+def test_cache_thread(api):
+    _, host = api
+    cache = TelemetryCache(host=host)
+    cache.start()
+    try:
+        assert cache.running
+        values, ages = cache.get()
+        assert len(values) == len(HEADER_MAP)
+    finally:
+        cache.stop()
+    assert not cache.running
+
+
+def test_update_header_from_cache(api):
+    _, host = api
+    cache = TelemetryCache(host=host, autostart=False)
+    cache.refresh()
+
+    hdulist = fits.HDUList([fits.PrimaryHDU(np.zeros((8, 8), dtype=np.uint16))])
+    hdulist = update_header(hdulist, telemetry=cache)
+    hdr = hdulist[0].header
+    assert hdr["RA"] == 1.5
+    assert hdr["TELAGE"] >= 0.0
+
+    # updating again replaces the cards rather than appending duplicates
+    nkeys = len(hdr)
+    update_header(hdulist, telemetry=cache)
+    assert len(hdulist[0].header) == nkeys
+
+
+def test_header_cards():
+    assert len(HEADER_CARDS) == len(HEADER_MAP)
+
+    data = {
+        "mount_mini_ra": "12:30:36.0",
+        "mount_mini_declination": "-00:30:00",
+        "mount_mini_cat_id": "HD 1234",
+        "mount_mini_airmass": "1.25",
+        "ds_outside_rh": "15",
+        "ds_outside_temp": "nan",
+    }
+    cards = {c[0]: c for c in build_cards(data)}
+    assert len(cards) == len(data)
+    assert cards["RA"][1] == pytest.approx(12.51)
+    assert cards["RA"][2] == "[hourangle] Object RA"
+    assert cards["DEC"][1] == pytest.approx(-0.5)
+    assert cards["CATID"][1] == "HD 1234"
+    assert cards["AIRMASS"][1] == 1.25
+    assert cards["OUT_RH"][1] == 15.0
+    assert isinstance(cards["OUT_RH"][1], float)
+    assert cards["OUT_T"][1] == "nan"
+
+
+def test_redis_backend():
+    fakeredis = pytest.importorskip("fakeredis")
+    r = fakeredis.FakeStrictRedis()
+    r.mset({k: "3.5" for k in HEADER_MAP})
+    r.set("unrelated_key", "foo")
+
+    keys = get_redis_keys(r=r, pattern="mount_*")
+    assert keys == sorted(k for k in HEADER_MAP if k.startswith("mount_"))
+
+    data = get_redis(["mount_mini_ra", "not_a_key"], r=r)
+    assert data == {"mount_mini_ra": "3.5"}
+
+    cache = TelemetryCache(backend="redis", redis_client=r, autostart=False)
+    values, _ = cache.get()
+    assert len(values) == len(HEADER_MAP)
+    assert values["ds_outside_temp"] == "3.5"
+
+    with pytest.raises(ValueError):
+        TelemetryCache(backend="carrier_pigeon")
@@ -0,0 +1,67 @@
+"""
+Tests for reading FITS BLOBs straight into NumPy
+"""
+
+import io
+
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from ..ingest import RawImage, read_blob
+
+
+def make_blob(data, **cards):
+    hdu = fits.PrimaryHDU(data)
+    for k, v in cards.items():
+        hdu.header[k] = v
+    out = io.BytesIO()
+    hdu.writeto(out)
+    return out.getvalue()
+
+
+@pytest.mark.parametrize("dtype", [np.uint16, np.int16, np.int32, np.float32])
+@pytest.mark.parametrize("writeable", [False, True])
+def test_roundtrip(dtype, writeable):
+    data = (np.arange(40 * 30) % 1000).reshape(40, 30).astype(dtype)
+    blob = make_blob(data, EXPTIME=2.0)
+    buf = bytearray(blob) if writeable else blob
+
+    raw = RawImage(buf)
+    assert raw.in_place == writeable
+    assert raw.data.dtype == dtype
+    assert raw.data.dtype.isnative
+    assert np.array_equal(raw.data, data)
+    assert raw.hdu.header["EXPTIME"] == 2.0
+    if writeable:
+        assert np.shares_memory(raw.data, np.frombuffer(buf, dtype=np.uint8))
+
+    raw.hdu.header["FILTER"] = "none"
+    with fits.open(io.BytesIO(raw.tobytes())) as hdulist:
+        assert np.array_equal(hdulist[0].data, data)
+        assert hdulist[0].header["FILTER"] == "none"
+
+    raw.data[0, 0] = 7
+    raw.modified = True
+    assert fits.getdata(io.BytesIO(raw.tobytes()))[0, 0] == 7
+
+
+def test_unmodified_data_reused():
+    data = np.arange(100, dtype=np.uint16).reshape(10, 10)
+    blob = make_blob(data)
+    raw = RawImage(blob)
+    raw.hdu.header["OBJECT"] = "test"
+    out = raw.tobytes()
+    # the data section is copied over byte for byte
+    assert out[-2880:] == blob[-2880:]
+
+
+def test_fallback():
+    data = np.arange(100, dtype=np.int16).reshape(10, 10)
+    blob = make_blob(data, BSCALE=2.0)
+    hdulist, raw = read_blob(blob)
+    assert raw is None
+    assert hdulist[0].data.shape == (10, 10)
+
+    with pytest.raises(ValueError):
+        RawImage(blob[:2880] + blob[2880:2900])
@@ -0,0 +1,106 @@
+"""
+Tests for the simulated camera and load-test harness
+"""
+
+import json
+
+import pytest
+from tornado.testing import AsyncHTTPTestCase, gen_test
+
+from ..loadtest import create_server, parse_mix, run_load, summarize
+from ..simulate import BlobFeed, FakeCamera, make_frame, offline_telemetry
+
+
+def test_fake_camera():
+    camera = FakeCamera(shape=(64, 32))
+    hdulist = camera.expose(exptime=0.0, exptype="Dark")
+    assert hdulist[0].data.shape == (64, 32)
+    assert hdulist[0].header["IMAGETYP"] == "Dark"
+    assert camera.nexposures == 1
+
+
+def test_make_frame():
+    hdu = make_frame((128, 128), seed=1)
+    assert hdu.data.dtype.name == "uint16"
+    assert hdu.data.max() > hdu.data.min() + 1000
+    assert (make_frame((128, 128), seed=1).data == hdu.data).all()
+
+
+def test_offline_telemetry():
+    telemetry = offline_telemetry()
+    data = telemetry.refresh()
+    assert len(data) == len(telemetry.keys)
+    assert len(telemetry.values) == len(telemetry.keys)
+
+
+def test_parse_mix():
+    assert parse_mix("status=10,latest") == {"status": 10.0, "latest": 1.0}
+    with pytest.raises(ValueError):
+        parse_mix("status=1,bogus=2")
+
+
+def test_summarize():
+    results = [("status", 0.001, 200), ("status", 0.003, 200), ("latest", 0.01, 404)]
+    results.append(("expose", 0.002, 409))
+    summary = summarize(results, duration=1.0)
+    assert summary["all"]["requests"] == 4
+    assert summary["all"]["errors"] == 1
+    assert summary["status"]["rate"] == 2.0
+    assert summary["status"]["max"] == pytest.approx(3.0)
+
+
+class TestLoad(AsyncHTTPTestCase):
+    def get_app(self):
+        app = create_server("sim", shape=(64, 64))
+        self.feed = BlobFeed(app, shape=(64, 64), interval=0.05, nframes=2)
+        return app
+
+    def test_blob_feed(self):
+        hdulist = self.io_loop.run_sync(self.feed.send)
+        self.assertEqual(self.feed.nsent, 1)
+        self.assertIs(self._app.latest_image, hdulist[0])
+        self.assertIsNotNone(self._app.latest_image)
+        self.assertEqual(len(self._app.frames), 1)
+
+        response = self.fetch("/latest")
+        self.assertEqual(response.code, 200)
+
+        # BLOBs are read in the processing thread and failures are logged, not raised
+        self.assertIsNone(
+            self.io_loop.run_sync(lambda: self._app.receive_blob(b"not a FITS file"))
+        )
+
+    def test_expose(self):
+        response = self.fetch("/expose?exptime=0.5")
+        self.assertEqual(response.code, 200)
+        expid = json.loads(response.body)["id"]
+
+        # exposures aren't queued up behind one that is in progress
+        response = self.fetch("/expose?exptime=0.01")
+        self.assertEqual(response.code, 409)
+        self.assertEqual(json.loads(response.body)["id"], expid)
+
+        response = self.fetch(f"/exposure?id={expid}&wait=10", request_timeout=20)
+        self.assertEqual(json.loads(response.body)["state"], "done")
+        camera_time = self._app.camera_time
+        self.assertEqual(camera_time.count(op="expose"), 1)
+        self.assertEqual(camera_time.count(op="readout"), 1)
+        self.assertEqual(self.fetch("/expose?exptime=0.01").code, 200)
+
+        self.assertEqual(self.fetch("/expose?exptime=abc").code, 400)
+        self.assertEqual(self.fetch("/exposure?id=abc").code, 400)
+        self.assertEqual(self.fetch("/exposure?wait=x").code, 400)
+
+    @gen_test(timeout=30)
+    async def test_run_load(self):
+        self.feed.send()
+        self.feed.start()
+        mix = parse_mix("status=4,latest=2,preview=1,static=1,metrics=1,expose=1")
+        try:
+            results = await run_load(
+                self.get_url(""), mix, duration=1.0, concurrency=4, exptime=0.01
+            )
+        finally:
+            self.feed.stop()
+        self.assertGreater(len(results), 0)
+        self.assertEqual([r for r in results if r[2] >= 400 and r[2] != 409], [])
@@ -0,0 +1,56 @@
+"""
+Tests for memory sampling, snapshot diffs, and the soft memory limit
+"""
+
+import tracemalloc
+
+import numpy as np
+import pytest
+
+from ..memory import MemoryMonitor, numpy_bytes, rss_bytes
+
+
+def test_sample():
+    assert rss_bytes() > 0
+
+    freed = []
+    monitor = MemoryMonitor(
+        soft_limit=1, on_limit=lambda: freed.append(10) or 10, cached_bytes=lambda: 5
+    )
+    sample = monitor.sample()
+    assert sample["rss"] > 0
+    assert sample["cached"] == 5
+    assert sample["freed"] == 10
+    assert freed == [10]
+
+    stats = monitor.stats()
+    assert stats["limited"] == 1
+    assert stats["freed"] == 10
+    assert stats["latest"] is sample
+
+    # no limit, nothing freed
+    monitor = MemoryMonitor(on_limit=lambda: 1 / 0)
+    assert "freed" not in monitor.sample()
+
+
+def test_snapshots():
+    monitor = MemoryMonitor(maxsnapshots=2)
+    was_tracing = tracemalloc.is_tracing()
+    if not was_tracing:
+        with pytest.raises(RuntimeError):
+            monitor.take_snapshot()
+        tracemalloc.start(5)
+    try:
+        old = monitor.take_snapshot()
+        hog = np.ones(2**20)
+        assert numpy_bytes() >= hog.nbytes
+        diff = monitor.compare(old, nlines=5)
+        assert f"snapshots {old} and {old + 1}" in diff
+        assert "numpy" in diff
+
+        monitor.take_snapshot()
+        with pytest.raises(KeyError):
+            monitor.compare(old)
+    finally:
+        if not was_tracing:
+            tracemalloc.stop()
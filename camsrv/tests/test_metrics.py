@@ -0,0 +1,42 @@
+"""
+Tests for the Prometheus text format metrics
+"""
+
+from ..metrics import MetricsRegistry
+
+
+def test_render():
+    metrics = MetricsRegistry(prefix="test")
+    hist = metrics.histogram("stage_seconds", "Stage timings", buckets=(0.1, 1.0))
+    hist.observe(0.05, stage="header")
+    hist.observe(0.5, stage="header")
+    hist.observe(5.0, stage="header")
+    with hist.time(stage="correct"):
+        pass
+
+    counter = metrics.counter("images_total", "Images")
+    counter.inc(source="blob")
+    counter.inc(2, source="blob")
+    assert counter.get(source="blob") == 3
+
+    metrics.gauge("backlog", "Queue depth", func=lambda: 4)
+    metrics.gauge("broken", "Raises", func=lambda: 1 / 0)
+    metrics.gauge("labeled", "Labels", func=lambda: {(("queue", 'a"b'),): 1.5})
+
+    # metrics are only registered once per name
+    assert metrics.counter("images_total", "Images") is counter
+
+    text = metrics.render()
+    lines = text.splitlines()
+    assert "# TYPE test_stage_seconds histogram" in lines
+    assert 'test_stage_seconds_bucket{stage="header",le="0.1"} 1' in lines
+    assert 'test_stage_seconds_bucket{stage="header",le="1.0"} 2' in lines
+    assert 'test_stage_seconds_bucket{stage="header",le="+Inf"} 3' in lines
+    assert 'test_stage_seconds_count{stage="header"} 3' in lines
+    assert 'test_stage_seconds_sum{stage="header"} 5.55' in lines
+    assert hist.count(stage="correct") == 1
+    assert 'test_images_total{source="blob"} 3' in lines
+    assert "test_backlog 4" in lines
+    assert "# TYPE test_broken gauge" in lines
+    assert 'test_labeled{queue="a\\"b"} 1.5' in lines
+    assert text.endswith("\n")
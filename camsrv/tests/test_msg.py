@@ -0,0 +1,85 @@
+"""
+Tests for the shared MSG connections against a local fake MSG server
+"""
+
+import asyncio
+
+from tornado.testing import AsyncTestCase, gen_test
+
+from ..metrics import Histogram
+from ..msg import MSGDevice, MSGError, MSGPool
+from ..simulate import FakeMSGCamera
+
+
+class TestMSGConnection(AsyncTestCase):
+    async def start(self, **options):
+        self.server = FakeMSGCamera(shape=(32, 32))
+        port = await self.server.start()
+        self.pool = MSGPool(min_backoff=0.01, max_backoff=0.05, **options)
+        return MSGDevice(host="127.0.0.1", port=port, pool=self.pool)
+
+    async def stop(self):
+        await self.pool.close()
+        await self.server.stop()
+
+    @gen_test
+    async def test_shared(self):
+        request_time = Histogram("msg_request_seconds", "MSG round trips")
+        device = await self.start(request_time=request_time)
+        other = MSGDevice(host="127.0.0.1", port=self.server.port, pool=self.pool)
+        self.assertIs(device.msg, other.msg)
+
+        # concurrent requests are multiplexed over one connection
+        temps = await asyncio.gather(*(d.get("temp") for d in [device, other] * 10))
+        self.assertEqual(temps, ["-20.0"] * 20)
+        self.assertEqual(self.server.nconnections, 1)
+        self.assertTrue(device.connected)
+
+        self.assertTrue(await device.run("idle"))
+        self.assertFalse(await device.run("bogus"))
+        with self.assertRaises(MSGError):
+            await device.request(("bogus",))
+
+        progress = []
+        data = await device.msg.fetch(
+            ("fits", 0, 0), progress=lambda n, total: progress.append(n)
+        )
+        self.assertEqual(len(data), progress[-1])
+        self.assertEqual(await device.get("state"), "Idle")
+
+        # one round trip is recorded per request, however many commands it carries
+        self.assertEqual(request_time.count(server=device.msg.address), 25)
+        await self.stop()
+
+    @gen_test
+    async def test_reconnect(self):
+        device = await self.start()
+        self.assertEqual(await device.get("state"), "Idle")
+
+        await self.server.stop()
+        with self.assertRaises(ConnectionError):
+            await device.get("state")
+
+        await asyncio.sleep(0.1)
+        health = self.pool.health()[0]
+        self.assertFalse(health["connected"])
+        self.assertGreater(health["failures"], 0)
+        self.assertIn(health["state"], ("connecting", "backoff"))
+
+        await self.server.start()
+        self.assertEqual(await device.get("state"), "Idle")
+        health = self.pool.health()[0]
+        self.assertTrue(health["connected"])
+        self.assertEqual(health["connects"], 2)
+        self.assertEqual(health["backoff"], 0.01)
+        await self.stop()
+
+    @gen_test
+    async def test_not_connected(self):
+        pool = MSGPool(timeout=0.1, min_backoff=0.01)
+        device = MSGDevice(host="127.0.0.1", port=1, pool=pool)
+        with self.assertRaises(ConnectionError):
+            await device.get("state")
+        self.assertGreater(pool.health()[0]["failures"], 0)
+        await pool.close()
+        self.assertEqual(pool.health()[0]["state"], "idle")
@@ -0,0 +1,70 @@
+"""
+Tests for making preview images
+"""
+
+import struct
+import zlib
+
+import numpy as np
+import pytest
+
+from ..preview import bin_image, check_preview_args, make_preview, stretch_image
+
+
+def test_bin_image():
+    im = np.arange(36, dtype=np.float32).reshape(6, 6)
+    binned = bin_image(im, 2)
+    assert binned.shape == (3, 3)
+    assert binned[0, 0] == pytest.approx(np.mean([0, 1, 6, 7]))
+
+    # leftover rows and columns are dropped
+    assert bin_image(im, 4).shape == (1, 1)
+    assert bin_image(im, 1).shape == (6, 6)
+
+
+def test_stretch():
+    im = np.linspace(0.0, 1000.0, 100 * 100).reshape(100, 100)
+    im[0, 0] = np.nan
+    for stretch in ["zscale", "minmax", "99"]:
+        out = stretch_image(im, stretch=stretch)
+        assert out.dtype == np.uint8
+        assert out.min() == 0
+        assert out.max() > 250
+
+    flat = stretch_image(np.ones((10, 10)), stretch="minmax")
+    assert np.all(flat == 0)
+
+
+def test_png():
+    im = np.random.default_rng(0).normal(1000.0, 10.0, (200, 300))
+    png = make_preview(im, size=100)
+    assert png.startswith(b"\x89PNG\r\n\x1a\n")
+
+    width, height = struct.unpack(">II", png[16:24])
+    assert (height, width) == (66, 100)
+
+    # pull out the pixels and check they're the flipped, stretched image
+    length = struct.unpack(">I", png[33:37])[0]
+    raw = zlib.decompress(png[41:][:length])
+    pixels = np.frombuffer(raw, dtype=np.uint8).reshape(height, width + 1)
+    assert np.all(pixels[:, 0] == 0)
+    expected = stretch_image(bin_image(im, 3))[::-1]
+    assert np.array_equal(pixels[:, 1:], expected)
+
+    with pytest.raises(ValueError):
+        make_preview(im, fmt="gif")
+
+
+def test_check_preview_args():
+    assert check_preview_args("256", "zscale", "png") == (256, "zscale")
+    assert check_preview_args(512, "99.5") == (512, "99.5")
+    for args in [
+        ("abc", "zscale"),
+        ("8", "zscale"),
+        ("100000", "zscale"),
+        ("256", "foo"),
+        ("256", "0"),
+        ("256", "zscale", "bmp"),
+    ]:
+        with pytest.raises(ValueError):
+            check_preview_args(*args)
@@ -0,0 +1,48 @@
+"""
+Tests for the frame quality statistics
+"""
+
+import numpy as np
+from astropy.io import fits
+
+from ..quality import add_header_cards, clipped_stats, count_spots, frame_stats
+from ..simulate import make_frame
+
+
+def test_clipped_stats():
+    rng = np.random.default_rng(0)
+    im = rng.normal(500.0, 5.0, (1024, 1024))
+    im[::50, ::50] = 60000.0
+    background, noise = clipped_stats(im)
+    assert abs(background - 500.0) < 0.5
+    assert abs(noise - 5.0) < 0.5
+
+
+def test_count_spots():
+    im = make_frame((256, 256), nspots=100, seed=0).data
+    nspots, flux = count_spots(im, 1000.0, 10.0)
+    assert nspots == 100
+    assert flux > 0
+
+    # isolated hot pixels aren't spots
+    im = np.full((64, 64), 1000, dtype=np.uint16)
+    im[10, 10] = im[40, 40] = 5000
+    assert count_spots(im, 1000.0, 10.0) == (0, 0.0)
+
+
+def test_frame_stats():
+    im = make_frame((256, 256), nspots=100, seed=0).data
+    stats = frame_stats(im, spots=True)
+    assert stats["nspots"] == 100
+    assert stats["saturated"] == 0
+
+    im[0, :10] = 65535
+    stats = frame_stats(im)
+    assert stats["saturated"] == 10
+    assert stats["peak"] == 65535
+    assert "nspots" not in stats
+
+    header = add_header_cards(fits.Header(), stats)
+    assert "NSPOTS" not in header
+    assert header["NSATPIX"] == 10
+    assert abs(header["BKGND"] - 1000.0) <= 1.0
@@ -0,0 +1,97 @@
+"""
+Tests for server-side exposure sequences
+"""
+
+import asyncio
+import json
+import time
+
+from tornado.testing import AsyncHTTPTestCase
+
+from ..loadtest import create_server
+from ..simulate import FakeCamera
+
+
+class TestSequence(AsyncHTTPTestCase):
+    def get_app(self):
+        app = create_server("sim", shape=(64, 64))
+        app.camera = FakeCamera(shape=(64, 64), readout_time=0.05)
+        app.bad_pixel_mask = None
+
+        # log when each exposure and processing step runs so overlaps can be checked
+        self.intervals = {"expose": [], "process": []}
+        expose, process_image = app._expose, app.process_image
+
+        def timed(name, func):
+            def wrapper(*args):
+                start = time.monotonic()
+                try:
+                    return func(*args)
+                finally:
+                    self.intervals[name].append((start, time.monotonic()))
+
+            return wrapper
+
+        def slow_process(hdulist):
+            time.sleep(0.1)
+            return process_image(hdulist)
+
+        app._expose = timed("expose", expose)
+        app.process_image = timed("process", slow_process)
+        return app
+
+    def wait(self, seconds=10):
+        response = self.fetch(
+            f"/sequence/status?wait={seconds}", request_timeout=seconds + 10
+        )
+        return json.loads(response.body)
+
+    def test_sequence(self):
+        response = self.fetch("/sequence?nframes=4&exptime=0.1")
+        self.assertEqual(response.code, 200)
+        self.assertEqual(json.loads(response.body)["nframes"], 4)
+
+        # only one sequence at a time
+        response = self.fetch("/sequence?nframes=1&exptime=0.1")
+        self.assertEqual(response.code, 409)
+
+        record = self.wait()
+        self.assertEqual(record["state"], "done")
+        self.assertEqual(record["nexposed"], 4)
+        self.assertEqual(record["nprocessed"], 4)
+        self.assertGreater(record["frames_per_hour"], 0)
+        self.assertEqual(len(self._app.frames), 4)
+
+        # frames are processed while the next one is exposing
+        expose, process = self.intervals["expose"], self.intervals["process"]
+        for (pstart, pend), (estart, eend) in zip(process[:-1], expose[1:]):
+            self.assertLess(estart, pend)
+
+    def test_stop(self):
+        response = self.fetch("/sequence?exptime=0.1")
+        self.assertEqual(json.loads(response.body)["nframes"], 0)
+        self.io_loop.run_sync(lambda: asyncio.sleep(0.5))
+
+        response = self.fetch("/sequence/stop")
+        self.assertEqual(json.loads(response.body)["state"], "stopping")
+        record = self.wait()
+        self.assertEqual(record["state"], "stopped")
+        self.assertGreater(record["nexposed"], 0)
+        self.assertEqual(record["nprocessed"], record["nexposed"])
+
+        response = self.fetch("/sequence?nframes=bogus")
+        self.assertEqual(response.code, 400)
+
+    def test_exposure_in_progress(self):
+        response = self.fetch("/expose?exptime=0.5")
+        expid = json.loads(response.body)["id"]
+
+        # the sequence would only have waited behind the exposure
+        response = self.fetch("/sequence?nframes=1&exptime=0.1")
+        self.assertEqual(response.code, 409)
+        self.assertEqual(json.loads(response.body)["id"], expid)
+
+        self.fetch(f"/exposure?id={expid}&wait=10", request_timeout=20)
+        response = self.fetch("/sequence?nframes=1&exptime=0.1")
+        self.assertEqual(response.code, 200)
+        self.assertEqual(self.wait()["state"], "done")
@@ -0,0 +1,129 @@
+"""
+Tests for co-adding frames on the server
+"""
+
+import io
+import json
+
+import numpy as np
+import pytest
+from astropy.io import fits
+from tornado.testing import AsyncHTTPTestCase
+
+from ..loadtest import create_server
+from ..simulate import FakeCamera
+from ..stack import Stack
+
+
+def make_hdu(value, shape=(16, 16), exptime=1.0, imagetyp="Light"):
+    hdu = fits.PrimaryHDU(np.full(shape, value, dtype=np.uint16))
+    hdu.header["EXPTIME"] = exptime
+    hdu.header["IMAGETYP"] = imagetyp
+    return hdu
+
+
+def test_running_stacks():
+    stacks = {mode: Stack(mode=mode, depth=3) for mode in ("sum", "mean", "median")}
+    for i, value in enumerate([10, 20, 90, 30, 40]):
+        for stack in stacks.values():
+            stack.add(make_hdu(value), {"filename": f"test_{i}.fits"})
+
+    # only the last 3 frames are combined
+    assert np.all(stacks["sum"].combine() == 160.0)
+    assert np.allclose(stacks["mean"].combine(), 160.0 / 3)
+    assert np.all(stacks["median"].combine() == 40.0)
+    assert stacks["mean"].combine().dtype == np.float32
+
+    hdu = stacks["sum"].hdu()
+    assert hdu.header["NCOMBINE"] == 3
+    assert hdu.header["EXPTIME"] == 3.0
+    assert hdu.header["IMCMB001"] == "test_2.fits"
+    assert [f["filename"] for f in stacks["sum"].state()["frames"]] == [
+        "test_2.fits",
+        "test_3.fits",
+        "test_4.fits",
+    ]
+    assert stacks["mean"].hdu().header["EXPTIME"] == 1.0
+
+
+def test_unlimited_depth():
+    stack = Stack(mode="mean", depth=0)
+    for value in range(1, 11):
+        stack.add(make_hdu(value))
+    assert len(stack) == 10
+    assert np.allclose(stack.combine(), 5.5)
+    assert stack.ring is None
+
+    with pytest.raises(ValueError):
+        Stack(mode="median", depth=0)
+    with pytest.raises(ValueError):
+        Stack(mode="bogus")
+
+
+def test_geometry_and_memory():
+    stack = Stack(mode="sum", depth=8, maxbytes=3 * 16 * 16 * 4)
+    stack.add(make_hdu(1))
+    assert len(stack.ring) == 3
+
+    # a change in shape starts a new stack
+    stack.add(make_hdu(2, shape=(8, 8)))
+    assert len(stack) == 1
+    assert stack.combine().shape == (8, 8)
+
+    # frames of another image type are skipped rather than throwing the stack away
+    assert stack.add(make_hdu(3, shape=(8, 8), imagetyp="Dark")) is None
+    assert stack.add(make_hdu(2, shape=(8, 8))) == 2
+    assert np.all(stack.combine() == 4.0)
+    assert stack.state()["imagetyp"] == "light"
+
+    # as does a window of the same size somewhere else on the detector
+    nframes = []
+    for x0 in (0, 0, 16):
+        hdu = make_hdu(4, shape=(8, 8))
+        hdu.header["XORGSUBF"] = x0
+        hdu.header["YORGSUBF"] = 0
+        nframes.append(stack.add(hdu))
+    assert nframes == [1, 2, 1]
+
+
+class TestStack(AsyncHTTPTestCase):
+    def get_app(self):
+        app = create_server("sim", shape=(64, 64))
+        app.camera = FakeCamera(shape=(64, 64))
+        app.bad_pixel_mask = None
+        return app
+
+    def test_stack(self):
+        self.assertEqual(self.fetch("/stack").code, 404)
+
+        info = json.loads(self.fetch("/stack/start?mode=sum&depth=4").body)
+        self.assertTrue(info["enabled"])
+        self.assertEqual(info["mode"], "sum")
+
+        response = self.fetch("/sequence?nframes=3&exptime=0.01")
+        self.assertEqual(response.code, 200)
+        self.fetch("/sequence/status?wait=10", request_timeout=20)
+
+        response = self.fetch("/stack")
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.headers["X-Stack-Frames"], "3")
+        with fits.open(io.BytesIO(response.body)) as hdulist:
+            self.assertEqual(hdulist[0].header["NCOMBINE"], 3)
+            stacked = hdulist[0].data
+        frames = self._app.frames
+        expected = sum(frames.back(i).hdu.data.astype(np.float32) for i in range(3))
+        np.testing.assert_allclose(stacked, expected)
+
+        response = self.fetch("/stack?format=png&size=32")
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.headers["Content-Type"], "image/png")
+        self.assertEqual(self.fetch("/stack?format=png&stretch=foo").code, 400)
+        self.assertEqual(self.fetch("/stack?size=99999").code, 400)
+
+        info = json.loads(self.fetch("/stack/stop").body)
+        self.assertFalse(info["enabled"])
+        self.assertEqual(
+            [f["id"] for f in info["frames"]], [frames.back(i).id for i in (2, 1, 0)]
+        )
+
+        self.assertEqual(self.fetch("/stack/start?mode=bogus").code, 400)
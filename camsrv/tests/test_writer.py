@@ -0,0 +1,148 @@
+"""
+Tests for the queued FITS writer
+"""
+
+import io
+import tempfile
+import threading
+
+import numpy as np
+import pytest
+from astropy.io import fits
+from tornado.testing import AsyncTestCase
+
+from ..loadtest import create_server
+from ..writer import OUTPUT_FORMATS, FITSWriter, encode_fits, pack_int16
+
+
+def test_unique_filenames(tmp_path):
+    writer = FITSWriter()
+    names = [writer.next_filename(tmp_path, "f9wfs") for _ in range(5)]
+    assert len(set(names)) == 5
+    assert all(n.name.startswith("f9wfs_") and n.suffix == ".fits" for n in names)
+
+
+def test_write(tmp_path):
+    writer = FITSWriter(maxsize=2)
+    hdu = fits.PrimaryHDU(np.arange(100, dtype=np.uint16).reshape(10, 10))
+    buf = io.BytesIO()
+    hdu.writeto(buf)
+
+    filenames = []
+    for _ in range(5):
+        filename = writer.next_filename(tmp_path, "test")
+        filenames.append(filename)
+        assert writer.submit(filename, buf.getvalue())
+        writer.flush()
+    writer.stop()
+
+    stats = writer.stats()
+    assert stats["written"] == 5
+    assert stats["rejected"] == 0
+    assert stats["failed"] == 0
+    assert stats["backlog"] == 0
+    assert stats["mean_latency"] >= 0.0
+    for filename in filenames:
+        assert np.array_equal(fits.getdata(filename), hdu.data)
+    # no temporary files are left behind
+    assert sorted(tmp_path.glob(".*")) == []
+
+
+def test_write_full(tmp_path):
+    writer = FITSWriter(maxsize=2)
+    data = encode_fits(fits.PrimaryHDU(np.zeros((10, 10), dtype=np.uint16)))
+
+    # hold up the writer thread on the first frame so the queue fills behind it
+    writing, release = threading.Event(), threading.Event()
+    write = writer._write
+
+    def blocked_write(*args):
+        writing.set()
+        release.wait(10)
+        write(*args)
+
+    writer._write = blocked_write
+    filenames = [tmp_path / f"test_{i}.fits" for i in range(6)]
+    assert writer.submit(filenames[0], data)
+    assert writing.wait(10)
+    accepted = [writer.submit(filename, data) for filename in filenames[1:]]
+    assert accepted == [True, True, False, False, False]
+    assert writer.stats()["rejected"] == 3
+
+    release.set()
+    writer.flush()
+    writer.stop()
+    stats = writer.stats()
+    assert stats["written"] == 3
+    assert stats["rejected"] == 3
+    assert [f.exists() for f in filenames] == [True] * 3 + [False] * 3
+
+
+def test_write_failure(tmp_path):
+    writer = FITSWriter()
+    writer.submit(tmp_path / "nonexistent" / "test.fits", b"data")
+    writer.flush()
+    assert writer.stats()["failed"] == 1
+
+    # the temporary file is cleaned up if it can't be renamed into place
+    (tmp_path / "test.fits").mkdir()
+    writer.submit(tmp_path / "test.fits", b"data")
+    writer.flush()
+    assert writer.stats()["failed"] == 2
+    assert sorted(tmp_path.glob(".*")) == []
+    writer.stop()
+
+
+class TestSave(AsyncTestCase):
+    def test_save_rejected(self):
+        with tempfile.TemporaryDirectory() as datadir:
+            app = create_server("matcam", shape=(16, 16), datadir=datadir)
+            app.latest_image = fits.PrimaryHDU(np.zeros((16, 16), dtype=np.uint16))
+            app.save_latest()
+            app.writer.flush()
+            self.assertTrue(app.last_filename.exists())
+
+            # a frame the writer turns away gets no filename rather than one that is never written
+            app.writer.submit = lambda *args, **kwargs: False
+            app.save_latest()
+            self.assertIsNone(app.last_filename)
+            self.assertIsNone(app.buffer_latest().filename)
+
+
+def test_pack_int16():
+    assert pack_int16(np.array([0.0, 65535.0])).dtype == np.uint16
+    assert pack_int16(np.array([-5, 100], dtype=np.int32)).dtype == np.int16
+    assert pack_int16(np.array([0.5, 1.0])).dtype == np.float64
+    assert pack_int16(np.array([0.0, np.nan])).dtype == np.float64
+    assert pack_int16(np.array([0, 70000], dtype=np.int32)).dtype == np.int32
+
+
+@pytest.mark.parametrize("fmt", OUTPUT_FORMATS)
+@pytest.mark.parametrize("dtype", [np.uint16, np.float32])
+def test_encode_lossless(fmt, dtype):
+    rng = np.random.default_rng(0)
+    data = rng.normal(1000.0, 10.0, (64, 64)).astype(dtype)
+    hdu = fits.PrimaryHDU(data)
+    hdu.header["EXPTIME"] = 1.5
+
+    with fits.open(io.BytesIO(encode_fits(hdu, fmt))) as hdulist:
+        # compressed images are in the first extension
+        assert len(hdulist) == (2 if fmt in ("rice", "gzip") else 1)
+        assert np.array_equal(hdulist[-1].data, data)
+        assert hdulist[-1].header["EXPTIME"] == 1.5
+
+    with pytest.raises(ValueError):
+        encode_fits(hdu, "jpeg")
+
+
+def test_write_compressed(tmp_path):
+    writer = FITSWriter(fmt="rice")
+    hdu = fits.PrimaryHDU(np.full((256, 256), 1000, dtype=np.uint16))
+    filename = writer.next_filename(tmp_path, "test")
+    writer.submit(filename, encode_fits(hdu), hdu=hdu)
+    writer.flush()
+    writer.stop()
+
+    assert writer.stats()["format"] == "rice"
+    assert np.array_equal(fits.getdata(filename, ext=1), hdu.data)
+    assert filename.stat().st_size < len(encode_fits(hdu))
@@ -0,0 +1,263 @@
+"""
+Write FITS files from a bounded queue in a dedicated thread so slow disks don't stall the servers
+"""
+
+import io
+import os
+import time
+import queue
+import logging
+import threading
+from pathlib import Path
+
+import numpy as np
+from astropy.io import fits
+
+log = logging.getLogger("tornado.application")
+
+__all__ = ["OUTPUT_FORMATS", "FITSWriter", "encode_fits", "pack_int16", "write_atomic"]
+
+# tile compression algorithms for each compressed output format
+OUTPUT_FORMATS = {
+    "none": None,
+    "int16": None,
+    "rice": "RICE_1",
+    "gzip": "GZIP_2",
+}
+
+
+def pack_int16(data):
+    """
+    Return data as 16-bit integers if that can be done without losing anything, e.g. a float image
+    that only holds whole numbers of ADU. Otherwise data is returned as is.
+    """
+    if data.dtype.itemsize <= 2 and data.dtype.kind in "iu":
+        return data
+    if data.dtype.kind not in "iuf" or data.size == 0:
+        return data
+    if data.dtype.kind == "f" and not (
+        np.isfinite(data).all() and np.array_equal(data, np.rint(data))
+    ):
+        return data
+
+    vmin, vmax = data.min(), data.max()
+    for dtype in (np.uint16, np.int16):
+        info = np.iinfo(dtype)
+        if vmin >= info.min and vmax <= info.max:
+            return data.astype(dtype)
+    return data
+
+
+def encode_fits(hdu, fmt="none"):
+    """
+    Serialize hdu in the given output format. "int16" packs the data into 16-bit integers when lossless.
+    "rice" and "gzip" write an empty primary HDU followed by a tile-compressed image extension. Float
+    images that can't be packed are compressed without quantization so nothing is lost.
+    """
+    if fmt not in OUTPUT_FORMATS:
+        raise ValueError(
+            f"Unsupported output format {fmt}, must be one of {list(OUTPUT_FORMATS)}"
+        )
+
+    out = io.BytesIO()
+    if fmt == "none":
+        hdu.writeto(out)
+        return out.getvalue()
+
+    data = pack_int16(hdu.data)
+    if fmt == "int16":
+        fits.PrimaryHDU(data, header=hdu.header).writeto(out)
+        return out.getvalue()
+
+    compression = OUTPUT_FORMATS[fmt]
+    kwargs = {}
+    if data.dtype.kind == "f":
+        # Rice can't compress floats without quantizing them
+        compression = "GZIP_2"
+        kwargs["quantize_level"] = 0.0
+    comp = fits.CompImageHDU(
+        data, header=hdu.header, compression_type=compression, **kwargs
+    )
+    fits.HDUList([fits.PrimaryHDU(), comp]).writeto(out)
+    return out.getvalue()
+
+
+def write_atomic(filename, data):
+    """
+    Write data to a temporary file next to filename and rename it into place so readers never see
+    a partially written file
+    """
+    filename = Path(filename)
+    tmpname = filename.with_name(f".{filename.name}.tmp")
+    try:
+        with open(tmpname, "wb") as fp:
+            fp.write(data)
+        os.replace(tmpname, filename)
+    except Exception:
+        try:
+            tmpname.unlink()
+        except OSError:
+            pass
+        raise
+
+
+class FITSWriter:
+    """
+    Queue of (filename, bytes) to write, drained by a writer thread. If the queue is full, the frame is
+    rejected rather than written on the caller's thread, which is usually the IOLoop or the
+    processing thread, and the rejection is logged and counted.
+    Frames are written in the output format fmt, one of OUTPUT_FORMATS. Compression is done in the
+    writer thread as well. If a MetricsRegistry is given, write times are recorded in it.
+    """
+
+    def __init__(self, maxsize=16, fmt="none", metrics=None):
+        if fmt not in OUTPUT_FORMATS:
+            raise ValueError(
+                f"Unsupported output format {fmt}, must be one of {list(OUTPUT_FORMATS)}"
+            )
+        self.fmt = fmt
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.lock = threading.Lock()
+        self._thread = None
+
+        self._stamp = None
+        self._seq = 0
+
+        self.nwritten = 0
+        self.nfailed = 0
+        self.nrejected = 0
+        self.last_latency = None
+        self.max_latency = 0.0
+        self.total_latency = 0.0
+        self.last_error = None
+
+        self.write_time = self.write_latency = None
+        if metrics is not None:
+            self.write_time = metrics.histogram(
+                "write_seconds", "Time to encode and write a FITS file"
+            )
+            self.write_latency = metrics.histogram(
+                "write_latency_seconds",
+                "Time from queueing a FITS file to it being on disk",
+            )
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    @property
+    def backlog(self):
+        return self.queue.qsize()
+
+    def start(self):
+        if self.running:
+            return
+        self._thread = threading.Thread(
+            target=self._run, name="fits-writer", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        """
+        Write out whatever is queued and stop the writer thread
+        """
+        if self.running:
+            self.queue.put(None)
+            self._thread.join()
+        self._thread = None
+
+    def flush(self):
+        """
+        Block until everything queued so far has been written
+        """
+        self.queue.join()
+
+    def next_filename(self, datadir, prefix):
+        """
+        Return a filename of the form prefix_YYYYmmdd-HHMMSS.fits in datadir. Frames within the same
+        second get _1, _2, etc. appended so filenames never collide.
+        """
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        with self.lock:
+            if stamp == self._stamp:
+                self._seq += 1
+            else:
+                self._stamp = stamp
+                self._seq = 0
+            seq = self._seq
+        name = f"{prefix}_{stamp}.fits" if seq == 0 else f"{prefix}_{stamp}_{seq}.fits"
+        return Path(datadir) / name
+
+    def submit(self, filename, data, hdu=None):
+        """
+        Queue data to be written to filename. data are the uncompressed FITS bytes of hdu. If the output
+        format isn't "none", hdu is queued instead to be encoded by the writer thread. Returns False if the
+        queue was full and the frame was not written.
+        """
+        if self.fmt != "none" and hdu is not None:
+            data = hdu
+        self.start()
+        try:
+            self.queue.put_nowait((filename, data, time.time()))
+            return True
+        except queue.Full:
+            log.error(
+                f"FITS write queue is full ({self.queue.maxsize} frames), not writing {filename}"
+            )
+            with self.lock:
+                self.nrejected += 1
+            return False
+
+    def _write(self, filename, data, queued):
+        start = time.time()
+        try:
+            if not isinstance(data, bytes):
+                data = encode_fits(data, self.fmt)
+            write_atomic(filename, data)
+        except Exception as e:
+            log.error(f"Error writing {filename}: {e}")
+            with self.lock:
+                self.nfailed += 1
+                self.last_error = str(e)
+            return
+
+        now = time.time()
+        latency = now - queued
+        if self.write_time is not None:
+            self.write_time.observe(now - start, format=self.fmt)
+            self.write_latency.observe(latency)
+        with self.lock:
+            self.nwritten += 1
+            self.last_latency = latency
+            self.max_latency = max(self.max_latency, latency)
+            self.total_latency += latency
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                self._write(*item)
+            finally:
+                self.queue.task_done()
+
+    def stats(self):
+        """
+        Return dict of queue depth, counts, and write latencies, in seconds, from queueing to on disk
+        """
+        with self.lock:
+            return {
+                "format": self.fmt,
+                "backlog": self.backlog,
+                "maxsize": self.queue.maxsize,
+                "written": self.nwritten,
+                "failed": self.nfailed,
+                "rejected": self.nrejected,
+                "last_latency": self.last_latency,
+                "max_latency": self.max_latency,
+                "mean_latency": (
+                    self.total_latency / self.nwritten if self.nwritten > 0 else None
+                ),
+                "last_error": self.last_error,
+            }